@@ -0,0 +1,192 @@
+# --- START OF FILE analysis_cache.py ---
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Optional
+
+# On-disk cache of raw model answers (description / reasoning / selected_id).
+# Rows are keyed by (file content hash, model pair, ruleset) so that a rerun over
+# the same images with the same model and prompts never touches the engine again.
+# Descriptions are also kept per content hash, independent of the ruleset, so a
+# changed ruleset can be re-applied to the text without re-sending the images.
+
+HASH_CHUNK = 1024 * 1024
+ROW_OVERHEAD = 64  # bytes counted per file_hashes / descriptions row besides its text (keys, integers)
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk: break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def model_digest(model_path: str, mmproj_path: str) -> str:
+    key = f"{os.path.abspath(model_path or '')}|{os.path.abspath(mmproj_path or '')}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def ruleset_digest(categories: List[Dict], variant: str = "") -> str:
+    # Only what the model actually sees matters; folder names are applied afterwards.
+    payload = json.dumps([[str(c["id"]), c["prompt"]] for c in categories], ensure_ascii=False)
+    return hashlib.blake2b(f"{variant}|{payload}".encode("utf-8"), digest_size=12).hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, path: str, max_size_mb: int = 512):
+        self.path = path
+        self.max_bytes = max(1, int(max_size_mb)) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts_since_check = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS analysis (
+                content_hash TEXT NOT NULL,
+                model_key TEXT NOT NULL,
+                rules_key TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (content_hash, model_key, rules_key)
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_analysis_access ON analysis(last_access)")
+        # path/size/mtime -> content hash, so unchanged files are not re-read on every run
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            )""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS descriptions (
+                content_hash TEXT PRIMARY KEY,
+                model_key TEXT NOT NULL,
+                description TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._db.commit()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit: bool):
+        """Records one lookup made with get(..., count=False)."""
+        with self._lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def content_hash(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, content_hash FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        digest = file_digest(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, digest))
+            self._db.commit()
+        return digest
+
+    def get(self, content_hash: str, model_key: str, rules_key: str, count: bool = True) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM analysis WHERE content_hash = ? AND model_key = ? AND rules_key = ?",
+                (content_hash, model_key, rules_key)).fetchone()
+            if row is None:
+                if count: self.misses += 1
+                return None
+            if count: self.hits += 1
+            self._db.execute(
+                "UPDATE analysis SET last_access = ? WHERE content_hash = ? AND model_key = ? AND rules_key = ?",
+                (time.time(), content_hash, model_key, rules_key))
+            self._db.commit()
+        try: return json.loads(row[0])
+        except: return None
+
+    def put(self, content_hash: str, model_key: str, rules_key: str, result: Dict):
+        blob = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis (content_hash, model_key, rules_key, result, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, model_key, rules_key, blob, len(blob), time.time()))
+            self._db.commit()
+            self._puts_since_check += 1
+            if self._puts_since_check >= 100:
+                self._puts_since_check = 0
+                self._evict_locked()
+
+    def put_description(self, content_hash: str, model_key: str, description: str):
+        if not description: return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO descriptions (content_hash, model_key, description, updated_at) VALUES (?, ?, ?, ?)",
+                (content_hash, model_key, description, time.time()))
+            self._db.commit()
+
+    def get_description(self, content_hash: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT description FROM descriptions WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def _sizes_locked(self):
+        """Approximate bytes of the answers, and of the descriptions plus the path -> hash memo."""
+        answers = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM analysis").fetchone()[0]
+        descriptions = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(description)), 0) + COUNT(*) * ? FROM descriptions", (ROW_OVERHEAD,)).fetchone()[0]
+        hashes = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(path)), 0) + COUNT(*) * ? FROM file_hashes", (ROW_OVERHEAD,)).fetchone()[0]
+        return answers, descriptions + hashes
+
+    def _evict_locked(self):
+        if sum(self._sizes_locked()) <= self.max_bytes: return
+        # Drop least recently used answers, and the descriptions and file hashes of content that has
+        # no answer left, until we are back under 90% of the budget.
+        goal = int(self.max_bytes * 0.9)
+        while True:
+            answers, rest = self._sizes_locked()
+            excess = answers + rest - goal
+            if excess <= 0: break
+            # Each answer is assumed to take its share of descriptions and hashes along.
+            rows = self._db.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+            share = rest // rows if rows else 0
+            freed = 0
+            doomed = []
+            for rowid, size in self._db.execute("SELECT rowid, size FROM analysis ORDER BY last_access ASC"):
+                doomed.append((rowid,))
+                freed += size + share
+                if freed >= excess: break
+            self._db.executemany("DELETE FROM analysis WHERE rowid = ?", doomed)
+            self._db.execute("DELETE FROM descriptions WHERE content_hash NOT IN (SELECT content_hash FROM analysis)")
+            self._db.execute("DELETE FROM file_hashes WHERE content_hash NOT IN (SELECT content_hash FROM analysis)")
+            if not doomed: break  # only rows without answers were left, and they are gone now
+        self._db.commit()
+        self._db.execute("PRAGMA incremental_vacuum")
+
+    def evict(self):
+        with self._lock:
+            self._evict_locked()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._evict_locked()
+                self._db.close()
+            except: pass
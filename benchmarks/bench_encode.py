@@ -0,0 +1,85 @@
+# --- START OF FILE benchmarks/bench_encode.py ---
+"""
+Micro-benchmark: legacy temp-PNG encoder vs. the in-memory encoder.
+
+Usage: python benchmarks/bench_encode.py [image_folder] [--repeat N]
+Without a folder a few synthetic photos/screenshots are generated in a temp dir.
+"""
+import os
+import sys
+import time
+import uuid
+import base64
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from PIL import Image
+import sorter_logic as logic
+
+
+def legacy_encode_image(path: str, temp_dir: str) -> str:
+    """The original encoder: RGB -> Lanczos 1500px -> PNG on disk -> read back -> base64."""
+    temp_png_path = os.path.join(temp_dir, f"temp_process_{uuid.uuid4().hex}.png")
+    try:
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+            if max(img.size) > 1500:
+                img.thumbnail((1500, 1500), Image.Resampling.LANCZOS)
+            img.save(temp_png_path, format="PNG")
+        with open(temp_png_path, "rb") as f:
+            b64 = base64.b64encode(f.read()).decode("utf-8")
+        return f"data:image/png;base64,{b64}"
+    finally:
+        if os.path.exists(temp_png_path): os.remove(temp_png_path)
+
+
+def make_synthetic_images(folder: str):
+    specs = [("photo_large.jpg", (6000, 4000), "JPEG"), ("photo_mid.jpg", (3000, 2000), "JPEG"),
+             ("screenshot.png", (2560, 1440), "PNG"), ("small.webp", (800, 600), "WEBP")]
+    paths = []
+    for name, size, fmt in specs:
+        # Smooth gradient plus noise: compresses like a photo, not like a flat fill.
+        img = Image.linear_gradient("L").resize(size).convert("RGB")
+        noise = Image.effect_noise(size, 40).convert("RGB")
+        img = Image.blend(img, noise, 0.35)
+        p = os.path.join(folder, name)
+        img.save(p, format=fmt, **({"quality": 92} if fmt in ("JPEG", "WEBP") else {}))
+        paths.append(p)
+    return paths
+
+
+def bench(label, fn, paths, repeat):
+    sizes = []
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for p in paths:
+            sizes.append(len(fn(p)))
+    dt = time.perf_counter() - t0
+    n = len(paths) * repeat
+    avg_kb = sum(sizes) / len(sizes) / 1024
+    print(f"{label:<22} {dt / n * 1000:8.1f} ms/image   {avg_kb:8.0f} KB payload/image")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder", nargs="?")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = logic.find_images(args.folder) if args.folder else make_synthetic_images(tmp)
+        if not paths:
+            print("No images found."); return
+        print(f"{len(paths)} images x {args.repeat} repeats\n")
+        bench("legacy (temp PNG)", lambda p: legacy_encode_image(p, tmp), paths, args.repeat)
+        for fmt, q in (("png", 0), ("jpeg", 90), ("jpeg", 80), ("webp", 85)):
+            label = f"in-memory {fmt}" + (f" q{q}" if q else "")
+            bench(label, lambda p, fmt=fmt, q=q: base64.b64encode(logic.encode_image_bytes(p, fmt=fmt, quality=q or None)), paths, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# --- START OF FILE benchmarks/bench_throughput.py ---
+"""
+End-to-end throughput benchmark: scan, encode, move and full sort/search runs
+against the local stub engine (benchmarks/stub_engine.py), no GPU needed.
+
+Usage: python benchmarks/bench_throughput.py [image_folder] [--count 200] [--latency 0.2]
+           [--per-image 0.05] [--slots 2] [--out results.json]
+           [--baseline old.json] [--tolerance 0.15]
+Without a folder a seeded synthetic corpus is generated (benchmarks/make_corpus.py).
+The images are copied to a scratch folder first; the source folder is never touched.
+With --baseline the exit code is 1 when any metric is more than --tolerance slower.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+for p in (ROOT_DIR, BENCH_DIR):
+    if p not in sys.path: sys.path.insert(0, p)
+
+import sorter_logic as logic
+import scanner
+import stub_engine
+from make_corpus import make_corpus
+
+RULES = [
+    {"id": "1", "prompt": "a photo of a landscape", "folder_name": "landscapes"},
+    {"id": "2", "prompt": "a screenshot of a game", "folder_name": "screenshots"},
+]
+
+
+def rate(n: int, seconds: float) -> float:
+    return round(n / seconds, 2) if seconds > 0 else 0.0
+
+
+def copy_corpus(src: str, dst: str) -> int:
+    if os.path.exists(dst): shutil.rmtree(dst)
+    shutil.copytree(src, dst)
+    return len(logic.find_images(dst))
+
+
+def bench_scan(folder: str, scratch: str) -> dict:
+    out = {}
+    exts = logic.ALLOWED_EXTENSIONS
+    for label, workers in (("scan_sequential", 1), ("scan_parallel", max(2, logic.SCAN_WORKERS))):
+        t0 = time.perf_counter()
+        n = sum(1 for _ in scanner.iter_images(folder, exts, workers))
+        out[label] = rate(n, time.perf_counter() - t0)
+    snaps = scanner.DirSnapshots(os.path.join(scratch, "snapshots.sqlite"))
+    try:
+        for label in ("scan_snapshot_cold", "scan_snapshot_warm"):
+            t0 = time.perf_counter()
+            n = sum(1 for _ in scanner.iter_images(folder, exts, 1, snaps))
+            out[label] = rate(n, time.perf_counter() - t0)
+    finally:
+        snaps.close()
+    return out
+
+
+def bench_encode(paths) -> dict:
+    t0 = time.perf_counter()
+    nbytes = sum(len(logic.encode_image_bytes(p)) for p in paths)
+    dt = time.perf_counter() - t0
+    return {"encode": rate(len(paths), dt), "encode_kb_per_image": round(nbytes / max(1, len(paths)) / 1024, 1)}
+
+
+def bench_move(folder: str) -> dict:
+    paths = logic.find_images(folder)
+    planner = logic.mover.MovePlanner()
+    t0 = time.perf_counter()
+    for i, p in enumerate(paths):
+        logic.move_file_unique(p, os.path.join(folder, f"dest_{i % 4}"), planner)
+    return {"move": rate(len(paths), time.perf_counter() - t0)}
+
+
+def bench_sort(src: str, work: str, mode: str, label: str, cfg: stub_engine.StubConfig) -> dict:
+    n = copy_corpus(src, work)
+    before = cfg.requests
+    t0 = time.perf_counter()
+    for _ in logic.run_sort_process(work, RULES, mode=mode): pass
+    dt = time.perf_counter() - t0
+    return {label: rate(n, dt), f"{label}_requests": cfg.requests - before}
+
+
+def bench_search(src: str, work: str, cfg: stub_engine.StubConfig) -> dict:
+    n = copy_corpus(src, work)
+    before = cfg.requests
+    t0 = time.perf_counter()
+    for _ in logic.run_search_process(work, "a red car", mode="fast"): pass
+    dt = time.perf_counter() - t0
+    return {"search_fast": rate(n, dt), "search_fast_requests": cfg.requests - before}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Throughput metrics (images/s) that dropped by more than tolerance."""
+    regressions = []
+    for key, old in baseline.get("metrics", {}).items():
+        new = results["metrics"].get(key)
+        if key.endswith(("_requests", "_kb_per_image")) or not isinstance(old, (int, float)) or not new or old <= 0: continue
+        if new < old * (1 - tolerance):
+            regressions.append(f"{key}: {new} < {old} (-{(1 - new / old) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder", nargs="?")
+    ap.add_argument("--count", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--latency", type=float, default=0.2)
+    ap.add_argument("--per-image", type=float, default=0.05)
+    ap.add_argument("--slots", type=int, default=2)
+    ap.add_argument("--out")
+    ap.add_argument("--baseline")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    args = ap.parse_args()
+
+    srv, url, cfg = stub_engine.serve(cfg=stub_engine.StubConfig(args.latency, args.per_image, args.slots))
+    logic.use_external_engine(url)
+    logic.ENGINE_PREWARM = False
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # Keep the benchmark's caches away from the user's temp/cache.
+        logic.CACHE_PATH = os.path.join(scratch, "analysis_cache.sqlite")
+        logic.SCAN_SNAPSHOT_PATH = os.path.join(scratch, "scan_snapshots.sqlite")
+        logic.INDEX_PATH = os.path.join(scratch, "caption_index.sqlite")
+        logic.THUMB_DIR = os.path.join(scratch, "thumbs")
+        # Its journals, jobs, logs and metrics too: a benchmark run must not replace the user's
+        # resumable job or become the run "Undo Last Sort" targets.
+        logic.JOURNAL_DIR = os.path.join(scratch, "journals")
+        logic.JOBS_DIR = os.path.join(scratch, "jobs")
+        logic.LOG_DIR = os.path.join(scratch, "logs")
+        logic.METRICS_DIR = os.path.join(scratch, "runs")
+
+        src = os.path.abspath(args.folder) if args.folder else os.path.join(scratch, "corpus")
+        if not args.folder:
+            print(f"Generating {args.count} synthetic images (seed {args.seed})...")
+            make_corpus(src, args.count, args.seed)
+        paths = logic.find_images(src)
+        if not paths:
+            print("No images found."); return 0
+        print(f"{len(paths)} images, stub latency {args.latency}s + {args.per_image}s/image, {args.slots} slots\n")
+
+        metrics = {}
+        metrics.update(bench_scan(src, scratch))
+        metrics.update(bench_encode(paths))
+        work = os.path.join(scratch, "work")
+        copy_corpus(src, work)
+        metrics.update(bench_move(work))
+
+        logic.CACHE_ENABLED = False
+        metrics.update(bench_sort(src, work, "precise", "sort_precise", cfg))
+        metrics.update(bench_sort(src, work, "fast", "sort_fast", cfg))
+        logic.CACHE_ENABLED = True
+        metrics.update(bench_sort(src, work, "precise", "sort_cache_cold", cfg))
+        metrics.update(bench_sort(src, work, "precise", "sort_cache_warm", cfg))
+        logic.close_analysis_cache()
+        metrics.update(bench_search(src, work, cfg))
+        logic.close_scan_snapshots()
+
+    srv.shutdown()
+    results = {
+        "images": len(paths),
+        "settings": {"prefetch_workers": logic.PREFETCH_WORKERS, "parallel_requests": logic.PARALLEL_REQUESTS,
+                     "batch_size": logic.BATCH_SIZE, "encode_format": logic.ENCODE_FORMAT,
+                     "latency": args.latency, "per_image": args.per_image, "slots": args.slots},
+        "platform": {"python": platform.python_version(), "system": platform.platform(), "cpus": os.cpu_count()},
+        "metrics": metrics,
+    }
+    for key, value in metrics.items():
+        unit = "" if key.endswith(("_requests", "_kb_per_image")) else " images/s"
+        print(f"{key:<22} {value:>10}{unit}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nREGRESSIONS:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
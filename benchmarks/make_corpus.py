@@ -0,0 +1,61 @@
+# --- START OF FILE benchmarks/make_corpus.py ---
+"""
+Generates a reproducible synthetic image corpus for the benchmarks.
+
+Usage: python benchmarks/make_corpus.py <out_folder> [--count 200] [--seed 1] [--depth 2]
+Mixes formats (jpg/png/webp/gif/bmp/tiff), sizes from thumbnails to 24 MP photos
+and a nested folder layout. The same seed always produces the same files.
+"""
+import os
+import random
+import argparse
+
+from PIL import Image
+
+FORMATS = [(".jpg", "JPEG", 0.45), (".png", "PNG", 0.25), (".webp", "WEBP", 0.15),
+           (".gif", "GIF", 0.05), (".bmp", "BMP", 0.05), (".tiff", "TIFF", 0.05)]
+SIZES = [((320, 240), 0.2), ((1280, 720), 0.3), ((1920, 1080), 0.25), ((4000, 3000), 0.2), ((6000, 4000), 0.05)]
+
+
+def make_image(size, rng: random.Random) -> Image.Image:
+    # Gradient plus noise compresses like a photo; the tint varies colours between files.
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    noise = Image.effect_noise(size, rng.randint(10, 60)).convert("RGB")
+    img = Image.blend(img, noise, rng.uniform(0.1, 0.5))
+    tint = Image.new("RGB", size, tuple(rng.randint(0, 255) for _ in range(3)))
+    return Image.blend(img, tint, rng.uniform(0.1, 0.6))
+
+
+def make_corpus(folder: str, count: int = 200, seed: int = 1, depth: int = 2) -> list:
+    """Writes count images under folder and returns their paths."""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    dirs = [folder]
+    for d in range(depth):
+        dirs += [os.path.join(p, f"sub{d}_{i}") for p in list(dirs) for i in range(2)]
+    for d in dirs: os.makedirs(d, exist_ok=True)
+    paths = []
+    for i in range(count):
+        ext, fmt, _ = rng.choices(FORMATS, weights=[f[2] for f in FORMATS])[0]
+        size = rng.choices(SIZES, weights=[s[1] for s in SIZES])[0][0]
+        p = os.path.join(rng.choice(dirs), f"img_{i:05d}{ext}")
+        img = make_image(size, rng)
+        if fmt == "GIF": img = img.convert("P")
+        img.save(p, format=fmt, **({"quality": 90} if fmt in ("JPEG", "WEBP") else {}))
+        paths.append(p)
+    return paths
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder")
+    ap.add_argument("--count", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--depth", type=int, default=2)
+    args = ap.parse_args()
+    paths = make_corpus(args.folder, args.count, args.seed, args.depth)
+    print(f"Wrote {len(paths)} images to {os.path.abspath(args.folder)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# --- START OF FILE benchmarks/range_server.py ---
+"""
+Local file server with HTTP range support, for testing the model downloader.
+
+Serves the files of a folder like the Hugging Face CDN does for the downloader's
+purposes: single-range GET (206 + Content-Range), HEAD, an ETag and, unless
+--no-sha, the file's SHA-256 as X-Linked-ETag. --no-ranges ignores Range headers
+(the single-connection fallback); --fail-rate drops that fraction of responses
+midway to exercise retries and resume; --rate-mb throttles each connection.
+
+Usage: python benchmarks/range_server.py FOLDER [--port 5098] [--no-ranges] [--no-sha]
+                                         [--fail-rate 0.0] [--rate-mb 0]
+Then: python downloader.py OUT_DIR --url http://127.0.0.1:5098/model.gguf
+"""
+import os
+import re
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE_RE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+class RangeConfig:
+    def __init__(self, root: str, ranges: bool = True, sha: bool = True, fail_rate: float = 0.0, rate_mb: float = 0.0):
+        self.root = os.path.abspath(root)
+        self.ranges = ranges
+        self.sha = sha
+        self.fail_rate = fail_rate
+        self.rate_mb = rate_mb
+        self.requests = 0
+        self.ranged = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._sha = {}
+
+    def sha256(self, path: str) -> str:
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._sha: return self._sha[key]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+        with self._lock: self._sha[key] = h.hexdigest()
+        return self._sha[key]
+
+
+def make_handler(cfg: RangeConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _file(self):
+            name = os.path.basename(self.path.split("?")[0])
+            path = os.path.join(cfg.root, name)
+            return path if name and os.path.isfile(path) else None
+
+        def _headers(self, path: str, status: int, start: int, end: int, size: int):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("ETag", f'"{os.stat(path).st_mtime_ns:x}-{size:x}"')
+            if cfg.ranges: self.send_header("Accept-Ranges", "bytes")
+            if cfg.sha: self.send_header("X-Linked-ETag", f'"{cfg.sha256(path)}"')
+            if status == 206: self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+
+        def _resolve(self):
+            path = self._file()
+            if path is None:
+                self.send_error(404)
+                return None
+            size = os.path.getsize(path)
+            start, end, status = 0, size - 1, 200
+            m = RANGE_RE.match(self.headers.get("Range", "")) if cfg.ranges else None
+            if m:
+                start, end = int(m.group(1)), min(size - 1, int(m.group(2)) if m.group(2) else size - 1)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+                status = 206
+            return path, size, start, end, status
+
+        def do_HEAD(self):
+            r = self._resolve()
+            if r: self._headers(r[0], r[4], r[2], r[3], r[1])
+
+        def do_GET(self):
+            r = self._resolve()
+            if not r: return
+            path, size, start, end, status = r
+            with cfg._lock:
+                cfg.requests += 1
+                if status == 206: cfg.ranged += 1
+            self._headers(path, status, start, end, size)
+            fail_at = None
+            if cfg.fail_rate and random.random() < cfg.fail_rate:
+                fail_at = start + (end - start) // 2
+                with cfg._lock: cfg.failed += 1
+            try:
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    pos = start
+                    while pos <= end:
+                        n = min(256 * 1024, end + 1 - pos)
+                        if fail_at is not None and pos + n > fail_at:
+                            self.wfile.write(f.read(fail_at - pos))
+                            self.close_connection = True
+                            return  # the client sees a short body
+                        self.wfile.write(f.read(n))
+                        pos += n
+                        if cfg.rate_mb: time.sleep(n / (cfg.rate_mb * 1024 * 1024))
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # the client hung up (e.g. after reading the headers only)
+
+        def log_message(self, *args): pass
+
+    return Handler
+
+
+def serve(root: str, port: int = 0, host: str = "127.0.0.1", cfg: RangeConfig = None):
+    """Starts the server on a daemon thread. Returns (server, base url, cfg); port 0 picks a free port."""
+    cfg = cfg or RangeConfig(root)
+    srv = ThreadingHTTPServer((host, port), make_handler(cfg))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True, name="range-server").start()
+    return srv, f"http://{host}:{srv.server_address[1]}", cfg
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=5098)
+    ap.add_argument("--no-ranges", action="store_true")
+    ap.add_argument("--no-sha", action="store_true")
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--rate-mb", type=float, default=0.0, help="per-connection limit in MB/s (0 = unlimited)")
+    args = ap.parse_args()
+    cfg = RangeConfig(args.folder, not args.no_ranges, not args.no_sha, args.fail_rate, args.rate_mb)
+    srv, url, _ = serve(args.folder, args.port, args.host, cfg)
+    print(f"Serving {cfg.root} on {url} (Ctrl+C to stop)")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
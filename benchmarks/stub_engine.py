@@ -0,0 +1,172 @@
+# --- START OF FILE benchmarks/stub_engine.py ---
+"""
+Local stub of the koboldcpp OpenAI-compatible API for benchmarks.
+
+Answers every request shape the sorter sends (precise, batched, fast, multi-label,
+text re-classify, captions, re-rank) with canned JSON after a configurable delay, so
+the pipeline can be measured without a GPU or model files.
+
+Responses carry llama.cpp-style "timings" (prompt_n, cache_n, prompt_ms) from a
+simulated prefix cache: the tokens a prompt shares with the previous one are
+not processed again, so prompt layout changes can be checked here too.
+
+Usage: python benchmarks/stub_engine.py [--port 5099] [--latency 0.2] [--per-image 0.05]
+                                        [--slots 1] [--answer first|none|cycle] [--prefill-ms 0]
+Then set [engine] api_base_url = http://127.0.0.1:5099 in config.ini, or import
+serve() and call logic.use_external_engine(url).
+"""
+import re
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ID_RE = re.compile(r"- ID '([^']*)':")
+ITEM_RE = re.compile(r"^\s*\[(\d+)\]", re.M)
+
+
+class StubConfig:
+    def __init__(self, latency: float = 0.2, per_image: float = 0.05, slots: int = 1, answer: str = "first",
+                 prefill_ms: float = 0.0):
+        self.latency = latency        # seconds per request (prompt processing + decode)
+        self.per_image = per_image    # extra seconds per image part
+        self.prefill_ms = prefill_ms  # extra milliseconds per prompt token not served from the prefix cache
+        self.slots = max(1, slots)    # concurrent requests the "GPU" can serve (koboldcpp --multiuser)
+        self.answer = answer          # first | none | cycle
+        self.requests = 0
+        self.images = 0
+        self._sem = threading.Semaphore(self.slots)
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._last_prompt: list = []
+
+    def prefix_cache(self, units: list) -> int:
+        """Tokens shared with the previous prompt (what a single-slot KV cache could reuse)."""
+        with self._lock:
+            last, self._last_prompt = self._last_prompt, units
+        n = 0
+        for a, b in zip(last, units):
+            if a != b: break
+            n += 1
+        return n
+
+    def pick(self, ids):
+        if not ids or self.answer == "none": return "none"
+        if self.answer == "first": return ids[0]
+        with self._lock:
+            self._turn += 1
+            return (ids + ["none"])[self._turn % (len(ids) + 1)]
+
+
+def _text_of(content) -> str:
+    if isinstance(content, str): return content
+    return "\n".join(p.get("text", "") for p in content if p.get("type") == "text")
+
+
+def prompt_units(messages) -> list:
+    """The prompt as rough tokens: 4-character text pieces and 256 tokens per image."""
+    units = []
+    for m in messages:
+        parts = [{"type": "text", "text": m["content"]}] if isinstance(m.get("content"), str) else m.get("content") or []
+        for p in parts:
+            if p.get("type") == "text":
+                t = p.get("text", "")
+                units.extend(t[i:i + 4] for i in range(0, len(t), 4))
+            elif p.get("type") == "image_url":
+                key = hash(p.get("image_url", {}).get("url", ""))
+                units.extend((key, i) for i in range(256))
+    return units
+
+
+def build_answer(cfg: StubConfig, body: dict) -> str:
+    content = body["messages"][-1]["content"]
+    text = _text_of(content)
+    n_images = 0 if isinstance(content, str) else sum(1 for p in content if p.get("type") == "image_url")
+    ids = ID_RE.findall(text)
+
+    if body.get("grammar") or body.get("response_format"):
+        return json.dumps({"selected_id": cfg.pick(ids)})
+    if "<items>" in text:
+        n = len(ITEM_RE.findall(text.split("<items>", 1)[1]))
+        return json.dumps([{"item": i, "selected_id": cfg.pick(ids), "confidence": "high"} for i in range(n)])
+    if "<candidates>" in text:
+        n = len(ITEM_RE.findall(text.split("<candidates>", 1)[1]))
+        return json.dumps({"matches": list(range(0, n, 2))})
+    if '"tags"' in text:
+        return json.dumps({"description": "a stub caption of a photo", "tags": ["stub", "photo"]})
+    if '"selected_ids"' in text:
+        return json.dumps({"description": "stub", "selected_ids": [i for i in [cfg.pick(ids)] if i != "none"]})
+    if n_images > 1:
+        return json.dumps([{"image": k + 1, "description": "stub", "selected_id": cfg.pick(ids)} for k in range(n_images)])
+    return json.dumps({"description": "stub", "reasoning": "stub", "selected_id": cfg.pick(ids)})
+
+
+def make_handler(cfg: StubConfig):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self._send({"object": "list", "data": [{"id": "stub-model", "object": "model"}]})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            content = body.get("messages", [{}])[-1].get("content", "")
+            n_images = 0 if isinstance(content, str) else sum(1 for p in content if p.get("type") == "image_url")
+            units = prompt_units(body.get("messages", []))
+            with cfg._sem:
+                cached = cfg.prefix_cache(units)
+                prompt_ms = (len(units) - cached) * cfg.prefill_ms
+                time.sleep(cfg.latency + cfg.per_image * n_images + prompt_ms / 1000.0)
+            with cfg._lock:
+                cfg.requests += 1
+                cfg.images += n_images
+            answer = build_answer(cfg, body)
+            self._send({
+                "object": "chat.completion",
+                "model": "stub-model",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(units), "completion_tokens": max(1, len(answer) // 4)},
+                "timings": {"prompt_n": len(units) - cached, "cache_n": cached, "prompt_ms": prompt_ms},
+            })
+
+        def _send(self, obj):
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args): pass
+
+    return Handler
+
+
+def serve(port: int = 0, host: str = "127.0.0.1", cfg: StubConfig = None):
+    """Starts the stub on a daemon thread. Returns (server, url, cfg); port 0 picks a free port."""
+    cfg = cfg or StubConfig()
+    srv = ThreadingHTTPServer((host, port), make_handler(cfg))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True, name="stub-engine").start()
+    return srv, f"http://{host}:{srv.server_address[1]}", cfg
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=5099)
+    ap.add_argument("--latency", type=float, default=0.2)
+    ap.add_argument("--per-image", type=float, default=0.05)
+    ap.add_argument("--slots", type=int, default=1)
+    ap.add_argument("--answer", choices=["first", "none", "cycle"], default="first")
+    ap.add_argument("--prefill-ms", type=float, default=0.0)
+    args = ap.parse_args()
+    srv, url, _ = serve(args.port, args.host, StubConfig(args.latency, args.per_image, args.slots, args.answer, args.prefill_ms))
+    print(f"Stub engine listening on {url} (Ctrl+C to stop)")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
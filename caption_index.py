@@ -0,0 +1,125 @@
+# --- START OF FILE caption_index.py ---
+import os
+import re
+import math
+import time
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Per-image captions (description + tags) produced once by the vision model, so
+# searches can rank text instead of re-running the model over every image.
+# Rows are keyed by path and revalidated by size/mtime, then by content hash.
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "with", "and", "or", "is", "are",
+    "this", "that", "it", "its", "as", "by", "from", "be", "some", "image", "picture", "showing",
+}
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    out = []
+    for t in _TOKEN_RE.findall(text.lower()):
+        if t in STOPWORDS: continue
+        # Cheap plural folding so "cats" matches "cat".
+        if len(t) > 3 and t.endswith("s") and not t.endswith("ss"): t = t[:-1]
+        out.append(t)
+    return out
+
+
+def bm25_rank(query: str, docs: Dict[str, str], k1: float = 1.5, b: float = 0.75) -> List[Tuple[str, float, float]]:
+    """Ranks docs against the query. Returns (key, score, coverage) with coverage = share of query terms matched."""
+    q_terms = list(dict.fromkeys(tokenize(query)))
+    if not q_terms or not docs: return []
+    tfs = {key: Counter(tokenize(text)) for key, text in docs.items()}
+    n = len(tfs)
+    avgdl = sum(sum(tf.values()) for tf in tfs.values()) / n or 1.0
+    df = {t: sum(1 for tf in tfs.values() if t in tf) for t in q_terms}
+    idf = {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in q_terms}
+    ranked = []
+    for key, tf in tfs.items():
+        dl = sum(tf.values())
+        score, hit = 0.0, 0
+        for t in q_terms:
+            f = tf.get(t, 0)
+            if not f: continue
+            hit += 1
+            score += idf[t] * f * (k1 + 1) / (f + k1 * (1 - b + b * dl / avgdl))
+        if hit: ranked.append((key, score, hit / len(q_terms)))
+    ranked.sort(key=lambda x: -x[1])
+    return ranked
+
+
+class CaptionIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                description TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                model_key TEXT NOT NULL,
+                indexed_at REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_captions_hash ON captions(content_hash)")
+        self._db.commit()
+
+    def is_fresh(self, path: str, st: Optional[os.stat_result] = None) -> bool:
+        """True when the row for path still matches the file's size and mtime."""
+        st = st or os.stat(path)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns FROM captions WHERE path = ?", (path,)).fetchone()
+        return bool(row) and row[0] == st.st_size and row[1] == st.st_mtime_ns
+
+    def find_by_hash(self, content_hash: str) -> Optional[Tuple[str, str, str]]:
+        """(description, tags, model_key) of any row with that content, e.g. a moved or touched file."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT description, tags, model_key FROM captions WHERE content_hash = ? LIMIT 1",
+                (content_hash,)).fetchone()
+
+    def upsert(self, path: str, st: os.stat_result, content_hash: str, description: str, tags: Iterable[str], model_key: str):
+        tag_str = ", ".join(t.strip() for t in tags if t and t.strip()) if not isinstance(tags, str) else tags
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO captions (path, size, mtime_ns, content_hash, description, tags, model_key, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, content_hash, description, tag_str, model_key, time.time()))
+            self._db.commit()
+
+    def captions_for(self, paths: List[str]) -> Dict[str, Tuple[str, str]]:
+        out = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for p, d, t in self._db.execute(
+                        f"SELECT path, description, tags FROM captions WHERE path IN ({marks})", chunk):
+                    out[p] = (d, t)
+        return out
+
+    def prune(self, folder: str, present: Iterable[str]) -> int:
+        """Drops rows under folder whose file no longer exists there."""
+        keep = set(present)
+        prefix = os.path.join(os.path.abspath(folder), "")
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM captions WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+            gone = [(p,) for (p,) in rows if p not in keep]
+            self._db.executemany("DELETE FROM captions WHERE path = ?", gone)
+            self._db.commit()
+        return len(gone)
+
+    def close(self):
+        with self._lock:
+            try: self._db.close()
+            except: pass
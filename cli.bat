@@ -0,0 +1,20 @@
+@echo off
+setlocal
+
+REM Headless Image Sorter: cli.bat sort "D:\Photos" --rules rules.json
+set "PYTHONDONTWRITEBYTECODE=1"
+
+set "BASE_DIR=%~dp0"
+if "%BASE_DIR:~-1%"=="\" set "BASE_DIR=%BASE_DIR:~0,-1%"
+
+set "PYTHON_EXE=%BASE_DIR%\bin\python-3.13.9-embed-amd64\python.exe"
+set "SCRIPT=%BASE_DIR%\cli.py"
+
+if not exist "%PYTHON_EXE%" (
+    echo [ERROR] Python executable not found: "%PYTHON_EXE%" 1>&2
+    exit /b 1
+)
+
+cd /d "%BASE_DIR%"
+"%PYTHON_EXE%" "%SCRIPT%" %*
+exit /b %ERRORLEVEL%
@@ -0,0 +1,220 @@
+# --- START OF FILE cli.py ---
+"""
+Headless entry point (no Gradio): sort, search or index a folder from the command line.
+
+  python cli.py sort   <folder> --rules rules.json [--mode precise|fast|cascade] [--reclassify] [--dry-run]
+  python cli.py search <folder> --query "a red car" [--query "a dog" ...] [--live] [--no-rerank]
+  python cli.py index  <folder>
+  python cli.py undo
+  python cli.py resume [sort|search]
+
+Rules file (JSON, or YAML when PyYAML is installed): either a list of
+{"folder": "Cats", "prompt": "a photo of a cat"} objects, {"rules": [...]}, or a
+plain {"Cats": "a photo of a cat", ...} mapping.
+
+stdout carries one JSON object per line (events: start, progress, result, match,
+status, summary, error); everything the engine or logic prints goes to stderr.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+EXIT_OK = 0
+EXIT_ERROR = 1        # engine/model failure or unexpected error
+EXIT_USAGE = 2        # bad arguments or rules file
+EXIT_NO_IMAGES = 3
+EXIT_PARTIAL = 4      # finished, but some requests or moves failed
+EXIT_STOPPED = 130    # interrupted (Ctrl+C)
+
+_out = sys.stdout
+
+
+def emit(event: str, **fields):
+    _out.write(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False) + "\n")
+    _out.flush()
+
+
+def load_rules(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f: text = f.read()
+    if path.lower().endswith((".yaml", ".yml")):
+        try: import yaml
+        except ImportError: raise ValueError("YAML rules need PyYAML (pip install pyyaml); use JSON otherwise.")
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if isinstance(data, dict) and "rules" in data: data = data["rules"]
+    if isinstance(data, dict): data = [{"folder": k, "prompt": v} for k, v in data.items()]
+    if not isinstance(data, list): raise ValueError("Rules must be a list, a {'rules': [...]} object or a folder -> prompt mapping.")
+    rules = []
+    for i, r in enumerate(data):
+        if not isinstance(r, dict): raise ValueError(f"Rule {i + 1} is not an object.")
+        prompt = str(r.get("prompt", "")).strip()
+        if not prompt: continue
+        name = str(r.get("folder") or r.get("folder_name") or f"Folder_{i + 1}").strip()
+        rules.append({"id": str(i + 1), "folder_name": name, "prompt": prompt})
+    if not rules: raise ValueError("No rules with a prompt defined.")
+    return rules
+
+
+class Progress:
+    """progress_callback stand-in that emits at most one progress event per interval."""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last = 0.0
+
+    def __call__(self, value, desc: str = ""):
+        done, total = value
+        if done < total and time.time() - self.last < self.interval: return
+        self.last = time.time()
+        emit("progress", done=done, total=total, desc=desc)
+
+
+def run_status(logic, failures: int = 0) -> int:
+    """Exit code from the run's metrics: engine down or every request failed -> error; some failed -> partial."""
+    c = logic.stage_metrics.snapshot()["counters"]
+    if c.get("engine_errors") or (c.get("errors") and c.get("errors") >= c.get("requests", 0)): return EXIT_ERROR
+    if c.get("errors") or failures: return EXIT_PARTIAL
+    return EXIT_STOPPED if logic.stop_event.is_set() else EXIT_OK
+
+
+def cmd_sort(logic, args, rules=None, resume=False) -> int:
+    rules = rules or load_rules(args.rules)
+    failed = [0]
+
+    def on_result(path, match, dest, err):
+        if err is not None: failed[0] += 1
+        emit("result", file=path, folder=match["folder_name"] if match else None, dest=dest,
+             error=str(err) if err is not None else None)
+
+    emit("start", command="sort", folder=os.path.abspath(args.folder), mode="reclassify" if args.reclassify else args.mode, rules=rules)
+    last = ""
+    for last in logic.run_sort_process(args.folder, rules, Progress(args.progress_interval), args.reclassify, args.mode, on_result, args.dry_run, resume):
+        pass
+    if last == "No images found.":
+        emit("error", message=last); return EXIT_NO_IMAGES
+    summary = last.split("--- COMPLETE ---", 1)[-1].strip().splitlines()
+    emit("summary", lines=summary, move_errors=failed[0])
+    if "CRITICAL ERROR:" in last: return EXIT_ERROR
+    return run_status(logic, failed[0])
+
+
+def cmd_search(logic, args, resume=False) -> int:
+    queries = list(dict.fromkeys(args.query))
+    multi = len(queries) > 1
+    emit("start", command="search", folder=os.path.abspath(args.folder), query=queries if multi else queries[0], live=args.live)
+    found = {q: [] for q in queries}
+    def matched(q, paths):
+        for p in paths: emit("match", file=p, **({"query": q} if multi else {}))
+    if args.live:
+        # All queries in one pass: each image is analyzed once.
+        for found_now in logic.run_multi_search_process(args.folder, queries, Progress(args.progress_interval), args.mode, resume):
+            for q in queries:
+                matched(q, found_now[q][len(found[q]):])
+                found[q] = list(found_now[q])
+    else:
+        for q in queries:
+            for found_now, status in logic.run_indexed_search_process(args.folder, q, args.rerank, Progress(args.progress_interval)):
+                emit("status", message=status)
+                found[q] = list(found_now)
+                if status == "No images found.": return EXIT_NO_IMAGES
+            matched(q, found[q])
+    if multi: emit("summary", matches=sum(map(len, found.values())), per_query={q: len(v) for q, v in found.items()})
+    else: emit("summary", matches=len(found[queries[0]]))
+    return run_status(logic)
+
+
+def cmd_index(logic, args) -> int:
+    emit("start", command="index", folder=os.path.abspath(args.folder))
+    last = ""
+    for last in logic.run_index_process(args.folder, Progress(args.progress_interval)): pass
+    if last == "No images found.":
+        emit("error", message=last); return EXIT_NO_IMAGES
+    emit("summary", lines=last.splitlines()[-2:])
+    if "CRITICAL ERROR:" in last: return EXIT_ERROR
+    return run_status(logic)
+
+
+def cmd_resume(logic, args) -> int:
+    job = logic.last_job(args.kind)
+    if job is None:
+        emit("error", message=f"No interrupted {args.kind} job to resume."); return EXIT_ERROR
+    s = job.state
+    args.folder, args.mode = s["folder"], s.get("mode", "precise")
+    if args.kind == "sort":
+        args.reclassify, args.dry_run = s.get("reclassify", False), False
+        return cmd_sort(logic, args, rules=s["rules"], resume=True)
+    args.query, args.live = s.get("queries") or [s["query"]], True
+    return cmd_search(logic, args, resume=True)
+
+
+def cmd_undo(logic, args) -> int:
+    path = logic.last_undoable_journal()
+    if not path:
+        emit("error", message="Nothing to undo."); return EXIT_ERROR
+    emit("start", command="undo", journal=path)
+    restored, problems = logic.mover.undo(path)
+    for p in problems: emit("error", message=p)
+    emit("summary", restored=restored, problems=len(problems))
+    return EXIT_PARTIAL if problems else EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="cli.py", description="Image Sorter without the web UI (JSONL on stdout).")
+    ap.add_argument("--api-base-url", help="use this OpenAI-compatible server instead of spawning koboldcpp")
+    ap.add_argument("--progress-interval", type=float, default=1.0, help="seconds between progress events")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("sort", help="sort images into rule folders")
+    s.add_argument("folder")
+    s.add_argument("--rules", required=True, help="rules file (.json, .yaml/.yml)")
+    s.add_argument("--mode", choices=["precise", "fast", "cascade"], default="precise")
+    s.add_argument("--reclassify", action="store_true", help="re-classify from stored descriptions")
+    s.add_argument("--dry-run", action="store_true", help="only report where images would go (written to the move journal)")
+
+    q = sub.add_parser("search", help="search images by a text query")
+    q.add_argument("folder")
+    q.add_argument("--query", required=True, action="append", help="repeat to search for several things in one pass")
+    q.add_argument("--live", action="store_true", help="analyze every image instead of using the caption index")
+    q.add_argument("--mode", choices=["precise", "fast"], default="precise", help="analysis mode for --live")
+    q.add_argument("--no-rerank", dest="rerank", action="store_false", default=None, help="skip the LLM re-rank of index results")
+
+    i = sub.add_parser("index", help="build or update the caption index")
+    i.add_argument("folder")
+
+    sub.add_parser("undo", help="move the files of the last sort run back")
+
+    r = sub.add_parser("resume", help="continue the last interrupted sort or live search")
+    r.add_argument("kind", nargs="?", choices=["sort", "search"], default="sort")
+    return ap
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if hasattr(args, "folder") and not os.path.isdir(args.folder.strip('"')):
+        emit("error", message=f"Not a folder: {args.folder}"); return EXIT_USAGE
+    if args.command == "sort":
+        try: load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            emit("error", message=f"Bad rules file: {e}"); return EXIT_USAGE
+
+    # Everything the logic prints goes to stderr so stdout stays valid JSONL.
+    with contextlib.redirect_stdout(sys.stderr):
+        import sorter_logic as logic
+        if args.api_base_url: logic.use_external_engine(args.api_base_url)
+        handler = {"sort": cmd_sort, "search": cmd_search, "index": cmd_index, "undo": cmd_undo, "resume": cmd_resume}[args.command]
+        try:
+            return handler(logic, args)
+        except KeyboardInterrupt:
+            logic.request_stop()
+            emit("error", message="Interrupted.")
+            return EXIT_STOPPED
+        except Exception as e:
+            emit("error", message=str(e))
+            return EXIT_ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(main())
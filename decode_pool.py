@@ -0,0 +1,262 @@
+# --- START OF FILE decode_pool.py ---
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import warnings
+import threading
+import subprocess
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+# Image decode + resize + compress, optionally in worker processes.
+#
+# encode() is the one implementation for images sent to the model: reduced JPEG
+# decoding (draft), only the first frame of animations, a pixel limit checked
+# from the header before any pixel is decoded. gray() (near-duplicate hashes)
+# and thumbnail() (previews) follow the same rules. DecodePool runs them in
+# `processes` worker processes started as plain scripts (`python decode_pool.py
+# --worker`, so they never import the GUI): requests go in as JSON lines on
+# stdin, the result comes back as a length-prefixed header + raw bytes on
+# stdout. Each worker is capped in memory (RLIMIT_AS on POSIX, a job object on
+# Windows) and is killed and replaced when a file takes longer than `timeout`
+# seconds, so a huge or corrupt file costs one worker restart instead of the
+# GUI's memory or a stalled run.
+
+_HEADER = struct.Struct(">I")
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _check_pixels(img: Image.Image, max_pixels: int):
+    w, h = img.size
+    if max_pixels and w * h > max_pixels:
+        raise DecodeError(f"{w}x{h} is over the {max_pixels / 1e6:.0f} MP decode limit")
+
+
+def encode(path: str, max_side: int, fmt: str = "jpeg", quality: int = 90, max_pixels: int = 0) -> Tuple[bytes, Dict]:
+    """
+    Decodes, orients and downsizes an image; returns (compressed bytes, info) where info holds
+    "size" (sent), "original_side" and the "decode_s"/"encode_s" timings.
+    """
+    t0 = time.perf_counter()
+    with Image.open(path) as img:
+        _check_pixels(img, max_pixels)
+        info: Dict = {"original_side": max(img.size)}
+        # Only the current frame is ever loaded: frame 0 of a GIF, APNG, WebP or multi-page TIFF.
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale straight from the DCT data.
+        if img.format == "JPEG": img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert('RGB')
+        if max(img.size) > max_side:
+            # reducing_gap lets PIL box-reduce first and only Lanczos the last step.
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        t1 = time.perf_counter()
+        buf = BytesIO()
+        if fmt == "png": img.save(buf, format="PNG", compress_level=1)
+        elif fmt == "webp": img.save(buf, format="WEBP", quality=quality, method=4)
+        else: img.save(buf, format="JPEG", quality=quality, optimize=False)
+        info["size"] = img.size
+    info["decode_s"] = t1 - t0
+    info["encode_s"] = time.perf_counter() - t1
+    return buf.getvalue(), info
+
+
+def gray(path: str, size: Tuple[int, int], max_pixels: int = 0) -> Tuple[bytes, Dict]:
+    """Grey pixels (one byte each, row by row) of the oriented image resized to size (w, h)."""
+    w, h = size
+    with Image.open(path) as img:
+        _check_pixels(img, max_pixels)
+        if img.format == "JPEG": img.draft("L", (w * 4, h * 4))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img = img.resize((w, h), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return img.tobytes(), {"size": img.size}
+
+
+def thumbnail(path: str, side: int, fmt: str = "webp", quality: int = 80, max_pixels: int = 0) -> Tuple[bytes, Dict]:
+    """A preview no larger than side x side, as WebP (keeping transparency) or JPEG bytes."""
+    with Image.open(path) as img:
+        _check_pixels(img, max_pixels)
+        if img.format == "JPEG": img.draft("RGB", (side * 2, side * 2))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((side, side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        img = img.convert("RGBA" if fmt == "webp" and img.mode in ("RGBA", "LA", "P") else "RGB")
+        buf = BytesIO()
+        img.save(buf, format="WEBP" if fmt == "webp" else "JPEG", quality=quality)
+        return buf.getvalue(), {"size": img.size}
+
+
+def _run(req: Dict, max_pixels: int) -> Tuple[bytes, Dict]:
+    op = req.get("op", "encode")
+    if op == "gray": return gray(req["path"], tuple(req["size"]), max_pixels)
+    if op == "thumbnail": return thumbnail(req["path"], req["side"], req["fmt"], req["quality"], max_pixels)
+    return encode(req["path"], req["max_side"], req["fmt"], req["quality"], max_pixels)
+
+
+# -------------------- WORKER PROCESS --------------------
+
+def _limit_memory(memory_mb: int):
+    if memory_mb <= 0 or os.name == "nt": return  # Windows: the parent puts us in a job object
+    try:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError): pass
+
+
+def _worker_main(memory_mb: int, max_pixels: int):
+    _limit_memory(memory_mb)
+    if max_pixels:
+        # _check_pixels() enforces the limit with a clear message; keep PIL from warning about it.
+        Image.MAX_IMAGE_PIXELS = max_pixels
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+    out = sys.stdout.buffer
+    _write(out, {"ready": True})  # imports are done; per-file timeouts start counting from here
+    for line in sys.stdin:
+        try:
+            req = json.loads(line)
+            data, info = _run(req, max_pixels)
+            header = dict(info, ok=True, n=len(data))
+        except MemoryError:
+            data, header = b"", {"ok": False, "error": "out of memory (worker memory cap)"}
+        except DecodeError as e:
+            data, header = b"", {"ok": False, "error": str(e)}
+        except Exception as e:
+            data, header = b"", {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        _write(out, header, data)
+
+
+def _write(out, header: Dict, data: bytes = b""):
+    raw = json.dumps(header).encode("utf-8")
+    out.write(_HEADER.pack(len(raw)) + raw + data)
+    out.flush()
+
+
+# -------------------- POOL --------------------
+
+class _Worker:
+    def __init__(self, memory_mb: int, max_pixels: int):
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", str(memory_mb), str(max_pixels)]
+        flags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     creationflags=flags)
+        self.job = None
+        if os.name == "nt":
+            import engine_manager
+            # Kill-on-close also takes the workers down with the GUI.
+            self.job = engine_manager.create_kill_on_close_job(memory_mb * 1024 * 1024)
+            if self.job: engine_manager.assign_process_to_job(self.job, self.proc.pid)
+        try: self._header()  # wait for the ready line
+        except Exception:
+            self.close()
+            raise
+
+    def _header(self) -> Dict:
+        return json.loads(self._read(_HEADER.unpack(self._read(_HEADER.size))[0]))
+
+    def _read(self, n: int) -> bytes:
+        buf = self.proc.stdout.read(n)
+        if len(buf) != n: raise EOFError("decode worker exited")
+        return buf
+
+    def call(self, req: Dict) -> Tuple[Dict, bytes]:
+        self.proc.stdin.write((json.dumps(req) + "\n").encode("utf-8"))
+        self.proc.stdin.flush()
+        header = self._header()
+        return header, (self._read(header["n"]) if header.get("ok") else b"")
+
+    def close(self):
+        try: self.proc.kill()
+        except OSError: pass
+        try: self.proc.wait(timeout=5)
+        except Exception: pass
+        for f in (self.proc.stdin, self.proc.stdout):
+            try: f.close()
+            except OSError: pass
+        if self.job:
+            import engine_manager
+            engine_manager.close_job(self.job)
+            self.job = None
+
+
+class DecodePool:
+    def __init__(self, processes: int = 2, memory_mb: int = 2048, max_pixels: int = 0, timeout: float = 30.0):
+        self.processes = max(1, processes)
+        self.memory_mb = memory_mb
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.restarts = 0
+        self._idle: "queue.Queue[Optional[_Worker]]" = queue.Queue()
+        self._all: List[_Worker] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(self.processes): self._idle.put(None)  # started on first use
+
+    def encode(self, path: str, max_side: int, fmt: str, quality: int) -> Tuple[bytes, Dict]:
+        """Same contract as encode(), run in a worker. Raises DecodeError for failures, timeouts and crashes."""
+        return self._call({"op": "encode", "path": path, "max_side": max_side, "fmt": fmt, "quality": quality})
+
+    def gray(self, path: str, size: Tuple[int, int]) -> Tuple[bytes, Dict]:
+        """gray() in a worker."""
+        return self._call({"op": "gray", "path": path, "size": list(size)})
+
+    def thumbnail(self, path: str, side: int, fmt: str, quality: int) -> Tuple[bytes, Dict]:
+        """thumbnail() in a worker."""
+        return self._call({"op": "thumbnail", "path": path, "side": side, "fmt": fmt, "quality": quality})
+
+    def _call(self, req: Dict) -> Tuple[bytes, Dict]:
+        if self._closed: raise DecodeError("decode pool is closed")
+        w = self._idle.get()
+        try:
+            if w is None:
+                try: w = self._spawn()
+                except (OSError, EOFError, ValueError) as e: raise DecodeError(f"decode worker failed to start ({e})") from None
+            killed = threading.Event()
+            def kill(proc=w.proc):
+                killed.set()
+                proc.kill()
+            timer = threading.Timer(self.timeout, kill) if self.timeout > 0 else None
+            if timer: timer.start()
+            try:
+                header, data = w.call(req)
+            except (OSError, EOFError, ValueError) as e:
+                self._retire(w)
+                w = None
+                if killed.is_set(): raise DecodeError(f"decoding took longer than {self.timeout:g}s") from None
+                raise DecodeError(f"decode worker crashed ({e})") from None
+            finally:
+                if timer: timer.cancel()
+            if killed.is_set():  # fired just after the answer arrived
+                self._retire(w)
+                w = None
+            if not header.get("ok"): raise DecodeError(header.get("error", "decode failed"))
+            return data, header
+        finally:
+            self._idle.put(w)
+
+    def _spawn(self) -> _Worker:
+        w = _Worker(self.memory_mb, self.max_pixels)
+        with self._lock: self._all.append(w)
+        return w
+
+    def _retire(self, w: _Worker):
+        with self._lock:
+            if w in self._all: self._all.remove(w)
+            self.restarts += 1
+        w.close()
+
+    def close(self):
+        self._closed = True
+        with self._lock: workers, self._all = self._all, []
+        for w in workers: w.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "--worker":
+        _worker_main(int(sys.argv[2]), int(sys.argv[3]))
@@ -0,0 +1,157 @@
+# --- START OF FILE dedup.py ---
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import decode_pool
+
+try:
+    import numpy as np
+except ImportError:  # numpy ships with Gradio; the CLI may run without it
+    np = None
+
+# Near-duplicate grouping before classification.
+#
+# Every image is reduced to a 64-bit perceptual hash (dHash: horizontal gradient
+# signs of a 9x8 grey thumbnail; pHash: signs of the low 8x8 DCT coefficients of
+# a 32x32 thumbnail, computed for a whole chunk with one matrix product). Images
+# whose hashes are within max_distance bits of an existing group's representative
+# join that group; the representatives live in a BK-tree so the lookup does not
+# scan every group. The grey thumbnails come from a `load` callable so the
+# caller can decode in its worker processes (decode_pool) rather than in-process.
+
+HASH_KINDS = ("dhash", "phash")
+_CHUNK = 256
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _load_gray(path: str, size: Tuple[int, int], load: Callable[[str, Tuple[int, int]], bytes]) -> Optional["np.ndarray"]:
+    try: data = load(path, size)
+    except Exception: return None
+    return np.frombuffer(data, dtype=np.uint8).reshape(size[1], size[0]).astype(np.float32)
+
+
+def _load_in_process(path: str, size: Tuple[int, int]) -> bytes:
+    return decode_pool.gray(path, size)[0]
+
+
+def _pack(bits: "np.ndarray") -> List[int]:
+    """(N, 64) booleans -> N Python ints."""
+    packed = np.packbits(bits.astype(np.uint8), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+
+def _dct_matrix(n: int) -> "np.ndarray":
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+def dhash_batch(pixels: "np.ndarray") -> List[int]:
+    """pixels: (N, 8, 9) grey values."""
+    return _pack((pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(pixels), 64))
+
+
+def phash_batch(pixels: "np.ndarray") -> List[int]:
+    """pixels: (N, 32, 32) grey values."""
+    d = _dct_matrix(32)
+    coeffs = np.einsum("ij,njk,lk->nil", d, pixels, d)[:, :8, :8].reshape(len(pixels), 64)
+    med = np.median(coeffs[:, 1:], axis=1, keepdims=True)  # DC term excluded from the median
+    return _pack(coeffs > med)
+
+
+def compute_hashes(paths: List[str], kind: str = "dhash", workers: int = 4,
+                   progress: Optional[Callable[[int, int], None]] = None,
+                   load: Optional[Callable[[str, Tuple[int, int]], bytes]] = None) -> Dict[str, int]:
+    """
+    {path: 64-bit hash} for every readable image. load(path, (w, h)) returns the grey
+    pixels (decode_pool.gray); by default the images are decoded in this process.
+    """
+    load = load or _load_in_process
+    size = (9, 8) if kind == "dhash" else (32, 32)
+    hasher = dhash_batch if kind == "dhash" else phash_batch
+    out: Dict[str, int] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="phash") as pool:
+        for start in range(0, len(paths), _CHUNK):
+            chunk = paths[start:start + _CHUNK]
+            arrays = list(pool.map(lambda p: _load_gray(p, size, load), chunk))
+            ok = [(p, a) for p, a in zip(chunk, arrays) if a is not None]
+            if ok:
+                for (p, _), h in zip(ok, hasher(np.stack([a for _, a in ok]))): out[p] = h
+            if progress: progress(min(start + _CHUNK, len(paths)), len(paths))
+    return out
+
+
+class BKTree:
+    """Metric tree over 64-bit hashes with Hamming distance."""
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+
+    def add(self, h: int, value):
+        if self.root is None:
+            self.root = [h, value, {}]
+            return
+        node = self.root
+        while True:
+            d = (node[0] ^ h).bit_count()
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                return
+            node = child
+
+    def nearest(self, h: int, max_distance: int):
+        """(distance, value) of the closest entry within max_distance, or None."""
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ h).bit_count()
+            if d <= max_distance and (best is None or d < best[0]): best = (d, node[1])
+            lo, hi = d - max_distance, d + max_distance
+            stack.extend(c for k, c in node[2].items() if lo <= k <= hi)
+        return best
+
+
+def group_near_duplicates(paths: List[str], hashes: Dict[str, int], max_distance: int = 4) -> Dict[str, List[str]]:
+    """
+    {representative: [members]} in input order. The first image of a cluster is its
+    representative; images without a hash are their own group.
+    """
+    tree = BKTree()
+    groups: Dict[str, List[str]] = {}
+    for p in paths:
+        h = hashes.get(p)
+        if h is not None:
+            hit = tree.nearest(h, max_distance)
+            if hit is not None:
+                groups[hit[1]].append(p)
+                continue
+            tree.add(h, p)
+        groups[p] = []
+    return groups
+
+
+def plan(groups: Dict[str, List[str]], spot_check: float = 0.0, seed: int = 0) -> Tuple[List[str], Dict[str, List[str]], Dict[str, str]]:
+    """
+    Splits groups into (items to analyze, {representative: members that copy its result},
+    {spot-checked member: representative}). Spot-checked members are analyzed on their own.
+    """
+    rng = random.Random(seed)
+    items: List[str] = []
+    members: Dict[str, List[str]] = {}
+    spot_of: Dict[str, str] = {}
+    for rep, group in groups.items():
+        items.append(rep)
+        copy = []
+        for m in group:
+            if spot_check > 0 and rng.random() < spot_check:
+                spot_of[m] = rep
+                items.append(m)
+            else: copy.append(m)
+        if copy: members[rep] = copy
+    return items, members, spot_of
@@ -2,114 +2,376 @@
 import os
 import sys
 
-# FIX: Explicitly add the script's directory to sys.path 
+# FIX: Explicitly add the script's directory to sys.path
 # This ensures 'sorter_logic' can be imported when running as a subprocess
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.insert(0, current_dir)
 
+import re
 import time
-import urllib.request
 import json
-import sorter_logic  # Import the shared logic file
+import queue
+import hashlib
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, List, Optional
+
+# Multi-connection model downloads.
+#
+# A file is fetched as fixed-size chunks over `segments` parallel ranged
+# connections into a preallocated "<file>.part". Chunks are handed out in file
+# order, so the finished prefix grows steadily; a hasher thread follows that
+# prefix and feeds it to SHA-256 while the data is still in the page cache, so
+# the checksum is ready when the last byte arrives. Finished and partial chunks
+# are checkpointed to "<file>.part.json": a restarted download only fetches what
+# is missing (the hash prefix is recomputed once from disk). When done, the
+# file is renamed into place next to "<file>.manifest.json" (size, SHA-256, the
+# server's expected hash when it publishes one), which file_state (and through it
+# sorter_logic.model_variant_state / check_model_variant_status) reads to tell
+# complete files from half-finished ones.
+#
+# This module does not import sorter_logic at the top, so sorter_logic can use the
+# manifest helpers; the GUI runs it as a subprocess that speaks JSON lines on stdout.
+
+USER_AGENT = "Python Downloader"
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+MANIFEST_SUFFIX = ".manifest.json"
+READ_SIZE = 1024 * 1024
+RETRIES = 6
+CHECKPOINT_S = 2.0
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+_print_lock = threading.Lock()
 
 def send_message(type_, data):
     """Send JSON formatted message to stdout for the GUI to parse."""
-    print(json.dumps({"type": type_, "data": data}), flush=True)
+    with _print_lock:
+        print(json.dumps({"type": type_, "data": data}), flush=True)
 
-def download_file(filename, url, estimated_size_mb, output_dir):
-    dest_path = os.path.join(output_dir, filename)
-    
-    send_message("log", f"Starting download: {filename}...")
-    
+# -------------------- MANIFESTS --------------------
+
+def manifest_path(path: str) -> str:
+    return path + MANIFEST_SUFFIX
+
+def read_manifest(path: str) -> Optional[Dict]:
     try:
-        # Check for existing file size for resume support
-        downloaded = 0
-        if os.path.exists(dest_path):
-            downloaded = os.path.getsize(dest_path)
-        
-        headers = {'User-Agent': 'Python Downloader'}
-        if downloaded > 0:
-            headers['Range'] = f'bytes={downloaded}-'
-            
-        req = urllib.request.Request(url, headers=headers)
-        
-        try:
-            response = urllib.request.urlopen(req, timeout=30)
-        except urllib.error.HTTPError as e:
-            if e.code == 416: 
-                # Range Not Satisfiable - likely finished
-                send_message("log", f"{filename} appears complete. Skipping.")
-                return True
-            raise e
-
-        total_size = downloaded
-        is_resuming = False
-        
-        if response.status == 206:
-            content_length = int(response.getheader('Content-Length', 0))
-            total_size = downloaded + content_length
-            is_resuming = True
-            send_message("log", f"Resuming {filename} from {downloaded/(1024*1024):.1f}MB...")
-        elif response.status == 200:
-            total_size = int(response.getheader('Content-Length', 0))
-            if downloaded > 0:
-                # Server didn't accept range, restart
-                downloaded = 0 
-                send_message("log", f"Server does not support resume. Restarting {filename}...")
-                with open(dest_path, 'wb') as f: pass # clear file
+        with open(manifest_path(path), "r", encoding="utf-8") as f: m = json.load(f)
+        return m if isinstance(m, dict) and "size" in m and "sha256" in m else None
+    except (OSError, ValueError): return None
+
+def _write_json(path: str, data: Dict):
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(data, f)
+    os.replace(tmp, path)
+
+def file_state(path: str) -> str:
+    """
+    missing, partial (an unfinished download is on disk), unverified (file without manifest,
+    e.g. from an older version, or modified since), corrupt (size or hash disagree) or ok.
+    Cheap: compares size and the recorded hashes, it does not re-read the file (see verify_file).
+    """
+    if not os.path.exists(path):
+        return "partial" if os.path.exists(path + PART_SUFFIX) else "missing"
+    m = read_manifest(path)
+    if m is None: return "unverified"
+    st = os.stat(path)
+    if st.st_size != m["size"]: return "corrupt"
+    if m.get("expected_sha256") and m["sha256"] != m["expected_sha256"]: return "corrupt"
+    if m.get("mtime_ns") and st.st_mtime_ns != m["mtime_ns"]: return "unverified"
+    return "ok"
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""): h.update(block)
+    return h.hexdigest()
+
+def verify_file(path: str) -> bool:
+    """Full check: re-hashes the file and compares with its manifest."""
+    m = read_manifest(path)
+    return m is not None and os.path.getsize(path) == m["size"] and sha256_file(path) == m["sha256"]
+
+def remove_download(path: str) -> List[str]:
+    """Deletes a file with its manifest and any unfinished download; returns the names removed."""
+    removed = []
+    for p in (path, manifest_path(path), path + PART_SUFFIX, path + STATE_SUFFIX):
+        if os.path.exists(p):
+            os.remove(p)
+            removed.append(os.path.basename(p))
+    return removed
+
+# -------------------- HTTP --------------------
+
+def _request(url: str, start: Optional[int] = None, end: Optional[int] = None, timeout: float = 30):
+    headers = {"User-Agent": USER_AGENT}
+    if start is not None: headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs): return None
+
+def _expected_sha256(url: str) -> Optional[str]:
+    """Hugging Face publishes an LFS file's SHA-256 as X-Linked-ETag on the (redirecting) HEAD response."""
+    req = urllib.request.Request(url, method="HEAD", headers={"User-Agent": USER_AGENT})
+    try: headers = urllib.request.build_opener(_NoRedirect).open(req, timeout=30).headers
+    except urllib.error.HTTPError as e: headers = e.headers
+    except (OSError, ValueError): return None
+    tag = (headers.get("X-Linked-ETag") or headers.get("ETag") or "").strip().strip('"').lower()
+    if tag.startswith("w/"): return None
+    return tag if _SHA256_RE.match(tag) else None
+
+def probe(url: str) -> Dict:
+    """{"size", "ranges", "etag", "expected_sha256"} from a one-byte ranged GET."""
+    resp = _request(url, 0, 0)
+    with resp:
+        etag = resp.headers.get("ETag", "")
+        if resp.status == 206:
+            total = (resp.headers.get("Content-Range") or "").rpartition("/")[2]
+            size, ranges = (int(total) if total.isdigit() else None), True
         else:
-            # Fallback if no content-length
-            total_size = estimated_size_mb * 1024 * 1024
-
-        mode = 'ab' if is_resuming else 'wb'
-        
-        with open(dest_path, mode) as f:
-            start_time = time.time()
-            bytes_in_session = 0
-            last_report_time = 0
-            
-            while True:
-                chunk = response.read(65536) # 64kb chunks
-                if not chunk:
-                    break
-                f.write(chunk)
-                
-                chunk_len = len(chunk)
-                downloaded += chunk_len
-                bytes_in_session += chunk_len
-                
-                now = time.time()
-                if now - last_report_time >= 0.2: # Update every 200ms
-                    last_report_time = now
-                    
-                    elapsed = now - start_time
-                    speed = (bytes_in_session / (1024*1024)) / elapsed if elapsed > 0 else 0
-                    percent = (downloaded / total_size) * 100 if total_size > 0 else 0
-                    
-                    send_message("progress", {
-                        "filename": filename,
-                        "percent": percent,
-                        "speed": f"{speed:.1f} MB/s",
-                        "downloaded": f"{downloaded/(1024*1024):.1f} MB",
-                        "total": f"{total_size/(1024*1024):.1f} MB"
-                    })
-
-        send_message("log", f"Successfully downloaded {filename}")
+            length = resp.headers.get("Content-Length")
+            size, ranges = (int(length) if length and length.isdigit() else None), False
+    return {"size": size, "ranges": ranges and size is not None, "etag": etag, "expected_sha256": _expected_sha256(url)}
+
+# -------------------- SEGMENTED DOWNLOAD --------------------
+
+class SegmentedDownload:
+    def __init__(self, url: str, dest: str, segments: int = 8, chunk_mb: int = 32,
+                 progress: Optional[Callable[[Dict], None]] = None, log: Callable[[str], None] = print):
+        self.url = url
+        self.dest = dest
+        self.part = dest + PART_SUFFIX
+        self.state_path = dest + STATE_SUFFIX
+        self.segments = max(1, segments)
+        self.chunk = max(1, chunk_mb) * 1024 * 1024
+        self.progress = progress
+        self.log = log
+        self.name = os.path.basename(dest)
+        self._lock = threading.Lock()
+        self._advanced = threading.Condition(self._lock)
+        self._error: Optional[BaseException] = None
+        self._size = 0
+        self._written: Dict[int, int] = {}
+        self._received = 0   # bytes fetched in this session, for the speed
+        self._full = 0       # leading chunks known to be complete
+
+    # ---- state ----
+
+    def _load_state(self, info: Dict) -> Dict[int, int]:
+        """{chunk index: bytes already written} for a matching earlier attempt, else {}."""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f: st = json.load(f)
+            if st.get("url") == self.url and st.get("size") == info["size"] and st.get("etag") == info["etag"] \
+                    and st.get("chunk") == self.chunk and os.path.getsize(self.part) == info["size"]:
+                return {int(k): v for k, v in st["written"].items()}
+        except (OSError, ValueError, KeyError): pass
+        if os.path.exists(self.dest) and read_manifest(self.dest) is None and os.path.getsize(self.dest) <= info["size"]:
+            # Left by the old single-connection downloader, which wrote the file front to back.
+            have = os.path.getsize(self.dest)
+            os.replace(self.dest, self.part)
+            return {i: min(self.chunk, have - i * self.chunk) for i in range(-(-have // self.chunk))}
+        return {}
+
+    def _save_state(self, info: Dict):
+        with self._lock: written = dict(self._written)
+        _write_json(self.state_path, {"url": self.url, "size": info["size"], "etag": info["etag"],
+                                      "chunk": self.chunk, "written": written})
+
+    def _chunk_len(self, idx: int) -> int:
+        return min(self.chunk, self._size - idx * self.chunk)
+
+    def _prefix(self) -> int:
+        """Bytes from the start of the file that are on disk without gaps (lock held)."""
+        while self._full * self.chunk < self._size and self._written.get(self._full, 0) == self._chunk_len(self._full):
+            self._full += 1
+        if self._full * self.chunk >= self._size: return self._size
+        return self._full * self.chunk + self._written.get(self._full, 0)
+
+    # ---- workers ----
+
+    def _fetch(self, f, idx: int):
+        start = idx * self.chunk + self._written.get(idx, 0)
+        end = idx * self.chunk + self._chunk_len(idx) - 1
+        if start > end: return
+        with _request(self.url, start, end) as resp:
+            if resp.status != 206 or not (resp.headers.get("Content-Range") or "").startswith(f"bytes {start}-"):
+                raise ValueError("server ignored the range request")
+            pos = start
+            while pos <= end:
+                data = resp.read(min(READ_SIZE, end + 1 - pos))
+                if not data: raise ConnectionError("connection closed early")
+                f.seek(pos)
+                view = memoryview(data)
+                while view: view = view[f.write(view):]
+                pos += len(data)
+                with self._lock:
+                    self._written[idx] = pos - idx * self.chunk
+                    self._received += len(data)
+                    self._advanced.notify_all()
+
+    def _worker(self, todo: "queue.Queue[int]"):
+        with open(self.part, "r+b", buffering=0) as f:
+            while self._error is None:
+                try: idx = todo.get_nowait()
+                except queue.Empty: return
+                for attempt in range(RETRIES):
+                    try:
+                        self._fetch(f, idx)
+                        break
+                    except (OSError, ValueError) as e:  # URLError/HTTPError are OSErrors
+                        if attempt == RETRIES - 1 or self._error is not None:
+                            with self._lock:
+                                self._error = self._error or e
+                                self._advanced.notify_all()
+                            return
+                        time.sleep(min(30, 2 ** attempt))
+
+    def _hasher(self, h: "hashlib._Hash"):
+        try: self._hash_prefix(h)
+        except OSError as e:
+            with self._lock:
+                self._error = self._error or e
+                self._advanced.notify_all()
+
+    def _hash_prefix(self, h: "hashlib._Hash"):
+        # Unbuffered: a buffered reader could keep bytes read ahead of the prefix (zeros) across seeks.
+        with open(self.part, "rb", buffering=0) as f:
+            hashed = 0
+            while hashed < self._size:
+                with self._lock:
+                    while self._prefix() <= hashed and self._error is None: self._advanced.wait(1.0)
+                    if self._error is not None: return
+                    available = self._prefix()
+                f.seek(hashed)
+                while hashed < available:
+                    block = f.read(min(READ_SIZE, available - hashed))
+                    if not block: raise OSError("part file is shorter than expected")
+                    h.update(block)
+                    hashed += len(block)
+
+    # ---- main ----
+
+    def run(self) -> Dict:
+        """Downloads (or finishes) the file and returns its manifest. Raises on failure."""
+        info = probe(self.url)
+        if not info["ranges"]: return self._single(info)
+        self._size = info["size"]
+        self._written = self._load_state(info)
+        if not self._written and os.path.exists(self.part): os.remove(self.part)
+        with open(self.part, "ab") as f:
+            if f.tell() != self._size: f.truncate(self._size)  # preallocate
+        n_chunks = -(-self._size // self.chunk)
+        todo: "queue.Queue[int]" = queue.Queue()
+        for i in range(n_chunks):
+            if self._written.get(i, 0) < self._chunk_len(i): todo.put(i)
+        have = sum(self._written.values())
+        if have: self.log(f"Resuming {self.name}: {have / (1024*1024):.1f} of {self._size / (1024*1024):.1f} MB on disk.")
+        h = hashlib.sha256()
+        hasher = threading.Thread(target=self._hasher, args=(h,), daemon=True, name=f"sha256-{self.name}")
+        workers = [threading.Thread(target=self._worker, args=(todo,), daemon=True, name=f"dl-{self.name}-{k}")
+                   for k in range(min(self.segments, todo.qsize()))]
+        for t in workers + [hasher]: t.start()
+        started = last_save = time.time()
+        while any(t.is_alive() for t in workers):
+            time.sleep(0.2)
+            now = time.time()
+            if now - last_save >= CHECKPOINT_S:
+                last_save = now
+                self._save_state(info)
+            self._report(have + self._received, now - started)
+        self._save_state(info)
+        if self._error is None: hasher.join()
+        if self._error is not None: raise self._error
+        self._report(self._size, time.time() - started)
+        return self._finish(info, h.hexdigest())
+
+    def _single(self, info: Dict) -> Dict:
+        """Servers without range support: one stream, hashed as it is written."""
+        self.log(f"{self.name}: server does not support ranged downloads, using one connection.")
+        h = hashlib.sha256()
+        started, last = time.time(), 0.0
+        total = info["size"] or 0
+        with _request(self.url) as resp, open(self.part, "wb") as f:
+            for block in iter(lambda: resp.read(READ_SIZE), b""):
+                f.write(block)
+                h.update(block)
+                self._received += len(block)
+                if time.time() - last >= 0.2:
+                    last = time.time()
+                    self._size = total or self._received
+                    self._report(self._received, last - started)
+        if total and self._received != total: raise ConnectionError(f"got {self._received} of {total} bytes")
+        self._size = self._received
+        return self._finish(info, h.hexdigest())
+
+    def _finish(self, info: Dict, sha: str) -> Dict:
+        size = os.path.getsize(self.part)
+        if size != self._size: raise OSError(f"{self.name}: size {size} does not match {self._size}")
+        expected = info.get("expected_sha256")
+        if expected and sha != expected:
+            for p in (self.part, self.state_path):
+                if os.path.exists(p): os.remove(p)
+            raise ValueError(f"{self.name}: SHA-256 mismatch (got {sha[:12]}..., expected {expected[:12]}...); the download was discarded")
+        os.replace(self.part, self.dest)
+        manifest = {"file": self.name, "url": self.url, "size": size, "sha256": sha, "expected_sha256": expected,
+                    "etag": info["etag"], "mtime_ns": os.stat(self.dest).st_mtime_ns, "completed": time.time()}
+        _write_json(manifest_path(self.dest), manifest)
+        if os.path.exists(self.state_path): os.remove(self.state_path)
+        return manifest
+
+    def _report(self, done: int, elapsed: float):
+        if not self.progress: return
+        total = self._size or 1
+        self.progress({
+            "filename": self.name,
+            "percent": min(100.0, done / total * 100),
+            "speed": f"{self._received / (1024*1024) / elapsed if elapsed > 0 else 0:.1f} MB/s",
+            "downloaded": f"{done/(1024*1024):.1f} MB",
+            "total": f"{total/(1024*1024):.1f} MB"
+        })
+
+def download_file(filename, url, output_dir, segments=8, chunk_mb=32):
+    dest_path = os.path.join(output_dir, filename)
+    if file_state(dest_path) == "ok":
+        send_message("log", f"{filename} is already downloaded and verified. Skipping.")
         return True
 
+    send_message("log", f"Starting download: {filename} ({segments} connections)...")
+    try:
+        dl = SegmentedDownload(url, dest_path, segments, chunk_mb,
+                               progress=lambda p: send_message("progress", p), log=lambda m: send_message("log", m))
+        m = dl.run()
+        check = "verified against the published hash" if m["expected_sha256"] else "no published hash to compare"
+        send_message("log", f"Successfully downloaded {filename} (SHA-256 {m['sha256'][:12]}..., {check})")
+        return True
     except Exception as e:
         send_message("error", f"Failed to download {filename}: {str(e)}")
         return False
 
-def main():
-    if len(sys.argv) < 3:
-        send_message("error", "Usage: downloader.py <output_dir> <variant_key>")
-        return
+def download_all(jobs: List[Dict], output_dir: str, segments: int, chunk_mb: int) -> bool:
+    """Downloads the files concurrently (e.g. the main model and its mmproj); True when all succeeded."""
+    results = [False] * len(jobs)
+    def run(i, job):
+        results[i] = download_file(job["filename"], job["url"], output_dir, segments, chunk_mb)
+    threads = [threading.Thread(target=run, args=(i, j), daemon=True) for i, j in enumerate(jobs)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return all(results)
 
-    output_dir = sys.argv[1]
-    variant_key = sys.argv[2]
+def main():
+    ap = argparse.ArgumentParser(description="Download model files (JSON lines on stdout).")
+    ap.add_argument("output_dir")
+    ap.add_argument("variant_key", nargs="?", help="MODEL_VARIANTS key (low, medium, high)")
+    ap.add_argument("--url", action="append", default=[], help="download this URL instead of a variant (repeatable)")
+    ap.add_argument("--segments", type=int, default=None, help="parallel connections per file")
+    ap.add_argument("--chunk-mb", type=int, default=None)
+    args = ap.parse_args()
 
+    output_dir = args.output_dir
     if not os.path.exists(output_dir):
         try:
             os.makedirs(output_dir)
@@ -117,6 +379,14 @@ def main():
             send_message("error", f"Could not create folder {output_dir}: {e}")
             return
 
+    if args.url:
+        files = [{"filename": os.path.basename(u.split("?")[0]), "url": u} for u in args.url]
+        ok = download_all(files, output_dir, args.segments or 8, args.chunk_mb or 32)
+        send_message("done", "SUCCESS|urls" if ok else "Downloads finished with errors.")
+        return
+
+    import sorter_logic  # Import the shared logic file (variants and [download] settings)
+    variant_key = args.variant_key
     if variant_key not in sorter_logic.MODEL_VARIANTS:
         send_message("error", f"Unknown variant: {variant_key}")
         return
@@ -124,30 +394,14 @@ def main():
     data = sorter_logic.MODEL_VARIANTS[variant_key]
     send_message("log", f"Download started: {data['label']}\nSaving to: {output_dir}")
 
-    # Download Main Model
-    ok_main = download_file(
-        data["main"]["filename"], 
-        data["main"]["url"], 
-        data["main"]["size_mb"], 
-        output_dir
-    )
-
-    if not ok_main:
-        send_message("done", "Download Aborted due to error.")
-        return
-
-    # Download MMProj
-    ok_mm = download_file(
-        data["mmproj"]["filename"], 
-        data["mmproj"]["url"], 
-        data["mmproj"]["size_mb"], 
-        output_dir
-    )
+    # Main model and mmproj in parallel
+    ok = download_all([data["main"], data["mmproj"]], output_dir,
+                      args.segments or sorter_logic.DOWNLOAD_SEGMENTS, args.chunk_mb or sorter_logic.DOWNLOAD_CHUNK_MB)
 
-    if ok_main and ok_mm:
+    if ok:
         send_message("done", f"SUCCESS|{variant_key}")
     else:
         send_message("done", "Downloads finished with errors.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,451 @@
+# --- START OF FILE engine_manager.py ---
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import threading
+import requests
+from typing import List, Optional, Tuple
+
+# -------------------- WINDOWS JOB OBJECT HELPERS --------------------
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+    JobObjectExtendedLimitInformation = 9
+    JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE = 0x2000
+    JOB_OBJECT_LIMIT_PROCESS_MEMORY = 0x0100
+
+    class IO_COUNTERS(ctypes.Structure):
+        _fields_ = [('ReadOperationCount', ctypes.c_ulonglong), ('WriteOperationCount', ctypes.c_ulonglong), ('OtherOperationCount', ctypes.c_ulonglong), ('ReadTransferCount', ctypes.c_ulonglong), ('WriteTransferCount', ctypes.c_ulonglong), ('OtherTransferCount', ctypes.c_ulonglong)]
+
+    class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [('PerProcessUserTimeLimit', wintypes.LARGE_INTEGER), ('PerJobUserTimeLimit', wintypes.LARGE_INTEGER), ('LimitFlags', wintypes.DWORD), ('MinimumWorkingSetSize', ctypes.c_size_t), ('MaximumWorkingSetSize', ctypes.c_size_t), ('ActiveProcessLimit', wintypes.DWORD), ('Affinity', ctypes.c_size_t), ('PriorityClass', wintypes.DWORD), ('SchedulingClass', wintypes.DWORD)]
+
+    class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [('BasicLimitInformation', JOBOBJECT_BASIC_LIMIT_INFORMATION), ('IoInfo', IO_COUNTERS), ('ProcessMemoryLimit', ctypes.c_size_t), ('JobMemoryLimit', ctypes.c_size_t), ('PeakProcessMemoryUsed', ctypes.c_size_t), ('PeakJobMemoryUsed', ctypes.c_size_t)]
+
+    def create_kill_on_close_job(memory_limit: int = 0):
+        """memory_limit: bytes of committed memory per process (0 = unlimited)."""
+        try:
+            hJob = ctypes.windll.kernel32.CreateJobObjectW(None, None)
+            if not hJob: return None
+            info = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+            info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+            if memory_limit > 0:
+                info.BasicLimitInformation.LimitFlags |= JOB_OBJECT_LIMIT_PROCESS_MEMORY
+                info.ProcessMemoryLimit = memory_limit
+            res = ctypes.windll.kernel32.SetInformationJobObject(hJob, JobObjectExtendedLimitInformation, ctypes.byref(info), ctypes.sizeof(JOBOBJECT_EXTENDED_LIMIT_INFORMATION))
+            if not res:
+                ctypes.windll.kernel32.CloseHandle(hJob)
+                return None
+            return hJob
+        except: return None
+
+    def assign_process_to_job(hJob, pid):
+        if not hJob: return False
+        try:
+            PROCESS_SET_QUOTA = 0x0100; PROCESS_TERMINATE = 0x0001
+            hProcess = ctypes.windll.kernel32.OpenProcess(PROCESS_SET_QUOTA | PROCESS_TERMINATE, False, pid)
+            if hProcess:
+                res = ctypes.windll.kernel32.AssignProcessToJobObject(hJob, hProcess)
+                ctypes.windll.kernel32.CloseHandle(hProcess)
+                return bool(res)
+        except: pass
+        return False
+
+    def close_job(hJob):
+        try: ctypes.windll.kernel32.CloseHandle(hJob)
+        except: pass
+
+def process_identity(pid: int) -> Optional[Tuple]:
+    """
+    (creation time, executable) of a running process, or None when it cannot be read.
+    A PID alone is not enough to kill a process found in a state file: after a reboot or
+    a crash the same number may belong to something else entirely.
+    """
+    if not pid: return None
+    if os.name == 'nt':
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000; STILL_ACTIVE = 259
+        k32 = ctypes.windll.kernel32
+        h = k32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not h: return None
+        try:
+            code = wintypes.DWORD()
+            if not k32.GetExitCodeProcess(h, ctypes.byref(code)) or code.value != STILL_ACTIVE: return None
+            created, exited, kernel, user = (wintypes.FILETIME() for _ in range(4))
+            if not k32.GetProcessTimes(h, ctypes.byref(created), ctypes.byref(exited), ctypes.byref(kernel), ctypes.byref(user)):
+                return None
+            buf = ctypes.create_unicode_buffer(32768)
+            size = wintypes.DWORD(len(buf))
+            if not k32.QueryFullProcessImageNameW(h, 0, buf, ctypes.byref(size)): return None
+            return ((created.dwHighDateTime << 32) | created.dwLowDateTime, os.path.normcase(buf.value))
+        except Exception: return None
+        finally: k32.CloseHandle(h)
+    if os.path.isdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f: stat = f.read()
+            started = int(stat[stat.rindex(")") + 2:].split()[19])  # field 22: start time in clock ticks since boot
+            return (started, os.readlink(f"/proc/{pid}/exe"))
+        except (OSError, ValueError, IndexError): return None
+    try:  # macOS / BSD
+        started = subprocess.run(["ps", "-o", "lstart=", "-p", str(pid)], capture_output=True, text=True, timeout=5).stdout.strip()
+        exe = subprocess.run(["ps", "-o", "comm=", "-p", str(pid)], capture_output=True, text=True, timeout=5).stdout.strip()
+        return (started, exe) if started and exe else None
+    except (OSError, subprocess.SubprocessError): return None
+
+def same_process(pid: int, identity) -> bool:
+    """True only when pid is still the process identity was read from (unknown counts as different)."""
+    return bool(identity) and process_identity(pid) == tuple(identity)
+
+HEARTBEAT_S = 5  # how often a GUI touches the heartbeat file of its engine
+
+def kill_pid(pid: int):
+    try: os.kill(pid, signal.SIGTERM)  # TerminateProcess on Windows
+    except OSError: pass
+
+# -------------------- ENGINE --------------------
+
+class KoboldEngine:
+    """
+    One koboldcpp process kept warm between jobs.
+
+    - start_async() loads a model in the background (used to pre-warm at GUI launch).
+    - ensure_ready() blocks until the requested model is served, (re)starting it if needed.
+    - acquire()/release() bracket a job; the idle watchdog only stops an engine nobody holds.
+    - A state file (pid, port, model) lets a relaunched GUI reattach instead of cold-loading.
+      It also records the process's creation time and executable: a PID from the file is only
+      reattached to or killed while those still match.
+      Such an engine outlives the GUI, so a small guard process (watch_orphan) stops it once
+      the GUI's heartbeat file has been stale for idle_timeout seconds.
+    """
+    STOPPED, LOADING, READY, FAILED = "stopped", "loading", "ready", "failed"
+
+    def __init__(self, exe: str, host: str, port: int, state_file: str, idle_timeout: int = 600, reattach: bool = True,
+                 env: Optional[dict] = None):
+        self.exe = exe
+        self.host = host
+        self.port = port
+        self.state_file = state_file
+        self.heartbeat_file = state_file + ".heartbeat"
+        self.idle_timeout = idle_timeout
+        self.reattach = reattach
+        self.env = env  # extra environment for the process (e.g. CUDA_VISIBLE_DEVICES)
+
+        self.state = self.STOPPED
+        self.error = ""
+        self.model_name: Optional[str] = None
+        self.identity: Optional[Tuple] = None  # (model, mmproj, args)
+        self.load_started: Optional[float] = None
+        self.time_to_ready: Optional[float] = None
+        self.reattached = False
+
+        self._proc: Optional[subprocess.Popen] = None
+        self._pid: Optional[int] = None
+        self._pid_identity: Optional[Tuple] = None  # process_identity() of _pid
+        self._job_handle = None
+        self._users = 0
+        self._last_used = time.time()
+        self._cond = threading.Condition(threading.RLock())
+        self._watchdog: Optional[threading.Thread] = None
+        self._guard: Optional[subprocess.Popen] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    # ---- status ----
+
+    def alive(self) -> bool:
+        if self._proc is not None: return self._proc.poll() is None
+        return same_process(self._pid, self._pid_identity)
+
+    def status(self) -> dict:
+        with self._cond:
+            if self.state == self.READY and not self.alive():
+                self.state, self.error = self.FAILED, "koboldcpp exited unexpectedly."
+            return {
+                "state": self.state,
+                "model": os.path.basename(self.identity[0]) if self.identity else None,
+                "error": self.error,
+                "time_to_ready": self.time_to_ready,
+                "loading_for": (time.time() - self.load_started) if self.state == self.LOADING and self.load_started else None,
+                "idle_for": (time.time() - self._last_used) if self.state == self.READY and not self._users else 0,
+                "in_use": self._users,
+                "reattached": self.reattached,
+                "pid": self._proc.pid if self._proc else self._pid,
+            }
+
+    def status_text(self) -> str:
+        st = self.status()
+        if st["state"] == self.LOADING:
+            return f"⏳ Engine loading {st['model']}... ({st['loading_for']:.0f}s)"
+        if st["state"] == self.READY:
+            how = "reattached" if st["reattached"] else f"ready in {st['time_to_ready']:.1f}s"
+            idle = f", idle {st['idle_for']:.0f}s" if st["idle_for"] >= 5 else ""
+            return f"🟢 Engine ready: {st['model']} ({how}{idle})"
+        if st["state"] == self.FAILED:
+            return f"🔴 Engine failed: {st['error']}"
+        return "⚪ Engine stopped"
+
+    # ---- job bracketing ----
+
+    def acquire(self):
+        with self._cond:
+            self._users += 1
+            self._last_used = time.time()
+
+    def release(self):
+        with self._cond:
+            self._users = max(0, self._users - 1)
+            self._last_used = time.time()
+
+    def touch(self):
+        self._last_used = time.time()
+
+    # ---- lifecycle ----
+
+    def start_async(self, model: str, mmproj: str, args: List[str], timeout: int = 90) -> bool:
+        """Starts loading in the background. Returns False if it is already loading/serving that model."""
+        identity = (model, mmproj, tuple(args))
+        with self._cond:
+            if self.identity == identity and self.state in (self.LOADING, self.READY) and (self.state == self.LOADING or self.alive()):
+                return False
+            if self._try_reattach(identity): return False
+            self._stop_locked()
+            self.state, self.error = self.LOADING, ""
+            self.identity = identity
+            self.load_started = time.time()
+            self.time_to_ready = None
+            self.reattached = False
+            try: self._spawn(model, mmproj, args)
+            except Exception as e:
+                self.state, self.error = self.FAILED, f"Could not launch koboldcpp: {e}"
+                self._cond.notify_all()
+                return False
+        threading.Thread(target=self._wait_until_ready, args=(identity, timeout), daemon=True, name="engine-load").start()
+        return True
+
+    def ensure_ready(self, model: str, mmproj: str, args: List[str], timeout: int = 90):
+        identity = (model, mmproj, tuple(args))
+        with self._cond:
+            if self.identity == identity and self.state == self.READY and self.alive():
+                self._last_used = time.time()
+                return
+            if not (self.identity == identity and self.state == self.LOADING):
+                self.start_async(model, mmproj, args, timeout)
+            deadline = time.time() + timeout + 5
+            while self.identity == identity and self.state == self.LOADING and time.time() < deadline:
+                self._cond.wait(0.5)
+            if self.identity != identity:
+                raise RuntimeError("Engine model changed while waiting.")
+            if self.state == self.LOADING:
+                raise RuntimeError("Timeout waiting for koboldcpp.")
+            if self.state != self.READY:
+                raise RuntimeError(self.error or "koboldcpp is not running.")
+            self._last_used = time.time()
+
+    def stop(self):
+        with self._cond:
+            self._stop_locked()
+
+    def _stop_locked(self):
+        if self._proc is not None and self._proc.poll() is None: self._proc.kill()
+        elif self._proc is None and self._pid and same_process(self._pid, self._pid_identity): kill_pid(self._pid)
+        self._proc = None
+        self._pid = None
+        self._pid_identity = None
+        if self._job_handle and os.name == 'nt':
+            ctypes.windll.kernel32.CloseHandle(self._job_handle)
+        self._job_handle = None
+        self.state = self.STOPPED
+        self.identity = None
+        self.model_name = None
+        self.reattached = False
+        self._remove_state_file()
+        try: os.remove(self.heartbeat_file)
+        except OSError: pass
+        if self._guard is not None: self._guard.poll()  # reap it (it exits with the engine)
+        self._cond.notify_all()
+
+    def _spawn(self, model: str, mmproj: str, args: List[str]):
+        cmd = [self.exe, "--model", model, "--mmproj", mmproj, "--host", self.host, "--port", str(self.port)] + list(args)
+        flags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
+        env = dict(os.environ, **self.env) if self.env else None
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=flags, env=env)
+        self._pid = self._proc.pid
+        self._pid_identity = process_identity(self._pid)
+        # A kill-on-close job would take the engine down with the GUI, which defeats reattaching.
+        if os.name == 'nt' and not self.reattach:
+            self._job_handle = create_kill_on_close_job()
+            if self._job_handle: assign_process_to_job(self._job_handle, self._proc.pid)
+        if self.reattach and self.idle_timeout > 0: self._spawn_guard()
+
+    def _spawn_guard(self):
+        """Without a kill-on-close job the engine survives a crashed GUI; the guard unloads it after idle_timeout."""
+        if not self._pid_identity:
+            print("[WARN] Engine guard not started (process identity unreadable); a crashed GUI would leave the engine running.")
+            return
+        self._beat()
+        cmd = [sys.executable, os.path.abspath(__file__), "--watch-orphan", str(self._pid),
+               self.heartbeat_file, self.state_file, str(self.idle_timeout), json.dumps(list(self._pid_identity))]
+        flags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
+        try:
+            self._guard = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                           creationflags=flags, start_new_session=(os.name != "nt"))
+        except OSError as e: print(f"[WARN] Engine guard not started ({e}); a crashed GUI would leave the engine running.")
+
+    def _beat(self):
+        """Tells the guard process the GUI is still there."""
+        try:
+            with open(self.heartbeat_file, "a"): pass
+            os.utime(self.heartbeat_file, None)
+        except OSError: pass
+
+    def _probe(self, timeout: float = 1.0) -> Optional[str]:
+        try:
+            r = requests.get(f"{self.base_url}/v1/models", timeout=timeout)
+            if r.status_code == 200:
+                return r.json().get("data", [{}])[0].get("id", "koboldcpp")
+        except: pass
+        return None
+
+    def _wait_until_ready(self, identity: Tuple, timeout: int):
+        start_t = time.time()
+        while True:
+            self._beat()
+            with self._cond:
+                if self.identity != identity or self.state != self.LOADING: return
+                if self._proc is not None and self._proc.poll() is not None:
+                    self.state, self.error = self.FAILED, "koboldcpp exited immediately."
+                    self._proc = None; self._pid = None
+                    self._cond.notify_all()
+                    return
+            name = self._probe(1.0)
+            with self._cond:
+                if self.identity != identity or self.state != self.LOADING: return
+                if name:
+                    self.model_name = name
+                    self.state = self.READY
+                    self.time_to_ready = time.time() - start_t
+                    self._last_used = time.time()
+                    self._write_state_file()
+                    self._start_watchdog()
+                    self._cond.notify_all()
+                    return
+                if time.time() - start_t > timeout:
+                    self._stop_locked()
+                    self.state, self.error = self.FAILED, "Timeout waiting for koboldcpp."
+                    self._cond.notify_all()
+                    return
+            time.sleep(0.5)
+
+    # ---- reattach ----
+
+    def _write_state_file(self):
+        if not self.reattach or not self.identity: return
+        current = process_identity(self._pid)
+        if current and self._pid_identity and current[0] == self._pid_identity[0]:
+            self._pid_identity = current  # same process; a launcher script may have exec'd into the engine binary
+        data = {"pid": self._proc.pid if self._proc else self._pid, "host": self.host, "port": self.port,
+                "model": self.identity[0], "mmproj": self.identity[1], "args": list(self.identity[2]),
+                "model_name": self.model_name, "started_at": time.time(),
+                "process": list(self._pid_identity) if self._pid_identity else None}
+        tmp = self.state_file + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f: json.dump(data, f)
+            os.replace(tmp, self.state_file)
+        except Exception as e: print(f"[WARN] Could not write engine state: {e}")
+
+    def _remove_state_file(self):
+        try:
+            if os.path.exists(self.state_file): os.remove(self.state_file)
+        except: pass
+
+    def _try_reattach(self, identity: Tuple) -> bool:
+        if not self.reattach or self._proc is not None or not os.path.exists(self.state_file): return False
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f: data = json.load(f)
+        except:
+            self._remove_state_file(); return False
+        pid = int(data.get("pid") or 0)
+        same = (data.get("host") == self.host and data.get("port") == self.port and
+                (data.get("model"), data.get("mmproj"), tuple(data.get("args", []))) == identity)
+        if not same_process(pid, data.get("process")):
+            # Gone, or the PID now belongs to another process (reboot, reuse) or cannot be checked:
+            # forget the file, never kill on a guess.
+            self._remove_state_file(); return False
+        if not same:
+            # A leftover engine with another model would hold the port and VRAM.
+            kill_pid(pid); self._remove_state_file(); time.sleep(1)
+            return False
+        name = self._probe(2.0)
+        if not name:
+            kill_pid(pid); self._remove_state_file(); time.sleep(1)
+            return False
+        self._pid = pid
+        self._pid_identity = tuple(data["process"])
+        self.identity = identity
+        self.model_name = name
+        self.state, self.error = self.READY, ""
+        self.time_to_ready = 0.0
+        self.reattached = True
+        self._last_used = time.time()
+        self._start_watchdog()
+        self._cond.notify_all()
+        return True
+
+    # ---- idle shutdown ----
+
+    def _start_watchdog(self):
+        if self._watchdog is not None and self._watchdog.is_alive(): return
+        self._watchdog = threading.Thread(target=self._watch_idle, daemon=True, name="engine-idle")
+        self._watchdog.start()
+
+    def _watch_idle(self):
+        while True:
+            self._beat()
+            time.sleep(HEARTBEAT_S)
+            with self._cond:
+                if self.state != self.READY: return
+                if self.idle_timeout > 0 and not self._users and time.time() - self._last_used > self.idle_timeout:
+                    print(f"[Engine] Idle for {self.idle_timeout}s, unloading model.")
+                    self._stop_locked()
+                    return
+
+
+# -------------------- ORPHAN GUARD --------------------
+
+def watch_orphan(pid: int, heartbeat_file: str, state_file: str, idle_timeout: float, identity: Tuple):
+    """
+    Runs in its own process next to a reattachable engine. Exits when the engine does
+    (or its PID is reused by another process); stops it when no GUI has touched the
+    heartbeat file for idle_timeout seconds.
+    """
+    started = time.time()
+    idle_timeout = max(idle_timeout, 6 * HEARTBEAT_S)  # never mistake a slow heartbeat for a dead GUI
+    # PID + creation time tell whether the engine still runs; the executable may change once
+    # (a launcher script exec'ing the binary) and is checked against the state file before killing.
+    while (process_identity(pid) or (None,))[0] == identity[0]:
+        time.sleep(min(10.0, idle_timeout / 4))
+        try:
+            with open(state_file, "r", encoding="utf-8") as f: state = json.load(f)
+            if int(state.get("pid") or 0) != pid: return  # another engine took over the state file
+            process = state.get("process")
+            if process and process[0] == identity[0]: identity = tuple(process)  # refreshed once the engine was ready
+        except (OSError, ValueError, AttributeError, TypeError): pass  # not written yet (still loading)
+        try: last = os.path.getmtime(heartbeat_file)
+        except OSError: last = started
+        if time.time() - last > idle_timeout:
+            if same_process(pid, identity): kill_pid(pid)
+            for p in (state_file, heartbeat_file):
+                try: os.remove(p)
+                except OSError: pass
+            return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 7 and sys.argv[1] == "--watch-orphan":
+        watch_orphan(int(sys.argv[2]), sys.argv[3], sys.argv[4], float(sys.argv[5]), tuple(json.loads(sys.argv[6])))
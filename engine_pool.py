@@ -0,0 +1,177 @@
+# --- START OF FILE engine_pool.py ---
+import time
+import threading
+import requests
+from typing import Dict, List, Optional
+
+from engine_manager import KoboldEngine
+
+# Several inference endpoints behind one request path.
+#
+# An endpoint is either a koboldcpp process we spawn (own port, GPU and flags) or
+# an external OpenAI-compatible server. Each request goes to the ready, healthy
+# endpoint with the fewest requests in flight (relative to its slots). An endpoint that
+# fails max_failures requests in a row is ejected for eject_s seconds; the health
+# checker probes /v1/models in the background, ejects endpoints that stop
+# answering and brings ejected ones back as soon as they answer again.
+
+
+class Endpoint:
+    def __init__(self, name: str, url: Optional[str] = None, engine: Optional[KoboldEngine] = None,
+                 slots: int = 1, args: Optional[List[str]] = None):
+        self.name = name
+        self.url = (url or "").rstrip("/")
+        self.engine = engine          # None for external servers
+        self.slots = max(1, slots)
+        self.args = list(args or [])  # extra koboldcpp flags for local endpoints
+        self.model_name: Optional[str] = None
+        self.ready = False            # started/connected and serving the wanted model
+        self.starting = False
+        self.outstanding = 0
+        self.failures = 0             # consecutive
+        self.ejected_until = 0.0
+        self.last_error = ""
+        self.reset_stats()
+
+    @property
+    def local(self) -> bool:
+        return self.engine is not None
+
+    @property
+    def base_url(self) -> str:
+        return self.engine.base_url if self.engine is not None else self.url
+
+    def ejected(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.ejected_until
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "images": 0, "seconds": 0.0, "errors": 0, "ejections": 0}
+
+
+class EnginePool:
+    def __init__(self, endpoints: List[Endpoint], max_failures: int = 3, eject_s: float = 30.0, health_interval: float = 10.0):
+        if not endpoints: raise ValueError("An engine pool needs at least one endpoint.")
+        self.endpoints = endpoints
+        self.max_failures = max(1, max_failures)
+        self.eject_s = eject_s
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._health: Optional[threading.Thread] = None
+        self._started = time.time()
+
+    # ---- balancing ----
+
+    def total_slots(self) -> int:
+        return sum(ep.slots for ep in self.endpoints)
+
+    def healthy(self) -> List[Endpoint]:
+        now = time.time()
+        return [ep for ep in self.endpoints if ep.ready and not ep.ejected(now)]
+
+    def acquire(self, exclude=()) -> Endpoint:
+        """Least outstanding requests (per slot) among healthy endpoints not in exclude."""
+        with self._lock:
+            now = time.time()
+            candidates = [ep for ep in self.endpoints if ep.ready and ep not in exclude and not ep.ejected(now)]
+            if not candidates:
+                errors = "; ".join(f"{ep.name}: {ep.last_error}" for ep in self.endpoints if ep.last_error)
+                raise RuntimeError("No healthy engine endpoint available." + (f" ({errors})" if errors else ""))
+            ep = min(candidates, key=lambda e: (e.outstanding / e.slots, e.stats["requests"]))
+            ep.outstanding += 1
+            return ep
+
+    def release(self, ep: Endpoint, seconds: float, images: int = 1, error: Optional[Exception] = None):
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            ep.stats["requests"] += 1
+            ep.stats["seconds"] += seconds
+            if error is None:
+                ep.failures = 0
+                ep.stats["images"] += images
+                return
+            ep.stats["errors"] += 1
+            ep.failures += 1
+            ep.last_error = str(error)
+            if ep.failures >= self.max_failures: self._eject_locked(ep, str(error))
+
+    def eject(self, ep: Endpoint, reason: str):
+        with self._lock: self._eject_locked(ep, reason)
+
+    def _eject_locked(self, ep: Endpoint, reason: str):
+        if not ep.ejected(): ep.stats["ejections"] += 1
+        ep.ejected_until = time.time() + self.eject_s
+        ep.last_error = reason
+        print(f"[Pool] Ejected {ep.name} for {self.eject_s:.0f}s: {reason}")
+
+    def restore(self, ep: Endpoint):
+        with self._lock:
+            if ep.ejected(): print(f"[Pool] {ep.name} is healthy again.")
+            ep.ejected_until = 0.0
+            ep.failures = 0
+
+    # ---- health checks ----
+
+    def probe(self, ep: Endpoint, timeout: float = 3.0) -> Optional[str]:
+        """Model id served by the endpoint, or None when it does not answer."""
+        if ep.local and not (ep.engine.state == ep.engine.READY and ep.engine.alive()): return None
+        try:
+            r = requests.get(f"{ep.base_url}/v1/models", timeout=timeout)
+            if r.status_code == 200:
+                return (r.json().get("data") or [{}])[0].get("id", "external")
+        except Exception: pass
+        return None
+
+    def start_health_checks(self):
+        if self.health_interval <= 0 or (self._health is not None and self._health.is_alive()): return
+        self._health = threading.Thread(target=self._check_loop, daemon=True, name="engine-health")
+        self._health.start()
+
+    def _check_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for ep in self.endpoints:
+                # Local engines that are stopped (idle unload, model switch) are started on
+                # demand and are not failures; only a loaded engine that stops answering is.
+                if ep.local and ep.engine.state != ep.engine.READY: continue
+                name = self.probe(ep)
+                if name:
+                    if not ep.local: ep.model_name, ep.ready = name, True
+                    if ep.ejected() and ep.ready: self.restore(ep)
+                elif ep.ready and not ep.ejected() and ep.outstanding == 0:
+                    self.eject(ep, "health check failed")
+
+    # ---- reporting ----
+
+    def reset_stats(self):
+        with self._lock:
+            for ep in self.endpoints: ep.reset_stats()
+            self._started = time.time()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {ep.name: dict(ep.stats, url=ep.base_url, local=ep.local, ejected=ep.ejected(), slots=ep.slots)
+                    for ep in self.endpoints}
+
+    def summary_lines(self) -> List[str]:
+        elapsed = max(1e-9, time.time() - self._started)
+        out = []
+        for name, s in self.snapshot().items():
+            line = (f"Endpoint {name}: {s['images']} images in {s['requests']} requests "
+                    f"({s['images'] / elapsed:.2f} images/s")
+            if s["requests"]: line += f", {s['seconds'] / s['requests']:.2f} s/request"
+            line += ")"
+            if s["errors"]: line += f", {s['errors']} errors"
+            if s["ejections"]: line += f", ejected {s['ejections']}x"
+            out.append(line)
+        return out
+
+    def status_text(self) -> str:
+        now = time.time()
+        parts = []
+        for ep in self.endpoints:
+            if ep.ejected(now): icon = "🔴"
+            elif ep.starting: icon = "⏳"
+            elif ep.local: icon = {"ready": "🟢", "loading": "⏳", "failed": "🔴"}.get(ep.engine.state, "⚪")
+            else: icon = "🟢" if ep.ready else "⚪"
+            parts.append(f"{icon} {ep.name}" + (f" ({ep.outstanding} busy)" if ep.outstanding else ""))
+        return "Engine pool: " + " · ".join(parts)
@@ -0,0 +1,294 @@
+# --- START OF FILE gguf_reader.py ---
+import os
+import mmap
+import struct
+import threading
+from typing import Dict, List, Optional
+
+# GGUF header inspection.
+#
+# read_gguf() memory-maps a model file and parses only the header, the
+# metadata and the tensor table (a few MB even for a 30 GB model; the weights
+# are never touched), so a model can be checked in milliseconds before the
+# engine spends a minute loading it. check_pair() uses it to catch what
+# otherwise only shows up as an engine that exits or times out: a file that is
+# not GGUF or is cut short, the projector and the model swapped, a projector
+# without a vision encoder, or a projector made for another model size. It also
+# estimates the memory the pair needs (weights + KV cache).
+
+MAGIC = b"GGUF"
+DEFAULT_ALIGNMENT = 32
+
+# Metadata value types
+_U8, _I8, _U16, _I16, _U32, _I32, _F32, _BOOL, _STR, _ARR, _U64, _I64, _F64 = range(13)
+_SCALAR = {_U8: "<B", _I8: "<b", _U16: "<H", _I16: "<h", _U32: "<I", _I32: "<i", _F32: "<f",
+           _BOOL: "<?", _U64: "<Q", _I64: "<q", _F64: "<d"}
+_SCALAR_SIZE = {t: struct.calcsize(f) for t, f in _SCALAR.items()}
+_ARRAY_KEEP = 4096  # numeric arrays up to this length are kept (per-layer head counts etc.); longer ones are skipped
+
+# ggml tensor types: id -> (name, elements per block, bytes per block)
+GGML_TYPES = {
+    0: ("F32", 1, 4), 1: ("F16", 1, 2), 2: ("Q4_0", 32, 18), 3: ("Q4_1", 32, 20), 6: ("Q5_0", 32, 22),
+    7: ("Q5_1", 32, 24), 8: ("Q8_0", 32, 34), 9: ("Q8_1", 32, 36), 10: ("Q2_K", 256, 84), 11: ("Q3_K", 256, 110),
+    12: ("Q4_K", 256, 144), 13: ("Q5_K", 256, 176), 14: ("Q6_K", 256, 210), 15: ("Q8_K", 256, 292),
+    16: ("IQ2_XXS", 256, 66), 17: ("IQ2_XS", 256, 74), 18: ("IQ3_XXS", 256, 98), 19: ("IQ1_S", 256, 50),
+    20: ("IQ4_NL", 32, 18), 21: ("IQ3_S", 256, 110), 22: ("IQ2_S", 256, 82), 23: ("IQ4_XS", 256, 136),
+    24: ("I8", 1, 1), 25: ("I16", 1, 2), 26: ("I32", 1, 4), 27: ("I64", 1, 8), 28: ("F64", 1, 8),
+    29: ("IQ1_M", 256, 56), 30: ("BF16", 1, 2), 34: ("TQ1_0", 256, 54), 35: ("TQ2_0", 256, 66),
+    39: ("MXFP4", 32, 17),
+}
+
+# general.file_type (llama_ftype) -> the quantization name used in file names
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K", 11: "Q3_K_S",
+    12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K",
+    19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL",
+    26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+    36: "TQ1_0", 37: "TQ2_0", 38: "MXFP4_MOE",
+}
+
+
+class GGUFError(Exception):
+    pass
+
+
+class GGUFInfo:
+    """What the header says about one file."""
+    def __init__(self, path: str, file_size: int, version: int, metadata: Dict):
+        self.path = path
+        self.file_size = file_size
+        self.version = version
+        self.metadata = metadata
+        self.parameters = 0
+        self.tensor_count = 0
+        self.tensor_bytes = 0                  # sum of the tensor sizes the table announces
+        self.data_end = 0                      # where the last tensor should end in the file
+        self.type_bytes: Dict[str, int] = {}   # tensor type name -> bytes
+        self.unknown_types: List[int] = []     # ggml types this reader cannot size (size check is partial)
+
+    @property
+    def architecture(self) -> str:
+        return str(self.metadata.get("general.architecture", "?"))
+
+    @property
+    def name(self) -> str:
+        return str(self.metadata.get("general.name") or os.path.basename(self.path))
+
+    @property
+    def is_projector(self) -> bool:
+        return self.architecture == "clip"
+
+    @property
+    def has_vision(self) -> bool:
+        return bool(self.metadata.get("clip.has_vision_encoder", self.is_projector))
+
+    @property
+    def projector_type(self) -> Optional[str]:
+        return self.metadata.get("clip.vision.projector_type") or self.metadata.get("clip.projector_type")
+
+    @property
+    def projection_dim(self) -> Optional[int]:
+        """Width of the embeddings the projector hands to the language model."""
+        return self.metadata.get("clip.vision.projection_dim")
+
+    def arch_value(self, key: str, default=None):
+        return self.metadata.get(f"{self.architecture}.{key}", default)
+
+    @property
+    def embedding_length(self) -> Optional[int]:
+        return self.arch_value("embedding_length")
+
+    @property
+    def quantization(self) -> str:
+        ft = self.metadata.get("general.file_type")
+        if ft in FILE_TYPES: return FILE_TYPES[ft]
+        # Projectors often carry no file_type: name the type holding most of the bytes.
+        return max(self.type_bytes, key=self.type_bytes.get) if self.type_bytes else "?"
+
+    @property
+    def truncated(self) -> bool:
+        return self.data_end > self.file_size
+
+    def kv_cache_bytes(self, context: int) -> int:
+        """F16 K and V for `context` tokens over all layers (0 when the header lacks the sizes)."""
+        layers = self.arch_value("block_count")
+        heads = self.arch_value("attention.head_count")
+        if not layers or not heads or not self.embedding_length: return 0
+        kv_heads = self.arch_value("attention.head_count_kv", heads)
+        per_layer = lambda v: list(v) if isinstance(v, list) else [v] * layers
+        heads, kv_heads = per_layer(heads), per_layer(kv_heads)
+        total = 0
+        for h, kv in zip(heads, kv_heads):
+            if not h or not kv: continue  # e.g. recurrent layers without attention
+            k_len = self.arch_value("attention.key_length", self.embedding_length // h)
+            v_len = self.arch_value("attention.value_length", self.embedding_length // h)
+            total += kv * (k_len + v_len)
+        return total * context * 2
+
+    def params_label(self) -> str:
+        label = self.metadata.get("general.size_label")
+        if label: return str(label)
+        p = self.parameters
+        return f"{p / 1e9:.1f}B" if p >= 1e9 else f"{p / 1e6:.0f}M"
+
+    def summary(self) -> str:
+        if self.is_projector:
+            return f"{self.name}: vision projector ({self.projector_type or 'unknown type'}, {self.quantization}, {format_bytes(self.tensor_bytes)})"
+        return f"{self.name}: {self.architecture}, {self.params_label()} parameters, {self.quantization}, {format_bytes(self.tensor_bytes)}"
+
+
+def format_bytes(n: int) -> str:
+    return f"{n / 1024**3:.1f} GB" if n >= 1024**3 else f"{n / 1024**2:.0f} MB"
+
+
+# -------------------- PARSER --------------------
+
+class _Reader:
+    def __init__(self, buf, size: int):
+        self.buf = buf
+        self.size = size
+        self.pos = 0
+
+    def scalar(self, t: int):
+        v = struct.unpack_from(_SCALAR[t], self.buf, self.pos)[0]
+        self.pos += _SCALAR_SIZE[t]
+        return v
+
+    def u32(self) -> int: return self.scalar(_U32)
+    def u64(self) -> int: return self.scalar(_U64)
+
+    def string(self) -> str:
+        n = self.u64()
+        if self.pos + n > self.size: raise GGUFError("string runs past the end of the file")
+        s = bytes(self.buf[self.pos:self.pos + n]).decode("utf-8", errors="replace")
+        self.pos += n
+        return s
+
+    def skip_string(self):
+        self.pos += 8 + struct.unpack_from("<Q", self.buf, self.pos)[0]
+
+    def value(self, t: int):
+        if t in _SCALAR: return self.scalar(t)
+        if t == _STR: return self.string()
+        if t != _ARR: raise GGUFError(f"unknown metadata type {t}")
+        et, n = self.u32(), self.u64()
+        if et in _SCALAR:
+            if n <= _ARRAY_KEEP:
+                v = list(struct.unpack_from(f"<{n}{_SCALAR[et][1]}", self.buf, self.pos))
+                self.pos += n * _SCALAR_SIZE[et]
+                return v
+            self.pos += n * _SCALAR_SIZE[et]  # e.g. token scores: not needed
+        elif et == _STR:
+            for _ in range(n): self.skip_string()  # e.g. the vocabulary
+        else:
+            for _ in range(n): self.value(et)
+        if self.pos > self.size: raise GGUFError("metadata runs past the end of the file")
+        return None
+
+
+def _parse(path: str) -> GGUFInfo:
+    size = os.path.getsize(path)
+    if size < 24: raise GGUFError(f"{os.path.basename(path)} is not a GGUF file (only {size} bytes)")
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:4] != MAGIC: raise GGUFError(f"{os.path.basename(path)} is not a GGUF file")
+        r = _Reader(mm, size)
+        r.pos = 4
+        try:
+            version = r.u32()
+            if version < 2: raise GGUFError(f"GGUF version {version} is too old for the engine")
+            n_tensors, n_kv = r.u64(), r.u64()
+            if n_tensors > 1_000_000 or n_kv > 1_000_000: raise GGUFError("header counts are implausible (corrupt file?)")
+            metadata = {}
+            for _ in range(n_kv):
+                key = r.string()
+                v = r.value(r.u32())
+                if v is not None: metadata[key] = v
+            info = GGUFInfo(path, size, version, metadata)
+            info.tensor_count = n_tensors
+            end = 0
+            for _ in range(n_tensors):
+                r.skip_string()
+                dims = [r.u64() for _ in range(r.u32())]
+                t, offset = r.u32(), r.u64()
+                elements = 1
+                for d in dims: elements *= d
+                info.parameters += elements
+                gt = GGML_TYPES.get(t)
+                if gt is None:
+                    if t not in info.unknown_types: info.unknown_types.append(t)
+                    end = max(end, offset)
+                    continue
+                nbytes = elements // gt[1] * gt[2]
+                info.tensor_bytes += nbytes
+                info.type_bytes[gt[0]] = info.type_bytes.get(gt[0], 0) + nbytes
+                end = max(end, offset + nbytes)
+        except struct.error:
+            raise GGUFError(f"{os.path.basename(path)}: header is cut short or corrupt") from None
+        align = metadata.get("general.alignment", DEFAULT_ALIGNMENT) or DEFAULT_ALIGNMENT
+        data_start = -(-r.pos // align) * align
+        info.data_end = data_start + end
+    return info
+
+
+_cache: Dict[tuple, GGUFInfo] = {}
+_lock = threading.Lock()
+
+
+def read_gguf(path: str) -> GGUFInfo:
+    """Parses the header of a GGUF file (cached per path, size and mtime). Raises GGUFError or OSError."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _lock:
+        if key in _cache: return _cache[key]
+    info = _parse(path)
+    with _lock:
+        if len(_cache) >= 32: _cache.clear()
+        _cache[key] = info
+    return info
+
+
+# -------------------- PAIR CHECK --------------------
+
+def check_pair(model_path: str, mmproj_path: str, context: int = 4096) -> Dict:
+    """
+    Validates a model + projector pair from their headers. Returns {"model", "mmproj" (GGUFInfo or None),
+    "errors", "warnings" (lists of messages) and "memory" ({"weights", "mmproj", "kv_cache", "total"} bytes)}.
+    """
+    result = {"model": None, "mmproj": None, "errors": [], "warnings": [], "memory": None}
+    errors, warnings = result["errors"], result["warnings"]
+    for role, path in (("model", model_path), ("mmproj", mmproj_path)):
+        try: result[role] = read_gguf(path)
+        except FileNotFoundError: errors.append(f"{role}: {path} not found")
+        except (GGUFError, OSError, ValueError) as e: errors.append(f"{role}: {e}")
+    model, proj = result["model"], result["mmproj"]
+
+    for info in (model, proj):
+        if info is None: continue
+        base = os.path.basename(info.path)
+        if info.truncated:
+            errors.append(f"{base} is incomplete: {info.file_size:,} of {info.data_end:,} bytes (download it again)")
+        if info.unknown_types:
+            warnings.append(f"{base} uses tensor types this check does not know ({', '.join(map(str, info.unknown_types))}); its size was not fully checked")
+
+    if model and proj:
+        if model.is_projector and not proj.is_projector:
+            errors.append("The model and mmproj files are swapped")
+            return result
+        if model.is_projector:
+            errors.append(f"{os.path.basename(model.path)} is a vision projector, not a language model")
+        if not proj.is_projector:
+            errors.append(f"{os.path.basename(proj.path)} is not a vision projector (architecture '{proj.architecture}')")
+        elif not proj.has_vision:
+            errors.append(f"{os.path.basename(proj.path)} has no vision encoder (audio-only projector?)")
+        elif proj.projection_dim and model.embedding_length and proj.projection_dim != model.embedding_length:
+            errors.append(f"{os.path.basename(proj.path)} belongs to another model: it outputs {proj.projection_dim}-wide "
+                          f"embeddings, {os.path.basename(model.path)} expects {model.embedding_length}")
+        weights, mm_bytes, kv = model.tensor_bytes, proj.tensor_bytes, model.kv_cache_bytes(context)
+        result["memory"] = {"weights": weights, "mmproj": mm_bytes, "kv_cache": kv, "total": weights + mm_bytes + kv}
+    return result
+
+
+def describe_memory(memory: Optional[Dict], context: int) -> str:
+    if not memory: return ""
+    return (f"~{format_bytes(memory['total'])} (weights {format_bytes(memory['weights'])} + mmproj "
+            f"{format_bytes(memory['mmproj'])} + KV cache {format_bytes(memory['kv_cache'])} at {context} tokens, plus compute buffers)")
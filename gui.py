@@ -1,10 +1,12 @@
 # --- START OF FILE gui.py ---
 import sys
 import os
-import base64
+import html
 import json
+import time
 import threading
 import subprocess
+import urllib.parse
 from functools import partial
 
 # FIX: Add the current script's directory to sys.path
@@ -53,19 +55,41 @@ def open_file_dialog(current):
         return path if path else current
     except: return current
 
-def scan_folder_ui(path):
+SCAN_DEBOUNCE = 0.6  # seconds of typing silence before a folder is scanned
+_scan_cancel = [threading.Event()]  # set to stop the scan of the previous (half-typed) path
+_scan_lock = threading.Lock()
+
+def scan_folder_ui(path, cancel=None):
     path = (path or "").strip('"')
     if not path or not os.path.isdir(path):
-        return "Invalid folder.", [], gr.update(interactive=False)
-    
-    imgs = logic.find_images(path)
-    count = len(imgs)
-    gallery = imgs[:24] 
+        yield "Invalid folder.", [], gr.update(interactive=False)
+        return
     
-    stats = f"**{count}** images found."
-    return stats, gallery, gr.update(interactive=(count > 0))
+    # Count and preview stream in while the walk runs; the full list is never built here.
+    # The gallery gets cached thumbnails, not the (possibly huge) originals.
+    for count, preview, done in logic.quick_scan(path, preview=24, cancel=cancel):
+        stats = f"**{count}** images found." if done else f"Scanning... **{count}** images so far"
+        thumbs = logic.thumbnails_for(preview)
+        yield stats, [thumbs.get(p, p) for p in preview], gr.update(interactive=(done and count > 0))
+
+def scan_folder_debounced(path):
+    # Every keystroke fires .change and the calls run concurrently: each one stops
+    # the previous call (in its pause, or inside its walk) and only the call that
+    # is still the latest after the pause goes on to scan.
+    cancel = threading.Event()
+    with _scan_lock:
+        _scan_cancel[0].set()
+        _scan_cancel[0] = cancel
+    if cancel.wait(SCAN_DEBOUNCE):
+        yield gr.skip(), gr.skip(), gr.skip()
+        return
+    for update in scan_folder_ui(path, cancel):
+        if cancel.is_set(): return  # a newer edit took over
+        yield update
+
+SORT_MODES = {"Precise (describe + reason)": "precise", "Fast (ID only)": "fast", "Cascade (small → large)": "cascade"}
 
-def wrapper_run_sort(folder, *args, progress=gr.Progress()):
+def wrapper_run_sort(folder, reclassify, mode_label, dry_run, *args, progress=gr.Progress()):
     n_folders = args[0]
     rule_inputs = args[1:]
     
@@ -85,50 +109,160 @@ def wrapper_run_sort(folder, *args, progress=gr.Progress()):
         yield "Error: No rules defined."
         return
 
-    generator = logic.run_sort_process(folder, rules, progress_callback=progress)
+    mode = SORT_MODES.get(mode_label, "precise")
+    generator = logic.run_sort_process(folder, rules, progress_callback=progress, reclassify=reclassify, mode=mode, dry_run=dry_run)
     for log_update in generator:
         yield log_update
 
-def format_search_results(image_paths):
-    if not image_paths:
-        return "<div style='padding: 20px; text-align: center; color: var(--body-text-color-subdued);'>No matches found yet...</div>"
-    
-    html = "<div style='display: flex; flex-direction: column; gap: 10px;'>"
-    for path in reversed(image_paths):
-        try:
-            with open(path, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode('utf-8')
-            src = f"data:image/jpeg;base64,{b64}"
-            
-            html += f"""
+# Gradio serves files from allowed_paths under this route.
+FILE_ROUTE = "/gradio_api/file="
+
+def file_url(path):
+    return FILE_ROUTE + urllib.parse.quote(os.path.abspath(path).replace("\\", "/"), safe="/:")
+
+class SearchResults:
+    """
+    Result list for one search. Each match is rendered once (thumbnail served by URL,
+    never inlined); an update only formats new matches and returns gr.skip() when
+    nothing changed, so a long live search does not re-send the same list per image.
+    """
+    def __init__(self):
+        self.paths = []
+        self.rows = {}
+
+    def row(self, path):
+        if path not in self.rows:
+            thumb = logic.thumbnails_for([path]).get(path)
+            img = f'<img src="{file_url(thumb)}" loading="lazy" style="width: 80px; height: 80px; object-fit: cover; border-radius: 6px; margin-right: 15px; flex-shrink: 0;" />' if thumb else ""
+            self.rows[path] = f"""
             <div style="display: flex; align-items: center; padding: 12px; border: 1px solid var(--border-color-primary); border-radius: 8px; background: var(--background-fill-secondary);">
-                <img src="{src}" style="width: 80px; height: 80px; object-fit: cover; border-radius: 6px; margin-right: 15px; flex-shrink: 0;" />
-                <span style="font-family: monospace; word-break: break-all; font-size: 0.85rem; color: var(--body-text-color);">{path}</span>
+                {img}
+                <a href="{file_url(path)}" target="_blank" style="font-family: monospace; word-break: break-all; font-size: 0.85rem; color: var(--body-text-color);">{html.escape(path)}</a>
             </div>
             """
-        except Exception:
-            continue
-    html += "</div>"
-    return html
-
-def wrapper_run_search(folder, query, progress=gr.Progress()):
+        return self.rows[path]
+
+    def render(self, image_paths):
+        if self.paths and list(image_paths) == self.paths: return gr.skip()
+        self.paths = list(image_paths)
+        return self.body(self.paths)
+
+    def body(self, image_paths):
+        if not image_paths:
+            return "<div style='padding: 20px; text-align: center; color: var(--body-text-color-subdued);'>No matches found yet...</div>"
+        return "<div style='display: flex; flex-direction: column; gap: 10px;'>" + "".join(self.row(p) for p in reversed(image_paths)) + "</div>"
+
+class MultiSearchResults:
+    """One collapsible result list per query of a multi-query search; re-rendered only when a list grew."""
+    def __init__(self, queries):
+        self.sections = {q: SearchResults() for q in queries}
+        self.counts = None
+
+    def render(self, found):
+        counts = [len(found.get(q, [])) for q in self.sections]
+        if counts == self.counts: return gr.skip()
+        self.counts = counts
+        parts = []
+        for q, section in self.sections.items():
+            paths = found.get(q, [])
+            parts.append(f"""
+            <details open style="margin-bottom: 12px;">
+                <summary style="cursor: pointer; padding: 6px 0; font-weight: 600;">{html.escape(q)} <span style="color: var(--body-text-color-subdued); font-weight: normal;">({len(paths)} matches)</span></summary>
+                {section.body(paths)}
+            </details>
+            """)
+        return "".join(parts)
+
+def match_counts(found):
+    return " · ".join(f"{html.escape(q)}: {len(v)}" for q, v in found.items())
+
+SEARCH_MODES = ["Index (fast)", "Live analysis"]
+
+def wrapper_run_search(folder, query, mode, rerank, progress=gr.Progress()):
     if not folder or not os.path.isdir(folder):
-        yield "Invalid folder"
+        yield "Invalid folder", ""
         return
-    if not query.strip():
-        yield "Please enter a search prompt."
+    queries = logic.split_queries(query)
+    if not queries:
+        yield "Please enter a search prompt.", ""
         return
         
-    generator = logic.run_search_process(folder, query, progress_callback=progress)
+    if len(queries) > 1:
+        # One query per line: every query gets its own result list.
+        results = MultiSearchResults(queries)
+        found = {q: [] for q in queries}
+        if mode == SEARCH_MODES[0]:
+            for n, q in enumerate(queries, 1):
+                for results_list, status in logic.run_indexed_search_process(folder, q, rerank=rerank, progress_callback=progress):
+                    found[q] = results_list
+                    yield results.render(found), f"🗂️ Query {n}/{len(queries)}: {status}"
+            return
+        for found in logic.run_multi_search_process(folder, queries, progress_callback=progress):
+            yield results.render(found), f"🔬 Live analysis of {len(queries)} queries: {match_counts(found)}"
+        return
+
+    results = SearchResults()
+    if mode == SEARCH_MODES[0]:
+        for results_list, status in logic.run_indexed_search_process(folder, queries[0], rerank=rerank, progress_callback=progress):
+            yield results.render(results_list), f"🗂️ {status}"
+        return
+
+    generator = logic.run_search_process(folder, queries[0], progress_callback=progress)
+    shown = -1
     for results_list in generator:
-        yield format_search_results(results_list)
+        if len(results_list) == shown: continue
+        shown = len(results_list)
+        yield results.render(results_list), f"🔬 Live analysis: {len(results_list)} matches so far."
+
+def wrapper_resume_sort(progress=gr.Progress()):
+    for log_update in logic.resume_last_sort(progress_callback=progress):
+        yield log_update
+
+def wrapper_resume_search(progress=gr.Progress()):
+    job = logic.last_job("search")
+    if job is None:
+        yield gr.skip(), "No interrupted live search to resume."
+        return
+    queries = job.state.get("queries") or [job.state.get("query", "")]
+    if len(queries) > 1:
+        results = MultiSearchResults(queries)
+        for found in logic.resume_last_search(progress_callback=progress):
+            yield results.render(found), f"🔬 Resumed {len(queries)} queries: {match_counts(found)}"
+        return
+    results = SearchResults()
+    shown = -1
+    for found in logic.resume_last_search(progress_callback=progress):
+        results_list = found.get(queries[0], [])
+        if len(results_list) == shown: continue
+        shown = len(results_list)
+        yield results.render(results_list), f"🔬 Resumed \"{html.escape(queries[0])}\": {len(results_list)} matches so far."
+
+def wrapper_run_index(folder, progress=gr.Progress()):
+    if not folder or not os.path.isdir(folder):
+        yield "Invalid folder"
+        return
+    for log_update in logic.run_index_process(folder, progress_callback=progress):
+        yield log_update
 
 # --- DOWNLOADER HELPERS ---
 
+MODEL_STATE_LABELS = {
+    "ok": "✅ Downloaded",
+    "unverified": "⚠️ Unverified (Download again to verify)",
+    "partial": "⏸ Partial (Download to resume)",
+    "corrupt": "❌ Corrupt (Delete and re-download)",
+    "missing": "❌ Not Downloaded",
+}
+
 def get_model_status_label(key):
-    if logic.check_model_variant_status(key):
-        return "✅ Downloaded"
-    return "❌ Not Downloaded"
+    state = logic.model_variant_state(key)
+    label = MODEL_STATE_LABELS[state]
+    if state in ("ok", "unverified") and logic.ENGINE_PREFLIGHT:
+        # Header check of the pair: catches truncated or mismatched files a size check would miss.
+        check = logic.model_variant_check(key)
+        if check["errors"]: return f"❌ {check['errors'][0]}"
+        if check["memory"]: label += f" · needs ~{logic.gguf_reader.format_bytes(check['memory']['total'])}"
+    return label
 
 def refresh_all_statuses():
     return (
@@ -164,6 +298,7 @@ def wrapper_run_download(key):
     )
     
     full_log = ""
+    progress = {}  # filename -> its latest progress line (main model and mmproj download together)
     
     while True:
         line = process.stdout.readline()
@@ -177,14 +312,17 @@ def wrapper_run_download(key):
                 
                 if m_type == "log":
                     full_log += f"> {m_data}\n"
-                    yield full_log
+                    yield full_log + "\n".join(progress.values())
                 elif m_type == "progress":
-                    p_line = f"Downloading {m_data['filename']}: {m_data['percent']:.1f}% ({m_data['speed']})"
-                    yield full_log + p_line
+                    progress[m_data['filename']] = (f"Downloading {m_data['filename']}: {m_data['percent']:.1f}% "
+                                                    f"({m_data['downloaded']} of {m_data['total']}, {m_data['speed']})")
+                    yield full_log + "\n".join(progress.values())
                 elif m_type == "error":
                     full_log += f"[ERROR] {m_data}\n"
-                    yield full_log
+                    yield full_log + "\n".join(progress.values())
                 elif m_type == "done":
+                    full_log += "\n".join(progress.values()) + "\n"
+                    progress.clear()
                     if str(m_data).startswith("SUCCESS|"):
                         downloaded_key = m_data.split("|")[1]
                         d_info = logic.MODEL_VARIANTS[downloaded_key]
@@ -205,6 +343,15 @@ def wrapper_run_download(key):
     else:
         yield full_log + f"\nProcess exited with code {process.returncode}"
 
+# --- SETTINGS HELPERS ---
+
+def model_check_ui(m, mm):
+    m, mm = m.strip().strip('"'), mm.strip().strip('"')
+    if not m or not mm: return ""
+    check = logic.model_preflight(m, mm)
+    head = "❌ **These files will not load:**" if check["errors"] else "✅ **Model pair looks good.**"
+    return head + "\n\n" + "\n".join(f"- {line}" for line in logic.preflight_summary(check).splitlines())
+
 # -------------------- BUILD APP --------------------
 
 MAX_CATS = 100
@@ -221,6 +368,10 @@ with gr.Blocks(title="Image Sorter") as app:
     # Header
     gr.Markdown("# 🖼️ Image Sorter")
     gr.Markdown("*Local Vision Model Sorter & Searcher*")
+    engine_status_md = gr.Markdown(logic.get_engine_status_text())
+    engine_timer = gr.Timer(2.0)
+    with gr.Accordion("📊 Run Metrics", open=False):
+        metrics_md = gr.Markdown(logic.get_metrics_markdown())
     
     with gr.Tabs():
         
@@ -303,6 +454,15 @@ with gr.Blocks(title="Image Sorter") as app:
                         with gr.Row():
                             btn_run = gr.Button("▶ RUN SORTING", variant="primary", interactive=False, scale=2)
                             btn_stop = gr.Button("⏹ STOP", variant="stop", scale=1)
+                        sort_mode = gr.Radio(list(SORT_MODES), value=list(SORT_MODES)[0], label="Analysis Mode")
+                        sort_reclassify = gr.Checkbox(
+                            value=False,
+                            label="Re-classify from stored descriptions (text only, images sent only when ambiguous)"
+                        )
+                        with gr.Row():
+                            sort_dry_run = gr.Checkbox(value=False, label="Dry run (preview where images would go, move nothing)", scale=2)
+                            btn_undo = gr.Button("↩ Undo Last Sort", variant="secondary", scale=1)
+                            btn_resume = gr.Button("⏯ Resume Last Job", variant="secondary", scale=1)
                         
                         log_output = gr.Textbox(
                             label="Process Log", 
@@ -328,18 +488,28 @@ with gr.Blocks(title="Image Sorter") as app:
                         gr.Markdown("### 🔎 Search Query")
                         search_query = gr.Textbox(
                             label="Search Prompt", 
-                            placeholder="e.g. 'A photo of a red car'", 
+                            placeholder="e.g. 'A photo of a red car' (one query per line to search for several things in one pass)", 
                             lines=3,
                             show_label=False
                         )
                         
+                        search_mode = gr.Radio(SEARCH_MODES, value=SEARCH_MODES[0], label="Search Mode")
+                        search_rerank = gr.Checkbox(value=logic.INDEX_RERANK, label="LLM re-rank of top index candidates")
+                        
                         with gr.Row():
                             btn_start_search = gr.Button("🔍 Start Search", variant="primary", scale=2)
                             btn_stop_search = gr.Button("⏹ Stop", variant="stop", scale=1)
+                        btn_resume_search = gr.Button("⏯ Resume Interrupted Live Search", variant="secondary")
+
+                    with gr.Group():
+                        gr.Markdown("### 🗂️ Caption Index")
+                        btn_build_index = gr.Button("🗂 Build / Update Index", variant="secondary")
+                        index_log = gr.Textbox(label="Index Log", lines=4, max_lines=4, show_label=False)
 
                 with gr.Column(scale=2):
                     with gr.Group():
                         gr.Markdown("### 📋 Results")
+                        search_status_md = gr.Markdown("")
                         search_results_html = gr.HTML(
                             value="<div style='padding: 20px; text-align: center; color: var(--body-text-color-subdued);'>Search results will appear here...</div>"
                         )
@@ -428,30 +598,41 @@ with gr.Blocks(title="Image Sorter") as app:
                         btn_sel_mm = gr.Button("📂 Browse MMProj", variant="secondary")
                 
                 btn_save = gr.Button("💾 Save & Restart", variant="primary")
-                cfg_status = gr.Markdown("")
+                cfg_status = gr.Markdown(model_check_ui(logic.MODEL_PATH, logic.MMPROJ_PATH))
 
     # -------------------- WIRING --------------------
     
+    def refresh_header():
+        return logic.get_engine_status_text(), logic.get_metrics_markdown()
+
+    engine_timer.tick(refresh_header, None, [engine_status_md, metrics_md])
+
     # Sorter Wiring
     btn_browse.click(open_folder_dialog, folder_path, folder_path)
     scan_inputs = [folder_path]
     scan_outputs = [file_count_md, gallery, btn_run]
     folder_path.submit(scan_folder_ui, scan_inputs, scan_outputs)
     btn_scan.click(scan_folder_ui, scan_inputs, scan_outputs)
-    folder_path.change(scan_folder_ui, scan_inputs, scan_outputs)
+    # No concurrency limit: a newer call must be able to run (and cancel the older one) while a slow scan is going.
+    folder_path.change(scan_folder_debounced, scan_inputs, scan_outputs, trigger_mode="multiple",
+                       concurrency_limit=None, show_progress="hidden")
 
     name_boxes = [x[1] for x in rule_names]
-    sort_inputs = [folder_path, n_folders] + name_boxes + rule_prompts
+    sort_inputs = [folder_path, sort_reclassify, sort_mode, sort_dry_run, n_folders] + name_boxes + rule_prompts
     btn_run.click(wrapper_run_sort, inputs=sort_inputs, outputs=log_output)
+    btn_undo.click(fn=logic.undo_last_sort, inputs=None, outputs=log_output)
+    btn_resume.click(wrapper_resume_sort, inputs=None, outputs=log_output)
     btn_stop.click(fn=logic.request_stop, inputs=None, outputs=None)
 
     # Search Wiring
     btn_browse_search.click(open_folder_dialog, search_folder, search_folder)
     btn_start_search.click(
         wrapper_run_search, 
-        inputs=[search_folder, search_query], 
-        outputs=[search_results_html]
+        inputs=[search_folder, search_query, search_mode, search_rerank], 
+        outputs=[search_results_html, search_status_md]
     )
+    btn_resume_search.click(wrapper_resume_search, inputs=None, outputs=[search_results_html, search_status_md])
+    btn_build_index.click(wrapper_run_index, inputs=[search_folder], outputs=[index_log])
     btn_stop_search.click(fn=logic.request_stop, inputs=None, outputs=None)
 
     # Download Wiring
@@ -474,7 +655,11 @@ with gr.Blocks(title="Image Sorter") as app:
     # Settings Wiring
     btn_sel_m.click(open_file_dialog, m_path, m_path)
     btn_sel_mm.click(open_file_dialog, mm_path, mm_path)
+    for box in (m_path, mm_path):
+        box.change(model_check_ui, [m_path, mm_path], cfg_status, trigger_mode="always_last", show_progress="hidden")
     def save_and_restart(m, mm):
+        if logic.ENGINE_PREFLIGHT and logic.model_preflight(m.strip().strip('"'), mm.strip().strip('"'))["errors"]:
+            return model_check_ui(m, mm) + "\n\nNot saved. (Set `preflight = false` under `[engine]` in config.ini to skip this check.)"
         # Save config
         logic.save_config(m, mm)
         # Restart using subprocess (handles paths with spaces properly on Windows)
@@ -482,8 +667,11 @@ with gr.Blocks(title="Image Sorter") as app:
         subprocess.Popen([sys.executable, script_path], cwd=current_dir)
         # Exit current process
         os._exit(0)
-    btn_save.click(save_and_restart, [m_path, mm_path], None)
+    btn_save.click(save_and_restart, [m_path, mm_path], cfg_status)
 
 if __name__ == "__main__":
+    # Load (or reattach to) the engine while the browser opens.
+    logic.prewarm_engine()
+    logic.start_metrics_endpoint()
     roots = [f"{d}:\\" for d in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" if os.path.exists(f"{d}:")]
-    app.launch(inbrowser=True, allowed_paths=roots, theme=theme)
\ No newline at end of file
+    app.launch(inbrowser=True, allowed_paths=roots + [logic.THUMB_DIR], theme=theme)
\ No newline at end of file
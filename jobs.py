@@ -0,0 +1,100 @@
+# --- START OF FILE jobs.py ---
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+# Checkpoints of long sort and search jobs.
+#
+# A job file holds what is needed to continue after Stop, a crash or a closed
+# GUI: the folder and settings, the outcome of every finished image and, for
+# searches, the matches so far. It is rewritten atomically (temp file +
+# os.replace) at most once per `interval` seconds, so an interruption loses at
+# most that much work and never leaves a half-written file behind.
+
+
+def rules_digest(rules: List[Dict]) -> str:
+    # Folder names count here (unlike the analysis cache): outcomes refer to them.
+    payload = json.dumps([[str(r["id"]), r["folder_name"], r["prompt"]] for r in rules], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=12).hexdigest()
+
+
+class Job:
+    RUNNING, STOPPED, FAILED, COMPLETE = "running", "stopped", "failed", "complete"
+
+    def __init__(self, path: str, state: Dict, interval: float = 10.0):
+        self.path = path
+        self.state = state
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = 0.0
+        self._dirty = False
+
+    @classmethod
+    def start(cls, path: str, kind: str, interval: float = 10.0, **info) -> "Job":
+        now = time.time()
+        job = cls(path, {"kind": kind, "status": cls.RUNNING, "started": now, "updated": now,
+                         "done": {}, "found": [], **info}, interval)
+        job.checkpoint(force=True)
+        return job
+
+    @classmethod
+    def load(cls, path: str, interval: float = 10.0) -> Optional["Job"]:
+        try:
+            with open(path, "r", encoding="utf-8") as f: state = json.load(f)
+        except (OSError, ValueError): return None
+        if not isinstance(state, dict) or "done" not in state: return None
+        job = cls(path, state, interval)
+        # Reopened: whatever it was doing when the file was last written is now interrupted.
+        if state.get("status") == cls.RUNNING: state["status"] = cls.STOPPED
+        return job
+
+    @property
+    def done(self) -> Dict[str, Optional[str]]:
+        return self.state["done"]
+
+    @property
+    def found(self) -> List[str]:
+        return self.state["found"]
+
+    @property
+    def resumable(self) -> bool:
+        return self.state.get("status") != self.COMPLETE
+
+    def matches(self, **info) -> bool:
+        return all(self.state.get(k) == v for k, v in info.items())
+
+    def mark(self, path: str, outcome: Optional[str] = None, found: bool = False):
+        """Records a finished image (outcome: its folder, None for no match) and checkpoints when due."""
+        with self._lock:
+            self.state["done"][path] = outcome
+            if found: self.state["found"].append(path)
+            self._dirty = True
+        self.checkpoint()
+
+    def checkpoint(self, force: bool = False):
+        with self._lock:
+            if not force and (not self._dirty or time.time() - self._last < self.interval): return
+            self.state["updated"] = time.time()
+            data = json.dumps(self.state, ensure_ascii=False)
+            self._last = time.time()
+            self._dirty = False
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[WARN] Job checkpoint failed: {e}")
+
+    def finish(self, status: str):
+        self.state["status"] = status
+        self.checkpoint(force=True)
+
+    def describe(self) -> str:
+        s = self.state
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(s.get("updated", 0)))
+        what = f"\"{s.get('query', '')}\"" if s.get("kind") == "search" else f"{len(s.get('rules', []))} rules"
+        return f"{s.get('kind', 'job')} of {s.get('folder', '?')} ({what}, {s.get('mode', '')}): {len(s['done'])} images done, {s.get('status')} {when}"
@@ -0,0 +1,145 @@
+# --- START OF FILE metrics.py ---
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+# Per-stage timings and counters for sort/search runs.
+#
+# Every observation goes into two scopes: "run" (reset when a job starts; shown
+# in the UI panel and written as a JSON summary) and "total" (process lifetime;
+# exported in Prometheus text format). Latencies keep the last SAMPLE_LIMIT
+# samples per stage for percentiles plus exact count/sum.
+
+SAMPLE_LIMIT = 10000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples: deque = deque(maxlen=SAMPLE_LIMIT)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max: self.max = seconds
+        self.samples.append(seconds)
+
+    def snapshot(self) -> Dict:
+        s = sorted(self.samples)
+        out = {"count": self.count, "sum": round(self.sum, 4), "max": round(self.max, 4)}
+        for q in QUANTILES:
+            out[f"p{int(q * 100)}"] = round(s[min(len(s) - 1, int(q * len(s)))], 4) if s else 0.0
+        return out
+
+
+class _Scope:
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.started = time.time()
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.run = _Scope()
+        self.total = _Scope()
+        self.run_info: Dict = {}
+
+    def begin_run(self, **info):
+        with self._lock:
+            self.run = _Scope()
+            self.run_info = dict(info)
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            for scope in (self.run, self.total):
+                h = scope.stages.get(stage)
+                if h is None: h = scope.stages[stage] = Histogram()
+                h.observe(seconds)
+
+    def incr(self, counter: str, n: float = 1):
+        if not n: return
+        with self._lock:
+            for scope in (self.run, self.total):
+                scope.counters[counter] = scope.counters.get(counter, 0) + n
+
+    @contextmanager
+    def timer(self, stage: str):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(stage, time.perf_counter() - t0)
+
+    def snapshot(self, total: bool = False) -> Dict:
+        with self._lock:
+            scope = self.total if total else self.run
+            return {
+                "info": {} if total else dict(self.run_info),
+                "elapsed_s": round(time.time() - scope.started, 2),
+                "stages": {k: h.snapshot() for k, h in scope.stages.items()},
+                "counters": dict(scope.counters),
+            }
+
+    def summary_markdown(self) -> str:
+        snap = self.snapshot()
+        if not snap["stages"] and not snap["counters"]: return "*No run yet.*"
+        lines = ["| Stage | Count | p50 ms | p95 ms | p99 ms | Total s |", "|---|---:|---:|---:|---:|---:|"]
+        for name, h in sorted(snap["stages"].items(), key=lambda kv: -kv[1]["sum"]):
+            lines.append(f"| {name} | {h['count']} | {h['p50'] * 1000:.1f} | {h['p95'] * 1000:.1f} | "
+                         f"{h['p99'] * 1000:.1f} | {h['sum']:.1f} |")
+        c = snap["counters"]
+        extra = [f"elapsed {snap['elapsed_s']:.0f} s"]
+        if c.get("bytes_sent"): extra.append(f"sent {c['bytes_sent'] / (1024 * 1024):.1f} MB")
+        if c.get("tokens_in") or c.get("tokens_out"): extra.append(f"tokens in/out {int(c.get('tokens_in', 0))}/{int(c.get('tokens_out', 0))}")
+        if c.get("images"): extra.append(f"{int(c['images'])} images ({c['images'] / max(1e-9, snap['elapsed_s']):.2f}/s)")
+        if c.get("errors"): extra.append(f"{int(c['errors'])} errors")
+        return "\n".join(lines) + "\n\n" + ", ".join(extra)
+
+    def write_json(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2, ensure_ascii=False)
+
+    def prometheus_text(self, prefix: str = "image_sorter") -> str:
+        snap = self.snapshot(total=True)
+        out = [f"# TYPE {prefix}_stage_seconds summary"]
+        for name, h in sorted(snap["stages"].items()):
+            for q in QUANTILES:
+                out.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{q}"}} {h[f"p{int(q * 100)}"]}')
+            out.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {h["sum"]}')
+            out.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {h["count"]}')
+        for name, value in sorted(snap["counters"].items()):
+            out.append(f"# TYPE {prefix}_{name}_total counter")
+            out.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(out) + "\n"
+
+
+def serve_prometheus(m: Metrics, port: int, host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    """Serves GET /metrics in Prometheus text format on a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404); return
+            data = m.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args): pass
+
+    try:
+        srv = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        print(f"[WARN] Metrics endpoint unavailable on port {port}: {e}")
+        return None
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True, name="metrics-http").start()
+    return srv
@@ -0,0 +1,157 @@
+# --- START OF FILE mover.py ---
+import os
+import json
+import time
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# Moves sorted images into their destination folders.
+#
+# Each destination is listed once; after that, free names ("image.png",
+# "image_1.png", ...) come from an in-memory index with a per-name counter, so
+# a thousand "image.png" files cost a thousand set lookups rather than a
+# quadratic os.path.exists loop. Same-device moves are a single os.rename;
+# cross-device moves copy to a temporary name, rename it into place and only
+# then delete the source. Every move is appended to a JSONL journal so a whole
+# run can be previewed (dry run) or undone.
+
+_norm = os.path.normcase
+
+
+class MovePlanner:
+    def __init__(self, journal_path: Optional[str] = None, dry_run: bool = False, info: Optional[Dict] = None):
+        self.dry_run = dry_run
+        self.journal_path = journal_path
+        self.counts = {"rename": 0, "copy": 0, "plan": 0}
+        self._names: Dict[str, set] = {}               # dest dir -> normcased names in it
+        self._next: Dict[Tuple[str, str, str], int] = {}  # (dir, stem, ext) -> next suffix to try
+        self._devices: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._journal = None
+        if journal_path:
+            os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+            self._journal = open(journal_path, "a", encoding="utf-8")
+            self._write({"op": "run", "dry_run": dry_run, "time": time.time(), **(info or {})})
+
+    def _write(self, entry: Dict):
+        if self._journal is None: return
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+
+    def _index(self, dst_dir: str) -> set:
+        names = self._names.get(dst_dir)
+        if names is None:
+            if os.path.isdir(dst_dir):
+                names = {_norm(n) for n in os.listdir(dst_dir)}
+            else:
+                names = set()
+                if not self.dry_run:
+                    os.makedirs(dst_dir, exist_ok=True)
+                    self._write({"op": "mkdir", "path": dst_dir})
+            self._names[dst_dir] = names
+        return names
+
+    def _reserve(self, dst_dir: str, base: str) -> str:
+        names = self._index(dst_dir)
+        if _norm(base) not in names:
+            names.add(_norm(base))
+            return os.path.join(dst_dir, base)
+        name, ext = os.path.splitext(base)
+        key = (dst_dir, _norm(name), _norm(ext))
+        c = self._next.get(key, 1)
+        while _norm(f"{name}_{c}{ext}") in names: c += 1
+        self._next[key] = c + 1
+        names.add(_norm(f"{name}_{c}{ext}"))
+        return os.path.join(dst_dir, f"{name}_{c}{ext}")
+
+    def _same_device(self, src: str, dst_dir: str) -> bool:
+        dev = self._devices.get(dst_dir)
+        if dev is None: dev = self._devices[dst_dir] = os.stat(dst_dir).st_dev
+        return os.stat(src).st_dev == dev
+
+    def move(self, src: str, dst_dir: str) -> str:
+        """Moves src into dst_dir under a free name and returns the new path (the planned path in a dry run)."""
+        dst_dir = os.path.abspath(dst_dir)
+        with self._lock:
+            dest = self._reserve(dst_dir, os.path.basename(src))
+            if self.dry_run:
+                self.counts["plan"] += 1
+                self._write({"op": "plan", "src": src, "dest": dest})
+                return dest
+            if os.path.lexists(dest):
+                # Created behind our back since the folder was listed: re-list once.
+                self._names.pop(dst_dir, None)
+                dest = self._reserve(dst_dir, os.path.basename(src))
+            if self._same_device(src, dst_dir):
+                os.rename(src, dest)
+                op = "rename"
+            else:
+                tmp = dest + ".part"
+                shutil.copy2(src, tmp)
+                os.replace(tmp, dest)
+                os.remove(src)
+                op = "copy"
+            self.counts[op] += 1
+            self._write({"op": op, "src": src, "dest": dest})
+            return dest
+
+    def summary_line(self) -> str:
+        c = self.counts
+        if self.dry_run: return f"Dry run: nothing was moved, {c['plan']} moves planned"
+        line = f"Moves: {c['rename']} renamed"
+        if c["copy"]: line += f", {c['copy']} copied across devices"
+        return line
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                try: self._journal.close()
+                except OSError: pass
+                self._journal = None
+
+
+def read_journal(path: str) -> List[Dict]:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try: entries.append(json.loads(line))
+            except ValueError: pass  # torn last line after a crash
+    return entries
+
+
+def journal_state(entries: List[Dict]) -> str:
+    """One of dry_run, undone, empty (nothing was moved) or undoable."""
+    if entries and entries[0].get("dry_run"): return "dry_run"
+    if any(e.get("op") == "undo" for e in entries): return "undone"
+    if not any(e.get("op") in ("rename", "copy") for e in entries): return "empty"
+    return "undoable"
+
+
+def undo(path: str) -> Tuple[int, List[str]]:
+    """
+    Moves every file of a journaled run back (newest first) and removes the folders it
+    created when they are empty again. Returns (restored, problems).
+    """
+    entries = read_journal(path)
+    restored, problems = 0, []
+    for e in reversed(entries):
+        op = e.get("op")
+        if op in ("rename", "copy"):
+            src, dest = e["src"], e["dest"]
+            if not os.path.exists(dest):
+                problems.append(f"missing: {dest}"); continue
+            if os.path.lexists(src):
+                problems.append(f"original path taken: {src}"); continue
+            try:
+                os.makedirs(os.path.dirname(src), exist_ok=True)
+                shutil.move(dest, src)
+                restored += 1
+            except OSError as ex:
+                problems.append(f"{dest}: {ex}")
+        elif op == "mkdir":
+            try: os.rmdir(e["path"])
+            except OSError: pass  # not empty (other files) or already gone
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "undo", "time": time.time(), "restored": restored, "problems": len(problems)}) + "\n")
+    return restored, problems
@@ -0,0 +1,161 @@
+# --- START OF FILE pipeline.py ---
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+# Producer/consumer pipeline used by the sort and search workflows.
+#
+#   feeder -> [prepare x workers] -> [infer x inflight] -> [finish x 1] -> generator
+#
+# prepare() runs CPU/disk work (cache lookup, decode, encode) and returns either
+# ("done", result) to bypass the engine or ("infer", payload) to queue a request.
+# infer() runs the blocking engine call, finish() runs the side effects (moving
+# files) on a single thread so destination bookkeeping needs no locking.
+# Outcomes are yielded in completion order as (item, outcome) tuples.
+#
+# With batch_size > 1 and an infer_batch() callable, each inference thread drains
+# up to batch_size ready items at once and gets back one result per item.
+
+_SENTINEL = object()
+_POLL = 0.2
+_BATCH_WAIT = 0.05  # how long a partial batch waits for stragglers
+
+
+class _Countdown:
+    def __init__(self, n: int):
+        self._n = n
+        self._lock = threading.Lock()
+
+    def done(self) -> bool:
+        """Returns True for the last caller."""
+        with self._lock:
+            self._n -= 1
+            return self._n == 0
+
+
+def run_pipeline(items: Iterable[Any],
+                 prepare: Callable[[Any], Tuple[str, Any]],
+                 infer: Callable[[Any, Any], Any],
+                 finish: Optional[Callable[[Any, Any], Any]] = None,
+                 workers: int = 2,
+                 inflight: int = 1,
+                 depth: int = 8,
+                 stop_event: Optional[threading.Event] = None,
+                 batch_size: int = 1,
+                 infer_batch: Optional[Callable[[List[Any], List[Any]], List[Any]]] = None) -> Iterator[Tuple[Any, Any]]:
+    workers = max(1, int(workers))
+    batch_size = max(1, int(batch_size)) if infer_batch else 1
+    inflight = max(1, int(inflight))
+    depth = max(1, int(depth))
+    abort = threading.Event()
+
+    def stopped() -> bool:
+        return abort.is_set() or (stop_event is not None and stop_event.is_set())
+
+    def put(q: queue.Queue, x):
+        while not abort.is_set():
+            try:
+                q.put(x, timeout=_POLL)
+                return
+            except queue.Full: continue
+
+    def get(q: queue.Queue):
+        while not abort.is_set():
+            try: return q.get(timeout=_POLL)
+            except queue.Empty: continue
+        return _SENTINEL
+
+    in_q: queue.Queue = queue.Queue(maxsize=depth)
+    ready_q: queue.Queue = queue.Queue(maxsize=depth)
+    done_q: queue.Queue = queue.Queue(maxsize=depth)
+    out_q: queue.Queue = queue.Queue()
+    prep_left = _Countdown(workers)
+    infer_left = _Countdown(inflight)
+
+    def feeder():
+        try:
+            for item in items:
+                if stopped(): break
+                put(in_q, item)
+        finally:
+            for _ in range(workers): put(in_q, _SENTINEL)
+
+    def preparer():
+        try:
+            while True:
+                item = get(in_q)
+                if item is _SENTINEL: break
+                if stopped(): continue
+                try: kind, value = prepare(item)
+                except Exception as e:
+                    print(f"[Pipeline] prepare failed for {item}: {e}")
+                    kind, value = "done", None
+                if kind == "skip": continue
+                if kind == "infer": put(ready_q, (item, value))
+                else: put(done_q, (item, value))
+        finally:
+            if prep_left.done():
+                for _ in range(inflight): put(ready_q, _SENTINEL)
+
+    def gather() -> Tuple[List[Tuple[Any, Any]], bool]:
+        """Blocks for one ready entry, then takes up to batch_size - 1 more. Returns (batch, finished)."""
+        first = get(ready_q)
+        if first is _SENTINEL: return [], True
+        batch = [first]
+        while len(batch) < batch_size:
+            try: entry = ready_q.get(timeout=_BATCH_WAIT)
+            except queue.Empty: break
+            if entry is _SENTINEL: return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def inferer():
+        try:
+            finished = False
+            while not finished:
+                batch, finished = gather()
+                if not batch or stopped(): continue
+                items = [item for item, _ in batch]
+                try:
+                    if len(batch) == 1: results = [infer(*batch[0])]
+                    else: results = infer_batch(items, [payload for _, payload in batch])
+                except Exception as e:
+                    print(f"[Pipeline] inference failed for {items}: {e}")
+                    results = [None] * len(batch)
+                for item, result in zip(items, results): put(done_q, (item, result))
+        finally:
+            if infer_left.done(): put(done_q, _SENTINEL)
+
+    def finisher():
+        try:
+            while True:
+                entry = get(done_q)
+                if entry is _SENTINEL: break
+                item, result = entry
+                if abort.is_set(): continue
+                try: outcome = finish(item, result) if finish else result
+                except Exception as e:
+                    print(f"[Pipeline] finish failed for {item}: {e}")
+                    outcome = None
+                out_q.put((item, outcome))
+        finally:
+            out_q.put(_SENTINEL)
+
+    threads = [threading.Thread(target=feeder, daemon=True, name="pipeline-feed")]
+    threads += [threading.Thread(target=preparer, daemon=True, name=f"pipeline-prep-{i}") for i in range(workers)]
+    threads += [threading.Thread(target=inferer, daemon=True, name=f"pipeline-infer-{i}") for i in range(inflight)]
+    threads += [threading.Thread(target=finisher, daemon=True, name="pipeline-finish")]
+    for t in threads: t.start()
+
+    try:
+        while True:
+            entry = out_q.get()
+            if entry is _SENTINEL: break
+            yield entry
+    finally:
+        # Consumer went away (generator closed) or finished: release every stage.
+        abort.set()
+        for q in (in_q, ready_q, done_q):
+            try:
+                while True: q.get_nowait()
+            except queue.Empty: pass
@@ -0,0 +1,134 @@
+# --- START OF FILE prompts.py ---
+import json
+import threading
+from typing import Dict, List, Optional
+
+# Prompt templates for image classification.
+#
+# Every request of a run starts with the same bytes: the shared system prompt,
+# then the category list, then the mode's instructions and response format.
+# Only what follows (the batch size line, image labels, the images) changes
+# between requests, so the engine can keep the KV cache of that prefix and only
+# prefill the rest. The category block (the largest part with many rules) comes
+# before anything mode specific, so precise, batched and fast requests for the
+# same rules share it as well.
+
+SYSTEM_PROMPT = "You are a precise visual data sorter. Your job is to analyze images and match each one to a specific category."
+
+PRECISE_INSTRUCTIONS = """
+<instructions>
+1. First, describe the main subject of the image in detail.
+   - If it is a character, describe their hair color, clothes, and distinctive features (tattoos, weapons, etc).
+2. Then, compare your description to the list of Target Categories above.
+3. If a prompt is a specific name (e.g. "Jinx", "Goku"), use your knowledge to identify if the character matches that name.
+4. Select the best matching ID. If the image does not fit any category confidently, select 'none'.
+5. Set "confidence" to "low" if you are unsure about the choice, otherwise "high".
+</instructions>
+
+Response Format (JSON Only):
+{
+    "description": "Brief description of what you see...",
+    "reasoning": "Why it matches or does not match...",
+    "selected_id": "ID_OR_NONE",
+    "confidence": "high"
+}
+"""
+
+BATCH_INSTRUCTIONS = """
+<instructions>
+You will receive several images, each preceded by its label ("Image 1", "Image 2", ...).
+For EACH image, independently:
+1. Briefly describe the main subject (for characters: hair color, clothes, distinctive features).
+2. Compare your description to the list of Target Categories above.
+3. If a prompt is a specific name (e.g. "Jinx", "Goku"), use your knowledge to identify if the character matches that name.
+4. Select the best matching ID. If the image does not fit any category confidently, select 'none'.
+5. Set "confidence" to "low" if you are unsure about the choice, otherwise "high".
+</instructions>
+
+Response Format (JSON array only, one entry per image in image order):
+[
+    {"image": 1, "description": "Brief description...", "selected_id": "ID_OR_NONE", "confidence": "high"}
+]
+"""
+
+FAST_INSTRUCTIONS = """
+<instructions>
+Match the image to the best Target Category above and answer with its ID only. If a prompt is a specific
+name (e.g. "Jinx", "Goku"), use your knowledge to identify the character. If nothing fits confidently, answer 'none'.
+</instructions>
+
+Response Format (JSON Only): {"selected_id": "ID_OR_NONE"}
+"""
+
+MULTI_INSTRUCTIONS = """
+<instructions>
+1. First, briefly describe the main subject of the image (for characters: hair color, clothes, distinctive features).
+2. Then decide for EACH Target Category above, independently, whether the image matches it.
+   An image can match several categories, or none.
+3. If a prompt is a specific name (e.g. "Jinx", "Goku"), use your knowledge to identify if the character matches that name.
+4. List the IDs of all matching categories in "selected_ids" (an empty list when nothing matches).
+</instructions>
+
+Response Format (JSON Only):
+{
+    "description": "Brief description of what you see...",
+    "selected_ids": ["ID", "ID"]
+}
+"""
+
+INSTRUCTIONS = {"precise": PRECISE_INSTRUCTIONS, "batch": BATCH_INSTRUCTIONS, "fast": FAST_INSTRUCTIONS,
+                "multi": MULTI_INSTRUCTIONS}
+
+
+class PromptTemplate:
+    """The static prefix for one set of categories, built once and reused for every request."""
+    def __init__(self, categories: List[Dict]):
+        lines = "\n".join(f"- ID '{c['id']}': {c['prompt']}" for c in categories)
+        self.categories_block = f"<target_categories>\n{lines}\n</target_categories>\n"
+        self.static = {kind: self.categories_block + text for kind, text in INSTRUCTIONS.items()}
+
+    def messages(self, kind: str, image_urls: List[str]) -> List[Dict]:
+        """Chat messages: static prefix first, then the per-request part (batch size, labels, images)."""
+        content = [{"type": "text", "text": self.static[kind]}]
+        if kind == "batch":
+            n = len(image_urls)
+            content.append({"type": "text", "text": f"There are {n} images. Answer with exactly {n} entries."})
+            for k, url in enumerate(image_urls, 1):
+                content.append({"type": "text", "text": f"Image {k}:"})
+                content.append({"type": "image_url", "image_url": {"url": url}})
+        else:
+            content.extend({"type": "image_url", "image_url": {"url": url}} for url in image_urls)
+        return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": content}]
+
+
+_templates: Dict[str, PromptTemplate] = {}
+_lock = threading.Lock()
+
+
+def compile_template(categories: List[Dict]) -> PromptTemplate:
+    """Shared template for these categories, so all requests of a run use the very same prefix string."""
+    key = json.dumps([[str(c["id"]), c["prompt"]] for c in categories], ensure_ascii=False)
+    with _lock:
+        t = _templates.get(key)
+        if t is None:
+            if len(_templates) >= 16: _templates.clear()
+            t = _templates[key] = PromptTemplate(categories)
+        return t
+
+
+def prompt_timing(data: Dict) -> Optional[Dict]:
+    """
+    Prefill figures from a chat completion, when the server reports them:
+    llama.cpp-style "timings" (prompt_ms, prompt_n, cache_n) or OpenAI-style
+    usage.prompt_tokens_details.cached_tokens. Returns {"seconds", "tokens", "cached"} where
+    tokens is the whole prompt, cached the part reused from the KV cache (values may be None).
+    """
+    t = data.get("timings") or {}
+    usage = data.get("usage") or {}
+    cached = t.get("cache_n")
+    if cached is None: cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    seconds = t["prompt_ms"] / 1000.0 if isinstance(t.get("prompt_ms"), (int, float)) else None
+    if seconds is None and cached is None: return None
+    tokens = usage.get("prompt_tokens")
+    if tokens is None and t.get("prompt_n") is not None: tokens = t["prompt_n"] + (cached or 0)  # prompt_n excludes the cache
+    return {"seconds": seconds, "tokens": tokens, "cached": cached}
@@ -0,0 +1,94 @@
+# --- START OF FILE run_log.py ---
+import os
+import time
+import threading
+from collections import deque
+from typing import List, Optional
+
+# Bounded log for long runs.
+#
+# The UI only ever receives the last `tail` lines (plus the header lines given
+# at creation), so each update costs the same on image 10 and on image 100k.
+# Every line also goes to an append-only file that is flushed periodically;
+# due() throttles UI updates to one per `interval` seconds. Footer lines (the
+# run summary) are always shown in full.
+
+
+class RunLog:
+    def __init__(self, header: List[str], path: Optional[str] = None, tail: int = 500,
+                 interval: float = 0.5, flush_every: float = 2.0):
+        self.header = list(header)
+        self.lines: deque = deque(maxlen=max(1, tail))
+        self.footer: List[str] = []
+        self.total = 0
+        self.path = path
+        self.interval = interval
+        self.flush_every = flush_every
+        self._last_ui = 0.0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._file = open(path, "a", encoding="utf-8", buffering=64 * 1024)
+                for line in self.header: self._file.write(line + "\n")
+            except OSError as e:
+                print(f"[WARN] Log file unavailable: {e}")
+                self._file, self.path = None, None
+
+    def add(self, line: str):
+        with self._lock:
+            self.lines.append(line)
+            self.total += 1
+            if self._file is not None:
+                self._file.write(line + "\n")
+                if time.time() - self._last_flush >= self.flush_every:
+                    self._file.flush()
+                    self._last_flush = time.time()
+
+    def extend(self, lines: List[str]):
+        for line in lines: self.add(line)
+
+    def set_footer(self, lines: List[str]):
+        """Lines shown after the tail no matter how long the run was (and written to the file)."""
+        with self._lock:
+            self.footer = list(lines)
+            if self._file is not None:
+                for line in self.footer: self._file.write(line + "\n")
+                self._file.flush()
+
+    def due(self) -> bool:
+        """True at most once per interval; call before yielding a UI update."""
+        now = time.time()
+        if now - self._last_ui < self.interval: return False
+        self._last_ui = now
+        return True
+
+    def text(self, status: Optional[List[str]] = None) -> str:
+        """The UI view; status lines are appended for this update only (not logged)."""
+        with self._lock:
+            out = list(self.header)
+            hidden = self.total - len(self.lines)
+            if hidden > 0:
+                out.append(f"... {hidden} earlier lines" + (f" in {self.path}" if self.path else "") + " ...")
+            out.extend(self.lines)
+            out.extend(self.footer)
+        if status: out.extend(status)
+        return "\n".join(out)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                try: self._file.close()
+                except OSError: pass
+                self._file = None
+
+
+def prune_dir(folder: str, keep: int, suffix: str):
+    """Deletes all but the newest `keep` files ending in suffix (names sort by timestamp)."""
+    try: names = sorted(f for f in os.listdir(folder) if f.endswith(suffix))
+    except OSError: return
+    for f in names[:-keep] if keep > 0 else names:
+        try: os.remove(os.path.join(folder, f))
+        except OSError: pass
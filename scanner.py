@@ -0,0 +1,155 @@
+# --- START OF FILE scanner.py ---
+import os
+import json
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+# Streaming image finder built on os.scandir.
+#
+# Paths are yielded as soon as their directory is listed, optionally with several
+# directories listed in parallel (helps a lot on SMB/NFS shares where every
+# listing is a round trip). A snapshot of each directory (mtime + image names +
+# subdirectory names) lets a rescan skip listing directories that did not change.
+
+_SENTINEL = object()
+
+
+class DirSnapshots:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, int, str, str]] = []
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                files TEXT NOT NULL,
+                subdirs TEXT NOT NULL
+            )""")
+        self._db.commit()
+
+    def get(self, path: str, mtime_ns: int) -> Optional[Tuple[List[str], List[str]]]:
+        """(files, subdirs) if the stored listing is still current."""
+        with self._lock:
+            row = self._db.execute("SELECT mtime_ns, files, subdirs FROM dirs WHERE path = ?", (path,)).fetchone()
+        if not row or row[0] != mtime_ns: return None
+        return json.loads(row[1]), json.loads(row[2])
+
+    def put(self, path: str, mtime_ns: int, files: List[str], subdirs: List[str]):
+        with self._lock:
+            self._pending.append((path, mtime_ns, json.dumps(files, ensure_ascii=False), json.dumps(subdirs, ensure_ascii=False)))
+            if len(self._pending) >= 500: self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending: return
+        self._db.executemany("INSERT OR REPLACE INTO dirs (path, mtime_ns, files, subdirs) VALUES (?, ?, ?, ?)", self._pending)
+        self._db.commit()
+        self._pending = []
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush_locked()
+                self._db.close()
+            except: pass
+
+
+def list_dir(path: str, extensions: Set[str], snapshots: Optional[DirSnapshots] = None) -> Tuple[List[str], List[str]]:
+    """Image file names and subdirectory names of one directory, from the snapshot when unchanged."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    if snapshots is not None:
+        snap = snapshots.get(path, mtime_ns)
+        if snap is not None: return snap
+    files, subdirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                # Like os.walk: symlinked directories are not followed.
+                if entry.is_dir(follow_symlinks=False): subdirs.append(entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in extensions: files.append(entry.name)
+            except OSError: pass
+    if snapshots is not None: snapshots.put(path, mtime_ns, files, subdirs)
+    return files, subdirs
+
+
+def iter_images(folder: str, extensions: Iterable[str], workers: int = 1,
+                snapshots: Optional[DirSnapshots] = None, exclude: Optional[Iterable[str]] = None,
+                cancel: Optional[threading.Event] = None) -> Iterator[str]:
+    """
+    Yields absolute image paths under folder in discovery order (not sorted), skipping the exclude directories.
+    Setting `cancel` stops the walk after the directories being listed (also while no image turns up).
+    """
+    if not os.path.isdir(folder): return
+    extensions = {e.lower() for e in extensions}
+    root = os.path.abspath(folder)
+    skip = {os.path.normcase(os.path.abspath(d)) for d in exclude or ()}
+    cancel = cancel or threading.Event()
+    try:
+        if workers <= 1: yield from _iter_sequential(root, extensions, snapshots, skip, cancel)
+        else: yield from _iter_parallel(root, extensions, workers, snapshots, skip, cancel)
+    finally:
+        if snapshots is not None: snapshots.flush()
+
+
+def _iter_sequential(root: str, extensions: Set[str], snapshots: Optional[DirSnapshots], skip: Set[str],
+                     cancel: threading.Event) -> Iterator[str]:
+    stack = [root]
+    while stack and not cancel.is_set():
+        d = stack.pop()
+        try: files, subdirs = list_dir(d, extensions, snapshots)
+        except OSError: continue
+        for f in files: yield os.path.join(d, f)
+        stack.extend(p for p in (os.path.join(d, s) for s in reversed(subdirs)) if os.path.normcase(p) not in skip)
+
+
+def _iter_parallel(root: str, extensions: Set[str], workers: int, snapshots: Optional[DirSnapshots], skip: Set[str],
+                   cancel: threading.Event) -> Iterator[str]:
+    out: queue.Queue = queue.Queue()
+    pending = [0]
+    lock = threading.Lock()
+    abort = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+
+    def submit(d: str):
+        with lock: pending[0] += 1
+        try: pool.submit(task, d)
+        except RuntimeError: finished()  # pool already shut down
+
+    def finished():
+        with lock:
+            pending[0] -= 1
+            last = pending[0] == 0
+        if last: out.put(_SENTINEL)
+
+    def task(d: str):
+        try:
+            if abort.is_set() or cancel.is_set(): return  # the queue drains and the sentinel ends the walk
+            try: files, subdirs = list_dir(d, extensions, snapshots)
+            except OSError: return
+            if files: out.put([os.path.join(d, f) for f in files])
+            for s in subdirs:
+                p = os.path.join(d, s)
+                if os.path.normcase(p) not in skip: submit(p)
+        finally:
+            finished()
+
+    submit(root)
+    try:
+        while True:
+            batch = out.get()
+            if batch is _SENTINEL: break
+            yield from batch
+    finally:
+        abort.set()
+        pool.shutdown(wait=False, cancel_futures=True)
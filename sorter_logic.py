@@ -4,21 +4,38 @@ import sys
 import shutil
 import base64
 import json
-import subprocess
 import time
 import atexit
 import threading
 import configparser
 import requests
-import uuid
+import io
 import re
-from PIL import Image
-from typing import List, Dict, Optional, Iterator
+import shlex
+from typing import List, Dict, Optional, Iterator, Tuple
+import analysis_cache
+import caption_index
+import scanner
+import engine_manager
+import engine_pool
+import metrics
+import run_log
+import thumbnails
+import dedup
+import mover
+import jobs
+import prompts
+import decode_pool
+import downloader
+import gguf_reader
+from pipeline import run_pipeline
 
 # -------------------- CONFIG & GLOBALS --------------------
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMP_DIR = os.path.join(SCRIPT_DIR, "temp")
+# Persistent data under temp/ that survives cleanup_temp_folder()
+CACHE_DIR = os.path.join(TEMP_DIR, "cache")
 
 KOBOLDCPP_EXE = os.path.join(SCRIPT_DIR, "bin", "koboldcpp", "koboldcpp-launcher.exe")
 MODELS_DIR = os.path.join(SCRIPT_DIR, "bin", "models")
@@ -83,78 +100,174 @@ KOBOLD_PORT = 5001
 API_BASE_URL = f"http://{KOBOLD_HOST}:{KOBOLD_PORT}"
 LOW_VRAM = False
 
+# Engine lifetime ([engine] section in config.ini)
+ENGINE_CONTEXT_SIZE = 4096
+ENGINE_KEEP_WARM = True      # keep the model loaded between jobs
+ENGINE_IDLE_TIMEOUT = 600    # seconds without a job before unloading (0 = never)
+ENGINE_PREWARM = True        # start loading as soon as the GUI launches
+ENGINE_REATTACH = True       # let a relaunched GUI adopt the running engine
+ENGINE_EXTERNAL_URL = ""     # OpenAI-compatible server to use instead of spawning koboldcpp
+ENGINE_PERF_PROBE = True     # ask koboldcpp's /api/extra/perf for prefill time when responses carry no timings
+ENGINE_PREFLIGHT = True      # check the GGUF headers of the model pair before launching the engine
+ENGINE_STATE_FILE = os.path.join(CACHE_DIR, "engine.json")
+
+# Engine pool ([pool] and [endpoint.<name>] sections in config.ini). Active as soon as
+# one endpoint section exists; the engine above joins as endpoint "default".
+POOL_INCLUDE_DEFAULT = True
+POOL_MAX_FAILURES = 3        # consecutive failed requests before an endpoint is ejected
+POOL_EJECT_S = 30            # seconds an ejected endpoint gets no requests
+POOL_HEALTH_INTERVAL = 10    # seconds between /v1/models probes (0 = off)
+
+# Analysis cache ([cache] section in config.ini)
+CACHE_ENABLED = True
+CACHE_PATH = os.path.join(CACHE_DIR, "analysis_cache.sqlite")
+CACHE_MAX_SIZE_MB = 512
+
+# Caption index for the Searcher ([index] section in config.ini)
+INDEX_PATH = os.path.join(CACHE_DIR, "caption_index.sqlite")
+INDEX_TOP_K = 50             # results returned from the index
+INDEX_MIN_COVERAGE = 0.5     # share of query words a caption must contain (without re-rank)
+INDEX_RERANK = True          # let the LLM re-check the best lexical candidates
+INDEX_RERANK_CANDIDATES = 40
+
+# Folder scanning ([scan] section in config.ini)
+SCAN_WORKERS = 4             # directories listed in parallel (helps on network shares)
+SCAN_SNAPSHOTS = True        # skip re-listing directories whose mtime did not change
+SCAN_SNAPSHOT_PATH = os.path.join(CACHE_DIR, "scan_snapshots.sqlite")
+
+# Pipeline ([performance] section in config.ini)
+PREFETCH_WORKERS = 2     # threads decoding/encoding images ahead of the engine
+PARALLEL_REQUESTS = 2    # requests in flight to the engine (koboldcpp --multiuser slots)
+PREFETCH_DEPTH = 8       # encoded images allowed to wait in each queue
+BATCH_SIZE = 1           # images packed into one chat request (clamped to the context size)
+BATCH_TOKENS_PER_IMAGE = 160  # answer budget per image in a batched request
+TEXT_BATCH_SIZE = 20     # descriptions per request when re-classifying from text
+
+# Fast (ID-only) classification ([fast] section in config.ini)
+FAST_CONSTRAINT = "grammar"  # grammar (GBNF) | json_schema (response_format) | none
+FAST_MAX_TOKENS = 16
+ANALYSIS_MODES = ("precise", "fast", "cascade")
+
+# Cascade inference ([cascade] section in config.ini): every image goes to the small
+# model first; unclear answers are re-asked (precise) on the large one.
+CASCADE_SMALL = "low"        # MODEL_VARIANTS key
+CASCADE_LARGE = "high"
+CASCADE_FIRST_MODE = "precise"  # precise | fast (fast answers carry no confidence)
+CASCADE_ESCALATE_ON = ("none", "error", "low_confidence")
+
+# Image encoder ([encoder] section in config.ini)
+ENCODE_FORMAT = "jpeg"   # jpeg | webp | png
+ENCODE_QUALITY = 90
+ENCODE_MAX_SIDE = 1500   # Qwen models handle up to 1000-1500 well
+# Resolution ladder for sorting: images are classified at the first size and re-sent at
+# the next one only when the answer is unclear (see LADDER_ESCALATE_ON). Empty = always max_side.
+ENCODE_LADDER: List[int] = [672, 1500]
+LADDER_ESCALATE_ON = ("none", "error", "low_confidence")
+
+# Decode workers ([decode] section in config.ini). processes = 0 decodes in the GUI process.
+DECODE_PROCESSES = 2
+DECODE_MEMORY_MB = 2048       # per worker
+DECODE_MAX_MEGAPIXELS = 180   # larger images are refused before decoding (PIL's bomb error limit)
+DECODE_TIMEOUT_S = 30.0
+
+# Model downloads ([download] section in config.ini)
+DOWNLOAD_SEGMENTS = 8   # parallel ranged connections per file
+DOWNLOAD_CHUNK_MB = 32  # unit of work and of resume
+
+# Run metrics ([metrics] section in config.ini)
+METRICS_DIR = os.path.join(CACHE_DIR, "runs")  # one JSON summary per run ("" = off)
+METRICS_KEEP_RUNS = 50
+METRICS_PROMETHEUS_PORT = 0  # serve /metrics in Prometheus text format (0 = off)
+METRICS_PROMETHEUS_HOST = "127.0.0.1"
+
+# Near-duplicate grouping ([dedup] section in config.ini)
+DEDUP_ENABLED = False      # opt-in: members are filed with their representative without being analyzed
+DEDUP_HASH = "phash"       # phash | dhash
+DEDUP_MAX_DISTANCE = 6     # Hamming distance (of 64 bits) that still counts as the same picture
+DEDUP_SPOT_CHECK = 0.05    # share of duplicates analyzed anyway to verify the grouping
+
+# Preview thumbnails ([thumbnails] section in config.ini)
+THUMB_DIR = os.path.join(CACHE_DIR, "thumbs")
+THUMB_MAX_SIZE_MB = 256
+THUMB_SIDE = 192
+THUMB_FORMAT = "webp"    # webp | jpeg
+
+# Run log ([log] section in config.ini)
+LOG_DIR = os.path.join(CACHE_DIR, "logs")  # full log of every run ("" = off)
+LOG_KEEP_FILES = 50
+LOG_TAIL_LINES = 500      # lines kept in the UI log
+LOG_UI_INTERVAL = 0.5     # seconds between UI log updates
+
+# Move journal ([moves] section in config.ini)
+JOURNAL_DIR = os.path.join(CACHE_DIR, "journals")  # one JSONL journal per sort run, for undo
+JOURNAL_KEEP = 50
+
+# Resumable jobs ([jobs] section in config.ini)
+JOBS_DIR = os.path.join(CACHE_DIR, "jobs")  # sort.json / search.json: the last job of each kind
+JOB_CHECKPOINT_S = 10.0   # seconds between checkpoints while a job runs
+
 # State
-kobold_process: Optional[subprocess.Popen] = None
-kobold_job_handle = None
+engine = engine_manager.KoboldEngine(KOBOLDCPP_EXE, KOBOLD_HOST, KOBOLD_PORT, ENGINE_STATE_FILE,
+                                     idle_timeout=ENGINE_IDLE_TIMEOUT, reattach=ENGINE_REATTACH)
+_analysis_cache: Optional[analysis_cache.AnalysisCache] = None
+_caption_index: Optional[caption_index.CaptionIndex] = None
+_scan_snapshots: Optional[scanner.DirSnapshots] = None
+_thumbnail_cache: Optional[thumbnails.ThumbnailCache] = None
+endpoint_pool: Optional[engine_pool.EnginePool] = None
 OPENAI_MODEL_NAME: Optional[str] = None
 CURRENT_MODEL_PATH: Optional[str] = None
 CURRENT_MMPROJ_PATH: Optional[str] = None
 stop_event = threading.Event()
+_http = requests.Session()
+stage_metrics = metrics.Metrics()
+
+IMAGE_MIME = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
 
 ALLOWED_EXTENSIONS = {
     ".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", 
     ".tif", ".tiff", ".ico", ".avif", ".jxl", ".tga"
 }
 
-# -------------------- WINDOWS JOB OBJECT HELPERS --------------------
-if os.name == 'nt':
-    import ctypes
-    from ctypes import wintypes
-
-    JobObjectExtendedLimitInformation = 9
-    JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE = 0x2000
-
-    class IO_COUNTERS(ctypes.Structure):
-        _fields_ = [('ReadOperationCount', ctypes.c_ulonglong), ('WriteOperationCount', ctypes.c_ulonglong), ('OtherOperationCount', ctypes.c_ulonglong), ('ReadTransferCount', ctypes.c_ulonglong), ('WriteTransferCount', ctypes.c_ulonglong), ('OtherTransferCount', ctypes.c_ulonglong)]
-
-    class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
-        _fields_ = [('PerProcessUserTimeLimit', wintypes.LARGE_INTEGER), ('PerJobUserTimeLimit', wintypes.LARGE_INTEGER), ('LimitFlags', wintypes.DWORD), ('MinimumWorkingSetSize', ctypes.c_size_t), ('MaximumWorkingSetSize', ctypes.c_size_t), ('ActiveProcessLimit', wintypes.DWORD), ('Affinity', ctypes.c_size_t), ('PriorityClass', wintypes.DWORD), ('SchedulingClass', wintypes.DWORD)]
-
-    class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
-        _fields_ = [('BasicLimitInformation', JOBOBJECT_BASIC_LIMIT_INFORMATION), ('IoInfo', IO_COUNTERS), ('ProcessMemoryLimit', ctypes.c_size_t), ('JobMemoryLimit', ctypes.c_size_t), ('PeakProcessMemoryUsed', ctypes.c_size_t), ('PeakJobMemoryUsed', ctypes.c_size_t)]
-
-    def create_kill_on_close_job():
-        try:
-            hJob = ctypes.windll.kernel32.CreateJobObjectW(None, None)
-            if not hJob: return None
-            info = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
-            info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
-            res = ctypes.windll.kernel32.SetInformationJobObject(hJob, JobObjectExtendedLimitInformation, ctypes.byref(info), ctypes.sizeof(JOBOBJECT_EXTENDED_LIMIT_INFORMATION))
-            if not res:
-                ctypes.windll.kernel32.CloseHandle(hJob)
-                return None
-            return hJob
-        except: return None
-
-    def assign_process_to_job(hJob, pid):
-        if not hJob: return False
-        try:
-            PROCESS_SET_QUOTA = 0x0100; PROCESS_TERMINATE = 0x0001
-            hProcess = ctypes.windll.kernel32.OpenProcess(PROCESS_SET_QUOTA | PROCESS_TERMINATE, False, pid)
-            if hProcess:
-                res = ctypes.windll.kernel32.AssignProcessToJobObject(hJob, hProcess)
-                ctypes.windll.kernel32.CloseHandle(hProcess)
-                return bool(res)
-        except: pass
-        return False
-
 # -------------------- CONFIG & TEMP MANAGEMENT --------------------
 
 def ensure_dirs():
     if not os.path.exists(TEMP_DIR): os.makedirs(TEMP_DIR)
+    if not os.path.exists(CACHE_DIR): os.makedirs(CACHE_DIR)
     if not os.path.exists(MODELS_DIR): os.makedirs(MODELS_DIR)
 
 def cleanup_temp_folder():
     if os.path.exists(TEMP_DIR):
         for filename in os.listdir(TEMP_DIR):
             file_path = os.path.join(TEMP_DIR, filename)
+            if os.path.abspath(file_path) == os.path.abspath(CACHE_DIR): continue
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path): os.unlink(file_path)
                 elif os.path.isdir(file_path): shutil.rmtree(file_path)
             except: pass
 
+def _resolve_path(p: str) -> str:
+    p = p.strip().strip('"')
+    if not os.path.isabs(p): p = os.path.abspath(os.path.join(SCRIPT_DIR, p))
+    return p
+
 def load_config():
-    global MODEL_PATH, MMPROJ_PATH
+    global MODEL_PATH, MMPROJ_PATH, CACHE_ENABLED, CACHE_PATH, CACHE_MAX_SIZE_MB
+    global PREFETCH_WORKERS, PARALLEL_REQUESTS, PREFETCH_DEPTH, BATCH_SIZE, TEXT_BATCH_SIZE
+    global FAST_CONSTRAINT, FAST_MAX_TOKENS
+    global ENCODE_FORMAT, ENCODE_QUALITY, ENCODE_MAX_SIDE, ENCODE_LADDER, LADDER_ESCALATE_ON
+    global DECODE_PROCESSES, DECODE_MEMORY_MB, DECODE_MAX_MEGAPIXELS, DECODE_TIMEOUT_S
+    global DOWNLOAD_SEGMENTS, DOWNLOAD_CHUNK_MB
+    global ENGINE_CONTEXT_SIZE, ENGINE_KEEP_WARM, ENGINE_IDLE_TIMEOUT, ENGINE_PREWARM, ENGINE_REATTACH, ENGINE_PREFLIGHT
+    global ENGINE_EXTERNAL_URL, API_BASE_URL, ENGINE_PERF_PROBE
+    global INDEX_PATH, INDEX_TOP_K, INDEX_MIN_COVERAGE, INDEX_RERANK, INDEX_RERANK_CANDIDATES
+    global SCAN_WORKERS, SCAN_SNAPSHOTS
+    global METRICS_DIR, METRICS_KEEP_RUNS, METRICS_PROMETHEUS_PORT, METRICS_PROMETHEUS_HOST
+    global LOG_DIR, LOG_KEEP_FILES, LOG_TAIL_LINES, LOG_UI_INTERVAL
+    global JOURNAL_DIR, JOURNAL_KEEP, JOBS_DIR, JOB_CHECKPOINT_S
+    global THUMB_DIR, THUMB_MAX_SIZE_MB, THUMB_SIDE, THUMB_FORMAT
+    global DEDUP_ENABLED, DEDUP_HASH, DEDUP_MAX_DISTANCE, DEDUP_SPOT_CHECK
+    global CASCADE_SMALL, CASCADE_LARGE, CASCADE_FIRST_MODE, CASCADE_ESCALATE_ON
+    global POOL_INCLUDE_DEFAULT, POOL_MAX_FAILURES, POOL_EJECT_S, POOL_HEALTH_INTERVAL, endpoint_pool
     ensure_dirs()
     if not os.path.exists(CONFIG_PATH): return
     cfg = configparser.ConfigParser()
@@ -167,27 +280,198 @@ def load_config():
             if not os.path.isabs(mmp): mmp = os.path.abspath(os.path.join(SCRIPT_DIR, mmp))
             MODEL_PATH = mp
             MMPROJ_PATH = mmp
+        if cfg.has_section("cache"):
+            CACHE_ENABLED = cfg.getboolean("cache", "enabled", fallback=CACHE_ENABLED)
+            cp = cfg.get("cache", "path", fallback="").strip()
+            if cp: CACHE_PATH = _resolve_path(cp)
+            CACHE_MAX_SIZE_MB = cfg.getint("cache", "max_size_mb", fallback=CACHE_MAX_SIZE_MB)
+        if cfg.has_section("performance"):
+            PREFETCH_WORKERS = max(1, cfg.getint("performance", "prefetch_workers", fallback=PREFETCH_WORKERS))
+            PARALLEL_REQUESTS = max(1, cfg.getint("performance", "parallel_requests", fallback=PARALLEL_REQUESTS))
+            PREFETCH_DEPTH = max(1, cfg.getint("performance", "prefetch_depth", fallback=PREFETCH_DEPTH))
+            BATCH_SIZE = max(1, cfg.getint("performance", "batch_size", fallback=BATCH_SIZE))
+            TEXT_BATCH_SIZE = max(1, cfg.getint("performance", "text_batch_size", fallback=TEXT_BATCH_SIZE))
+        if cfg.has_section("fast"):
+            fc = cfg.get("fast", "constraint", fallback=FAST_CONSTRAINT).strip().lower()
+            if fc in ("grammar", "json_schema", "none"): FAST_CONSTRAINT = fc
+            FAST_MAX_TOKENS = max(4, cfg.getint("fast", "max_tokens", fallback=FAST_MAX_TOKENS))
+        if cfg.has_section("encoder"):
+            fmt = cfg.get("encoder", "format", fallback=ENCODE_FORMAT).strip().lower()
+            if fmt in IMAGE_MIME: ENCODE_FORMAT = fmt
+            ENCODE_QUALITY = min(100, max(1, cfg.getint("encoder", "quality", fallback=ENCODE_QUALITY)))
+            ENCODE_MAX_SIDE = max(64, cfg.getint("encoder", "max_side", fallback=ENCODE_MAX_SIDE))
+            if cfg.has_option("encoder", "resolution_ladder"):
+                sides = [x.strip() for x in cfg.get("encoder", "resolution_ladder").split(",")]
+                ENCODE_LADDER = sorted({max(64, int(x)) for x in sides if x.isdigit()})
+            if cfg.has_option("encoder", "ladder_escalate_on"):
+                eo = cfg.get("encoder", "ladder_escalate_on")
+                LADDER_ESCALATE_ON = tuple(x.strip().lower() for x in eo.split(",") if x.strip().lower() in ("none", "error", "low_confidence"))
+        if cfg.has_section("decode"):
+            DECODE_PROCESSES = max(0, cfg.getint("decode", "processes", fallback=DECODE_PROCESSES))
+            DECODE_MEMORY_MB = max(0, cfg.getint("decode", "memory_mb", fallback=DECODE_MEMORY_MB))
+            DECODE_MAX_MEGAPIXELS = max(0, cfg.getint("decode", "max_megapixels", fallback=DECODE_MAX_MEGAPIXELS))
+            DECODE_TIMEOUT_S = max(0.0, cfg.getfloat("decode", "timeout_s", fallback=DECODE_TIMEOUT_S))
+        if cfg.has_section("download"):
+            DOWNLOAD_SEGMENTS = max(1, cfg.getint("download", "segments", fallback=DOWNLOAD_SEGMENTS))
+            DOWNLOAD_CHUNK_MB = max(1, cfg.getint("download", "chunk_mb", fallback=DOWNLOAD_CHUNK_MB))
+        if cfg.has_section("engine"):
+            ENGINE_CONTEXT_SIZE = cfg.getint("engine", "context_size", fallback=ENGINE_CONTEXT_SIZE)
+            ENGINE_KEEP_WARM = cfg.getboolean("engine", "keep_warm", fallback=ENGINE_KEEP_WARM)
+            ENGINE_IDLE_TIMEOUT = max(0, cfg.getint("engine", "idle_timeout_s", fallback=ENGINE_IDLE_TIMEOUT))
+            ENGINE_PREWARM = cfg.getboolean("engine", "prewarm", fallback=ENGINE_PREWARM)
+            ENGINE_REATTACH = cfg.getboolean("engine", "reattach", fallback=ENGINE_REATTACH)
+            ENGINE_EXTERNAL_URL = cfg.get("engine", "api_base_url", fallback=ENGINE_EXTERNAL_URL).strip().rstrip("/")
+            ENGINE_PERF_PROBE = cfg.getboolean("engine", "perf_probe", fallback=ENGINE_PERF_PROBE)
+            ENGINE_PREFLIGHT = cfg.getboolean("engine", "preflight", fallback=ENGINE_PREFLIGHT)
+        if cfg.has_section("index"):
+            ip = cfg.get("index", "path", fallback="").strip()
+            if ip: INDEX_PATH = _resolve_path(ip)
+            INDEX_TOP_K = max(1, cfg.getint("index", "top_k", fallback=INDEX_TOP_K))
+            INDEX_MIN_COVERAGE = cfg.getfloat("index", "min_coverage", fallback=INDEX_MIN_COVERAGE)
+            INDEX_RERANK = cfg.getboolean("index", "rerank", fallback=INDEX_RERANK)
+            INDEX_RERANK_CANDIDATES = max(1, cfg.getint("index", "rerank_candidates", fallback=INDEX_RERANK_CANDIDATES))
+        if cfg.has_section("scan"):
+            SCAN_WORKERS = max(1, cfg.getint("scan", "workers", fallback=SCAN_WORKERS))
+            SCAN_SNAPSHOTS = cfg.getboolean("scan", "snapshots", fallback=SCAN_SNAPSHOTS)
+        if cfg.has_section("metrics"):
+            md = cfg.get("metrics", "runs_dir", fallback=None)
+            if md is not None: METRICS_DIR = _resolve_path(md) if md.strip() else ""
+            METRICS_KEEP_RUNS = max(1, cfg.getint("metrics", "keep_runs", fallback=METRICS_KEEP_RUNS))
+            METRICS_PROMETHEUS_PORT = max(0, cfg.getint("metrics", "prometheus_port", fallback=METRICS_PROMETHEUS_PORT))
+            METRICS_PROMETHEUS_HOST = cfg.get("metrics", "prometheus_host", fallback=METRICS_PROMETHEUS_HOST).strip() or METRICS_PROMETHEUS_HOST
+        if cfg.has_section("dedup"):
+            DEDUP_ENABLED = cfg.getboolean("dedup", "enabled", fallback=DEDUP_ENABLED)
+            dh = cfg.get("dedup", "hash", fallback=DEDUP_HASH).strip().lower()
+            if dh in dedup.HASH_KINDS: DEDUP_HASH = dh
+            DEDUP_MAX_DISTANCE = min(32, max(0, cfg.getint("dedup", "max_distance", fallback=DEDUP_MAX_DISTANCE)))
+            DEDUP_SPOT_CHECK = min(1.0, max(0.0, cfg.getfloat("dedup", "spot_check", fallback=DEDUP_SPOT_CHECK)))
+        if cfg.has_section("cascade"):
+            cs = cfg.get("cascade", "small", fallback=CASCADE_SMALL).strip().lower()
+            if cs in MODEL_VARIANTS: CASCADE_SMALL = cs
+            cl = cfg.get("cascade", "large", fallback=CASCADE_LARGE).strip().lower()
+            if cl in MODEL_VARIANTS: CASCADE_LARGE = cl
+            fm = cfg.get("cascade", "first_mode", fallback=CASCADE_FIRST_MODE).strip().lower()
+            if fm in ("precise", "fast"): CASCADE_FIRST_MODE = fm
+            eo = cfg.get("cascade", "escalate_on", fallback=None)
+            if eo is not None:
+                CASCADE_ESCALATE_ON = tuple(x.strip().lower() for x in eo.split(",") if x.strip().lower() in ("none", "error", "low_confidence"))
+        if cfg.has_section("thumbnails"):
+            td = cfg.get("thumbnails", "dir", fallback="").strip()
+            if td: THUMB_DIR = _resolve_path(td)
+            THUMB_MAX_SIZE_MB = max(1, cfg.getint("thumbnails", "max_size_mb", fallback=THUMB_MAX_SIZE_MB))
+            THUMB_SIDE = min(1024, max(32, cfg.getint("thumbnails", "size", fallback=THUMB_SIDE)))
+            tf = cfg.get("thumbnails", "format", fallback=THUMB_FORMAT).strip().lower()
+            if tf in thumbnails.THUMB_EXT: THUMB_FORMAT = tf
+        if cfg.has_section("moves"):
+            jd = cfg.get("moves", "journal_dir", fallback="").strip()
+            if jd: JOURNAL_DIR = _resolve_path(jd)
+            JOURNAL_KEEP = max(1, cfg.getint("moves", "keep_journals", fallback=JOURNAL_KEEP))
+        if cfg.has_section("jobs"):
+            jd = cfg.get("jobs", "dir", fallback="").strip()
+            if jd: JOBS_DIR = _resolve_path(jd)
+            JOB_CHECKPOINT_S = max(1.0, cfg.getfloat("jobs", "checkpoint_s", fallback=JOB_CHECKPOINT_S))
+        if cfg.has_section("pool"):
+            POOL_INCLUDE_DEFAULT = cfg.getboolean("pool", "include_default", fallback=POOL_INCLUDE_DEFAULT)
+            POOL_MAX_FAILURES = max(1, cfg.getint("pool", "max_failures", fallback=POOL_MAX_FAILURES))
+            POOL_EJECT_S = max(1.0, cfg.getfloat("pool", "eject_s", fallback=POOL_EJECT_S))
+            POOL_HEALTH_INTERVAL = max(0.0, cfg.getfloat("pool", "health_interval_s", fallback=POOL_HEALTH_INTERVAL))
+        if cfg.has_section("log"):
+            ld = cfg.get("log", "dir", fallback=None)
+            if ld is not None: LOG_DIR = _resolve_path(ld) if ld.strip() else ""
+            LOG_KEEP_FILES = max(1, cfg.getint("log", "keep_files", fallback=LOG_KEEP_FILES))
+            LOG_TAIL_LINES = max(20, cfg.getint("log", "tail_lines", fallback=LOG_TAIL_LINES))
+            LOG_UI_INTERVAL = max(0.0, cfg.getfloat("log", "ui_interval_s", fallback=LOG_UI_INTERVAL))
     except: pass
+    engine.idle_timeout = ENGINE_IDLE_TIMEOUT
+    engine.reattach = ENGINE_REATTACH
+    API_BASE_URL = ENGINE_EXTERNAL_URL or engine.base_url
+    try: endpoint_pool = build_endpoint_pool(cfg)
+    except Exception as e:
+        print(f"[WARN] Engine pool disabled: {e}")
+        endpoint_pool = None
+
+def build_endpoint_pool(cfg: configparser.ConfigParser) -> Optional[engine_pool.EnginePool]:
+    """
+    One endpoint per [endpoint.<name>] section: url = ... for an external server, or
+    port = ... (plus optional device and args) for a koboldcpp process of our own.
+    """
+    sections = [sec for sec in cfg.sections() if sec.lower().startswith("endpoint.")]
+    if not sections: return None
+    endpoints = []
+    if POOL_INCLUDE_DEFAULT:
+        if ENGINE_EXTERNAL_URL: endpoints.append(engine_pool.Endpoint("default", url=ENGINE_EXTERNAL_URL, slots=PARALLEL_REQUESTS))
+        else: endpoints.append(engine_pool.Endpoint("default", engine=engine, slots=PARALLEL_REQUESTS))
+    for sec in sections:
+        name = sec.split(".", 1)[1].strip() or sec
+        slots = max(1, cfg.getint(sec, "slots", fallback=PARALLEL_REQUESTS))
+        url = cfg.get(sec, "url", fallback="").strip()
+        if url:
+            endpoints.append(engine_pool.Endpoint(name, url=url, slots=slots))
+            continue
+        port = cfg.getint(sec, "port", fallback=0)
+        if not port or (port == KOBOLD_PORT and POOL_INCLUDE_DEFAULT):
+            print(f"[WARN] [{sec}] needs a url, or a port other than the default engine's.")
+            continue
+        device = cfg.get(sec, "device", fallback="").strip()
+        env = {"CUDA_VISIBLE_DEVICES": device, "HIP_VISIBLE_DEVICES": device} if device else None
+        eng = engine_manager.KoboldEngine(KOBOLDCPP_EXE, KOBOLD_HOST, port, os.path.join(CACHE_DIR, f"engine_{name}.json"),
+                                          idle_timeout=ENGINE_IDLE_TIMEOUT, reattach=ENGINE_REATTACH, env=env)
+        endpoints.append(engine_pool.Endpoint(name, engine=eng, slots=slots, args=shlex.split(cfg.get(sec, "args", fallback=""))))
+    return engine_pool.EnginePool(endpoints, POOL_MAX_FAILURES, POOL_EJECT_S, POOL_HEALTH_INTERVAL)
 
 def save_config(model_path: str, mmproj_path: str):
     global MODEL_PATH, MMPROJ_PATH
     mp = os.path.abspath(model_path.strip().strip('"'))
     mmp = os.path.abspath(mmproj_path.strip().strip('"'))
+    # Keep every other section (cache, engine, ...) intact
     cfg = configparser.ConfigParser()
-    cfg.add_section("models")
+    if os.path.exists(CONFIG_PATH):
+        try: cfg.read(CONFIG_PATH, encoding="utf-8")
+        except: pass
+    if not cfg.has_section("models"): cfg.add_section("models")
     cfg.set("models", "model_gguf", mp)
     cfg.set("models", "mmproj_gguf", mmp)
     with open(CONFIG_PATH, "w", encoding="utf-8") as f: cfg.write(f)
+    changed = (mp, mmp) != (os.path.abspath(MODEL_PATH), os.path.abspath(MMPROJ_PATH))
     MODEL_PATH = mp
     MMPROJ_PATH = mmp
-    stop_koboldcpp()
+    # An unchanged model stays loaded so the restarted GUI can reattach to it.
+    if changed: stop_koboldcpp()
     return mp, mmp
 
-def check_model_variant_status(key: str) -> bool:
-    if key not in MODEL_VARIANTS: return False
+def model_variant_state(key: str) -> str:
+    """The least finished state of the variant's two files (see downloader.file_state)."""
+    if key not in MODEL_VARIANTS: return "missing"
     data = MODEL_VARIANTS[key]
-    return os.path.exists(os.path.join(MODELS_DIR, data["main"]["filename"])) and \
-           os.path.exists(os.path.join(MODELS_DIR, data["mmproj"]["filename"]))
+    states = [downloader.file_state(os.path.join(MODELS_DIR, data[sub]["filename"])) for sub in ("main", "mmproj")]
+    for s in ("corrupt", "partial", "missing", "unverified"):
+        if s in states:
+            # Half the files missing after a started download still reads as "partial".
+            return "partial" if s == "missing" and any(x != "missing" for x in states) else s
+    return "ok"
+
+def check_model_variant_status(key: str) -> bool:
+    """
+    True when both files are usable: size and SHA-256 agree with the download manifest, or the file has
+    no manifest to check against (downloaded by an older version). Partial and corrupt files count as absent.
+    """
+    return model_variant_state(key) in ("ok", "unverified")
+
+def model_preflight(model_path: str, mmproj_path: str) -> Dict:
+    """Header check of a model pair (see gguf_reader.check_pair): errors, warnings and a memory estimate."""
+    return gguf_reader.check_pair(model_path, mmproj_path, ENGINE_CONTEXT_SIZE)
+
+def model_variant_check(key: str) -> Optional[Dict]:
+    if key not in MODEL_VARIANTS: return None
+    v = MODEL_VARIANTS[key]
+    return model_preflight(os.path.join(MODELS_DIR, v["main"]["filename"]), os.path.join(MODELS_DIR, v["mmproj"]["filename"]))
+
+def preflight_summary(check: Dict) -> str:
+    lines = [info.summary() for info in (check["model"], check["mmproj"]) if info is not None]
+    if check["memory"]: lines.append(f"Memory: {gguf_reader.describe_memory(check['memory'], ENGINE_CONTEXT_SIZE)}")
+    lines += [f"⚠️ {w}" for w in check["warnings"]]
+    lines += [f"❌ {e}" for e in check["errors"]]
+    return "\n".join(lines)
 
 def delete_model_variant(key: str) -> str:
     if key not in MODEL_VARIANTS: return "Invalid Key"
@@ -195,13 +479,18 @@ def delete_model_variant(key: str) -> str:
     log = []
     for sub in ["main", "mmproj"]:
         p = os.path.join(MODELS_DIR, data[sub]["filename"])
-        if os.path.exists(p):
-            try: os.remove(p); log.append(f"Deleted {data[sub]['filename']}")
-            except Exception as e: log.append(f"Error {e}")
+        try: log.extend(f"Deleted {name}" for name in downloader.remove_download(p))
+        except Exception as e: log.append(f"Error {e}")
     return ", ".join(log) if log else "Files not found."
 
 def get_startup_message() -> str:
     if os.path.isfile(MODEL_PATH) and os.path.isfile(MMPROJ_PATH):
+        check = model_preflight(MODEL_PATH, MMPROJ_PATH) if ENGINE_PREFLIGHT else None
+        if check and check["errors"]:
+            return "⚠️ MODEL CHECK FAILED ⚠️\n" + "\n".join(check["errors"]) + "\nFix the paths in the Settings tab or download the model again."
+        if check and check["model"] is not None:
+            memory = gguf_reader.describe_memory(check["memory"], ENGINE_CONTEXT_SIZE)
+            return f"Ready to sort.\nUsing: {check['model'].summary()}" + (f"\nNeeds {memory}" if memory else "")
         return f"Ready to sort.\nUsing: {os.path.basename(MODEL_PATH)}"
     return "⚠️ NO ACTIVE MODEL FOUND ⚠️\nPlease download a model in the Download tab."
 
@@ -211,95 +500,430 @@ atexit.register(cleanup_temp_folder)
 
 # -------------------- PROCESS MANAGEMENT --------------------
 
-def start_koboldcpp_if_needed(timeout: int = 90):
-    global kobold_process, kobold_job_handle, OPENAI_MODEL_NAME, CURRENT_MODEL_PATH, CURRENT_MMPROJ_PATH
-    mp = os.path.abspath(MODEL_PATH)
-    mmp = os.path.abspath(MMPROJ_PATH)
-    
-    if not os.path.isfile(mp) or not os.path.isfile(mmp):
-        raise RuntimeError(f"Active model files missing.\nPlease go to the Download tab.")
+def engine_args(slots: Optional[int] = None) -> List[str]:
+    slots = slots or PARALLEL_REQUESTS
+    args = ["--quiet", "--contextsize", str(ENGINE_CONTEXT_SIZE)]
+    if LOW_VRAM: args.extend(["--mmprojcpu", "--flashattention"])
+    if slots > 1: args.extend(["--multiuser", str(slots)])
+    return args
 
-    if kobold_process is not None and kobold_process.poll() is None:
-        if (CURRENT_MODEL_PATH == mp and CURRENT_MMPROJ_PATH == mmp): return
-        else: stop_koboldcpp()
+def endpoint_args(ep: engine_pool.Endpoint) -> List[str]:
+    return engine_args(ep.slots) + ep.args
 
-    cmd = [KOBOLDCPP_EXE, "--model", mp, "--mmproj", mmp, "--host", KOBOLD_HOST, "--port", str(KOBOLD_PORT), "--quiet", "--contextsize", "4096"]
-    if LOW_VRAM: cmd.extend(["--mmprojcpu", "--flashattention"])
-    flags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
-    
-    kobold_process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=flags)
-    if os.name == 'nt':
-        kobold_job_handle = create_kill_on_close_job()
-        if kobold_job_handle: assign_process_to_job(kobold_job_handle, kobold_process.pid)
-    
-    CURRENT_MODEL_PATH = mp; CURRENT_MMPROJ_PATH = mmp
+def local_engines() -> List[engine_manager.KoboldEngine]:
+    if endpoint_pool is None: return [engine]
+    engines = [ep.engine for ep in endpoint_pool.endpoints if ep.local]
+    return engines if engine in engines else [engine] + engines
+
+def inflight_requests() -> int:
+    """Requests kept in flight: the engine's slots, or every pooled endpoint's."""
+    return endpoint_pool.total_slots() if endpoint_pool is not None else PARALLEL_REQUESTS
+
+def use_external_engine(url: str):
+    """Points all requests at an already running OpenAI-compatible server (e.g. a benchmark stub), bypassing the pool."""
+    global ENGINE_EXTERNAL_URL, API_BASE_URL, OPENAI_MODEL_NAME, endpoint_pool
+    endpoint_pool = None
+    ENGINE_EXTERNAL_URL = (url or "").strip().rstrip("/")
+    API_BASE_URL = ENGINE_EXTERNAL_URL or engine.base_url
+    OPENAI_MODEL_NAME = None
+
+_model_override: Optional[Tuple[str, str]] = None  # (model, mmproj) for the current cascade tier
+
+def active_model_paths() -> Tuple[str, str]:
+    mp, mmp = _model_override or (MODEL_PATH, MMPROJ_PATH)
+    return os.path.abspath(mp), os.path.abspath(mmp)
+
+def set_model_override(pair: Optional[Tuple[str, str]]):
+    """Makes requests use (and the engine load) another model pair until reset with None."""
+    global _model_override
+    _model_override = pair
+
+def current_model_key() -> str:
+    if ENGINE_EXTERNAL_URL: return analysis_cache.model_digest(ENGINE_EXTERNAL_URL, "external")
+    return analysis_cache.model_digest(*active_model_paths())
+
+_external_failed_at = 0.0
+
+def _connect_external_engine(timeout: int):
+    global OPENAI_MODEL_NAME, _external_failed_at
+    if OPENAI_MODEL_NAME: return
+    # Do not make every queued image wait out the full timeout again right after a failure.
+    if time.time() - _external_failed_at < 30:
+        raise RuntimeError(f"External engine not reachable: {ENGINE_EXTERNAL_URL}")
     start_t = time.time()
     while True:
-        if kobold_process.poll() is not None: raise RuntimeError("koboldcpp exited immediately.")
         try:
-            r = requests.get(f"{API_BASE_URL}/v1/models", timeout=1)
+            r = _http.get(f"{ENGINE_EXTERNAL_URL}/v1/models", timeout=5)
             if r.status_code == 200:
-                OPENAI_MODEL_NAME = r.json().get("data", [{}])[0].get("id", "koboldcpp")
-                break
-        except: pass
+                OPENAI_MODEL_NAME = (r.json().get("data") or [{}])[0].get("id", "external")
+                return
+        except Exception: pass
         if time.time() - start_t > timeout:
-            stop_koboldcpp(); raise RuntimeError("Timeout waiting for koboldcpp.")
+            _external_failed_at = time.time()
+            raise RuntimeError(f"External engine not reachable: {ENGINE_EXTERNAL_URL}")
         time.sleep(1)
 
+def check_models_before_launch(mp: str, mmp: str):
+    """Fails in milliseconds, with the reason, where the engine would exit or time out after loading."""
+    if not ENGINE_PREFLIGHT: return
+    check = model_preflight(mp, mmp)
+    for w in check["warnings"]: print(f"[WARN] {w}")
+    if check["errors"]:
+        raise RuntimeError("Model check failed, the engine was not started:\n" + "\n".join(check["errors"]))
+
+def start_koboldcpp_if_needed(timeout: int = 90):
+    try: _start_engine(timeout)
+    except Exception:
+        stage_metrics.incr("engine_errors")
+        raise
+
+def _start_engine(timeout: int):
+    global OPENAI_MODEL_NAME, CURRENT_MODEL_PATH, CURRENT_MMPROJ_PATH
+    if endpoint_pool is not None: return _start_pool(timeout)
+    if ENGINE_EXTERNAL_URL:
+        if not OPENAI_MODEL_NAME:
+            with stage_metrics.timer("engine_start"): _connect_external_engine(timeout)
+        return
+    mp, mmp = active_model_paths()
+    
+    if not os.path.isfile(mp) or not os.path.isfile(mmp):
+        raise RuntimeError(f"Active model files missing.\nPlease go to the Download tab.")
+
+    # Returns immediately when the engine is already serving this model; waits for
+    # an in-progress (pre-warm) load; (re)starts it otherwise.
+    args = engine_args()
+    if engine.state == engine.READY and engine.identity == (mp, mmp, tuple(args)) and engine.alive():
+        engine.ensure_ready(mp, mmp, args, timeout)
+    else:
+        check_models_before_launch(mp, mmp)
+        with stage_metrics.timer("engine_start"): engine.ensure_ready(mp, mmp, args, timeout)
+    OPENAI_MODEL_NAME = engine.model_name
+    CURRENT_MODEL_PATH = mp; CURRENT_MMPROJ_PATH = mmp
+
+_pool_cond = threading.Condition()
+
+def _endpoint_ready(ep: engine_pool.Endpoint) -> bool:
+    if not ep.local: return ep.ready
+    e = ep.engine
+    return e.state == e.READY and e.identity == (*active_model_paths(), tuple(endpoint_args(ep))) and e.alive()
+
+def _start_endpoint(ep: engine_pool.Endpoint, timeout: int):
+    if not ep.local:
+        # One probe: a LAN server that is down is ejected instead of holding up the job.
+        name = endpoint_pool.probe(ep, 5.0)
+        if not name: raise RuntimeError(f"not reachable: {ep.url}")
+        ep.model_name = name
+        return
+    mp, mmp = active_model_paths()
+    if not os.path.isfile(mp) or not os.path.isfile(mmp):
+        raise RuntimeError(f"Active model files missing.\nPlease go to the Download tab.")
+    check_models_before_launch(mp, mmp)
+    ep.engine.ensure_ready(mp, mmp, endpoint_args(ep), timeout)
+    ep.model_name = ep.engine.model_name
+
+def _start_pool(timeout: int):
+    """
+    Starts every endpoint that is not serving the wanted model yet (in parallel) and
+    returns as soon as one of them is ready; the others join the pool as they come up.
+    """
+    global OPENAI_MODEL_NAME, CURRENT_MODEL_PATH, CURRENT_MMPROJ_PATH
+    endpoints = endpoint_pool.endpoints
+    if all(_endpoint_ready(ep) or ep.ejected() for ep in endpoints) and endpoint_pool.healthy(): return
+
+    def start(ep):
+        try:
+            _start_endpoint(ep, timeout)
+            ep.ready = True
+            endpoint_pool.restore(ep)
+        except Exception as e:
+            endpoint_pool.eject(ep, f"start failed: {e}")
+        finally:
+            with _pool_cond:
+                ep.starting = False
+                _pool_cond.notify_all()
+
+    t0 = time.perf_counter()
+    with _pool_cond:
+        for ep in endpoints:
+            if ep.starting or ep.ejected(): continue
+            if _endpoint_ready(ep):
+                # e.g. a local engine that was pre-warmed or reattached
+                if ep.local and not ep.ready: ep.model_name, ep.ready = ep.engine.model_name, True
+                continue
+            ep.ready, ep.starting = False, True
+            threading.Thread(target=start, args=(ep,), daemon=True, name=f"engine-start-{ep.name}").start()
+        deadline = time.time() + timeout + 10
+        while not endpoint_pool.healthy() and any(ep.starting for ep in endpoints) and time.time() < deadline:
+            _pool_cond.wait(0.5)
+    ready = endpoint_pool.healthy()
+    if not ready:
+        errors = "; ".join(f"{ep.name}: {ep.last_error}" for ep in endpoints if ep.last_error)
+        raise RuntimeError(f"No engine endpoint could be started. {errors}")
+    stage_metrics.observe("engine_start", time.perf_counter() - t0)
+    endpoint_pool.start_health_checks()
+    OPENAI_MODEL_NAME = ready[0].model_name
+    CURRENT_MODEL_PATH, CURRENT_MMPROJ_PATH = active_model_paths()
+
+def prewarm_engine() -> bool:
+    """Starts loading (or reattaches to) the configured model in the background."""
+    if not ENGINE_PREWARM: return False
+    mp = os.path.abspath(MODEL_PATH)
+    mmp = os.path.abspath(MMPROJ_PATH)
+    if not os.path.isfile(mp) or not os.path.isfile(mmp): return False
+    if ENGINE_EXTERNAL_URL and endpoint_pool is None: return False
+    try: check_models_before_launch(mp, mmp)
+    except RuntimeError as e:
+        print(f"[WARN] Not pre-warming: {e}")
+        return False
+    if endpoint_pool is not None:
+        started = [ep.engine.start_async(mp, mmp, endpoint_args(ep)) for ep in endpoint_pool.endpoints if ep.local]
+        return any(started)
+    return engine.start_async(mp, mmp, engine_args())
+
+def get_engine_status_text() -> str:
+    if endpoint_pool is not None: return endpoint_pool.status_text()
+    if ENGINE_EXTERNAL_URL:
+        return f"🌐 External engine: {ENGINE_EXTERNAL_URL}" + (f" ({OPENAI_MODEL_NAME})" if OPENAI_MODEL_NAME else "")
+    return engine.status_text()
+
 def stop_koboldcpp():
-    global kobold_process, kobold_job_handle
-    if kobold_process and kobold_process.poll() is None: kobold_process.kill()
-    kobold_process = None
-    if kobold_job_handle and os.name == 'nt':
-        ctypes.windll.kernel32.CloseHandle(kobold_job_handle)
-        kobold_job_handle = None
+    for e in local_engines(): e.stop()
+
+def acquire_engine():
+    """Called when a job starts: keeps the idle watchdog(s) away while it runs."""
+    for e in local_engines(): e.acquire()
+
+def release_engine():
+    """Called when a job ends: keep the model warm for the next one, or unload it."""
+    for e in local_engines(): e.release()
+    if not ENGINE_KEEP_WARM: stop_koboldcpp()
 
 atexit.register(stop_koboldcpp)
 
 # -------------------- UTILS --------------------
 
-def find_images(folder: str) -> List[str]:
-    imgs = []
+def get_scan_snapshots() -> Optional[scanner.DirSnapshots]:
+    global _scan_snapshots
+    if not SCAN_SNAPSHOTS: return None
+    if _scan_snapshots is None:
+        try: _scan_snapshots = scanner.DirSnapshots(SCAN_SNAPSHOT_PATH)
+        except Exception as e:
+            print(f"[WARN] Scan snapshots unavailable: {e}")
+            return None
+    return _scan_snapshots
+
+def close_scan_snapshots():
+    global _scan_snapshots
+    if _scan_snapshots is not None: _scan_snapshots.close()
+    _scan_snapshots = None
+
+atexit.register(close_scan_snapshots)
+
+def get_thumbnail_cache() -> Optional[thumbnails.ThumbnailCache]:
+    global _thumbnail_cache
+    if _thumbnail_cache is None or _thumbnail_cache.folder != THUMB_DIR:
+        try: _thumbnail_cache = thumbnails.ThumbnailCache(THUMB_DIR, THUMB_MAX_SIZE_MB, THUMB_SIDE, THUMB_FORMAT, decode=decode_thumbnail)
+        except Exception as e:
+            print(f"[WARN] Thumbnail cache unavailable: {e}")
+            return None
+    return _thumbnail_cache
+
+def thumbnails_for(paths: List[str]) -> Dict[str, str]:
+    """{original: thumbnail path} for previews; originals that cannot be read are left out."""
+    cache = get_thumbnail_cache()
+    if cache is None: return {}
+    return cache.get_many(paths)
+
+def iter_images(folder: str, exclude: Optional[List[str]] = None, cancel: Optional[threading.Event] = None) -> Iterator[str]:
+    """Streams image paths as directories are listed (unsorted), skipping the exclude directories."""
+    return scanner.iter_images(folder, ALLOWED_EXTENSIONS, SCAN_WORKERS, get_scan_snapshots(), exclude, cancel)
+
+def find_images(folder: str, exclude: Optional[List[str]] = None) -> List[str]:
     if not os.path.isdir(folder): return []
-    for root, _, files in os.walk(folder):
-        for f in files:
-            if os.path.splitext(f)[1].lower() in ALLOWED_EXTENSIONS:
-                imgs.append(os.path.abspath(os.path.join(root, f)))
+    imgs = list(iter_images(folder, exclude))
     imgs.sort()
     return imgs
 
-def encode_image(path: str) -> str:
-    temp_png_path = os.path.join(TEMP_DIR, f"temp_process_{uuid.uuid4().hex}.png")
+def quick_scan(folder: str, preview: int = 24, report_every: float = 0.5,
+               cancel: Optional[threading.Event] = None) -> Iterator[Tuple[int, List[str], bool]]:
+    """
+    Counts images without building or sorting the full list. Yields (count, preview, done)
+    at most every report_every seconds, then once more when the walk is complete.
+    Setting `cancel` ends the walk early, without a final (done) result.
+    """
+    count, first, last = 0, [], time.time()
+    for p in iter_images(folder, cancel=cancel):
+        count += 1
+        if len(first) < preview: first.append(p)
+        if time.time() - last >= report_every:
+            last = time.time()
+            yield count, first, False
+    if cancel is None or not cancel.is_set(): yield count, first, True
+
+class EncodeStats:
+    """Bytes actually sent to the engine, for the run summary."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.images = 0
+            self.bytes = 0
+
+    def add(self, nbytes: int):
+        with self._lock:
+            self.images += 1
+            self.bytes += nbytes
+
+    def summary_line(self) -> Optional[str]:
+        if not self.images: return None
+        return f"Sent: {self.bytes / (1024*1024):.1f} MB ({self.bytes / self.images / 1024:.0f} KB/image, {ENCODE_FORMAT.upper()})"
+
+encode_stats = EncodeStats()
+
+def encode_ladder() -> List[int]:
+    """Sizes a sort run tries, smallest first; [max_side] when the ladder is off."""
+    return list(ENCODE_LADDER) or [ENCODE_MAX_SIDE]
+
+class ResolutionStats:
+    """Images settled at each ladder tier and the vision tokens spent on them, for the run summary."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.settled: Dict[int, int] = {}   # side -> images whose final answer came at that size
+            self.resent = 0
+            self.tokens = 0
+
+    def sent(self, info: Dict, resend: bool = False):
+        with self._lock:
+            if "size" in info: self.tokens += image_vision_tokens(info["size"])
+            if resend: self.resent += 1
+
+    def settle(self, side: int):
+        with self._lock: self.settled[side] = self.settled.get(side, 0) + 1
+
+    def summary_line(self) -> Optional[str]:
+        with self._lock:
+            n = sum(self.settled.values())
+            if not n: return None
+            tiers = ", ".join(f"{c} at {side}px" for side, c in sorted(self.settled.items()))
+            return (f"Resolution: {tiers}; {self.resent} re-sent larger, "
+                    f"{self.tokens / n:.0f} vision tokens/image (~{estimate_vision_tokens(encode_ladder()[-1])} max)")
+
+resolution_stats = ResolutionStats()
+
+_decode_pool: Optional[decode_pool.DecodePool] = None
+_decode_pool_lock = threading.Lock()
+
+def get_decode_pool() -> Optional[decode_pool.DecodePool]:
+    global _decode_pool
+    if DECODE_PROCESSES <= 0: return None
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = decode_pool.DecodePool(DECODE_PROCESSES, DECODE_MEMORY_MB,
+                                                  DECODE_MAX_MEGAPIXELS * 1000000, DECODE_TIMEOUT_S)
+        return _decode_pool
+
+def close_decode_pool():
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is not None: _decode_pool.close()
+        _decode_pool = None
+
+atexit.register(close_decode_pool)
+
+def encode_image_bytes(path: str, max_side: Optional[int] = None, fmt: Optional[str] = None, quality: Optional[int] = None,
+                       info: Optional[Dict] = None) -> bytes:
+    """
+    Decodes, orients and downsizes an image (in a decode worker unless [decode] processes = 0);
+    returns the compressed bytes. info, when given, receives the file's longest side and the
+    sent size ("original_side", "size").
+    """
+    max_side = max_side or ENCODE_MAX_SIDE
+    fmt = fmt or ENCODE_FORMAT
+    quality = quality or ENCODE_QUALITY
+    pool = get_decode_pool()
+    if pool is not None: data, meta = pool.encode(path, max_side, fmt, quality)
+    else: data, meta = decode_pool.encode(path, max_side, fmt, quality, DECODE_MAX_MEGAPIXELS * 1000000)
+    stage_metrics.observe("decode", meta["decode_s"])
+    stage_metrics.observe("encode", meta["encode_s"])
+    if info is not None:
+        info["original_side"] = meta["original_side"]
+        info["size"] = tuple(meta["size"])
+    return data
+
+def decode_thumbnail(path: str, side: int, fmt: str, quality: int) -> bytes:
+    """Preview bytes for the thumbnail cache, decoded like encode_image_bytes() (worker, pixel limit)."""
+    pool = get_decode_pool()
+    if pool is not None: return pool.thumbnail(path, side, fmt, quality)[0]
+    return decode_pool.thumbnail(path, side, fmt, quality, DECODE_MAX_MEGAPIXELS * 1000000)[0]
+
+def decode_gray(path: str, size: Tuple[int, int]) -> bytes:
+    """Grey pixels for near-duplicate hashing, decoded like encode_image_bytes() (worker, pixel limit)."""
+    pool = get_decode_pool()
+    if pool is not None: return pool.gray(path, size)[0]
+    return decode_pool.gray(path, size, DECODE_MAX_MEGAPIXELS * 1000000)[0]
+
+def encode_image(path: str, max_side: Optional[int] = None, info: Optional[Dict] = None) -> str:
     try:
-        with Image.open(path) as img:
-            img = img.convert('RGB')
-            # Resize for speed/memory but keep high enough for detail
-            # Qwen models handle up to 1000-1500 well.
-            if max(img.size) > 1500:
-                img.thumbnail((1500, 1500), Image.Resampling.LANCZOS)
-            img.save(temp_png_path, format="PNG")
-        with open(temp_png_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("utf-8")
-        return f"data:image/png;base64,{b64}"
+        data = encode_image_bytes(path, max_side, info=info)
+        encode_stats.add(len(data))
+        b64 = base64.b64encode(memoryview(data)).decode("ascii")
+        return f"data:{IMAGE_MIME.get(ENCODE_FORMAT, 'image/jpeg')};base64,{b64}"
     except Exception as e:
         print(f"[WARN] Image conversion failed: {e}")
         return ""
-    finally:
-        if os.path.exists(temp_png_path): 
-            try: os.remove(temp_png_path)
-            except: pass
 
-def move_file_unique(src: str, dst_dir: str) -> str:
-    os.makedirs(dst_dir, exist_ok=True)
-    base = os.path.basename(src)
-    name, ext = os.path.splitext(base)
-    dest = os.path.join(dst_dir, base)
-    c = 1
-    while os.path.exists(dest):
-        dest = os.path.join(dst_dir, f"{name}_{c}{ext}")
-        c += 1
-    shutil.move(src, dest)
-    return dest
+def move_file_unique(src: str, dst_dir: str, planner: Optional[mover.MovePlanner] = None) -> str:
+    """Moves src into dst_dir under a free name; pass one planner for many moves to keep the name index."""
+    return (planner or mover.MovePlanner()).move(src, dst_dir)
+
+def rule_folders(folder: str, rules: List[Dict]) -> List[str]:
+    """Destination folders of a sort run; they live inside the source folder and are not re-scanned."""
+    return [os.path.join(folder, r["folder_name"]) for r in rules]
+
+def new_move_planner(folder: str, dry_run: bool = False) -> mover.MovePlanner:
+    path = None
+    if JOURNAL_DIR:
+        run_log.prune_dir(JOURNAL_DIR, JOURNAL_KEEP - 1, ".jsonl")
+        # Milliseconds keep a dry run and the real run right after it in separate journals.
+        now = time.time()
+        path = os.path.join(JOURNAL_DIR, f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(now))}_{int(now * 1000) % 1000:03d}_sort.jsonl")
+    try: return mover.MovePlanner(path, dry_run, {"folder": folder})
+    except OSError as e:
+        print(f"[WARN] Move journal unavailable: {e}")
+        return mover.MovePlanner(None, dry_run)
+
+def last_undoable_journal() -> Optional[str]:
+    if not JOURNAL_DIR or not os.path.isdir(JOURNAL_DIR): return None
+    for name in sorted((f for f in os.listdir(JOURNAL_DIR) if f.endswith(".jsonl")), reverse=True):
+        path = os.path.join(JOURNAL_DIR, name)
+        try:
+            entries = mover.read_journal(path)
+            # A run whose folder is gone (e.g. a deleted scratch folder) cannot be undone; look further back.
+            folder = entries[0].get("folder") if entries else None
+            if folder and not os.path.isdir(folder): continue
+            if mover.journal_state(entries) == "undoable": return path
+        except OSError: pass
+    return None
+
+def undo_last_sort() -> str:
+    """Moves the files of the most recent (not yet undone) sort run back to where they were."""
+    path = last_undoable_journal()
+    if not path: return "Nothing to undo."
+    folder = mover.read_journal(path)[0].get("folder", "?")
+    restored, problems = mover.undo(path)
+    lines = [f"Undo of the sort run in {folder}:", f"Restored: {restored} files"]
+    if problems:
+        lines.append(f"Not restored: {len(problems)}")
+        lines.extend(f"  {p}" for p in problems[:50])
+        if len(problems) > 50: lines.append(f"  ... see {path}")
+    lines.append(f"Journal: {path}")
+    return "\n".join(lines)
 
 def clean_json_response(txt: str) -> str:
     """Attempts to extract JSON from markdown code blocks or messy text."""
@@ -313,9 +937,69 @@ def clean_json_response(txt: str) -> str:
     except: pass
     return txt
 
+def clean_json_array(txt: str) -> str:
+    """Like clean_json_response, for answers that should be a JSON list."""
+    try:
+        match = re.search(r"```json\s*(.*?)\s*```", txt, re.DOTALL)
+        if match: txt = match.group(1)
+        start, end = txt.find("["), txt.rfind("]")
+        if start != -1 and end != -1:
+            return txt[start:end+1]
+    except: pass
+    return txt
+
+def parse_json(txt: str, array: bool = False):
+    """clean_json_response/clean_json_array + json.loads, timed as the "parse" stage."""
+    with stage_metrics.timer("parse"):
+        return json.loads(clean_json_array(txt) if array else clean_json_response(txt))
+
+def hash_file(cache: Optional[analysis_cache.AnalysisCache], path: str) -> str:
+    with stage_metrics.timer("hash"):
+        return cache.content_hash(path) if cache is not None else analysis_cache.file_digest(path)
+
 # -------------------- AI LOGIC (PRECISION CHAIN OF THOUGHT) --------------------
 
-def make_api_call(messages, max_tokens=512):
+class RequestStats:
+    """Per-mode request accounting (images, generated tokens, wall time) for run summaries."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.modes: Dict[str, Dict[str, float]] = {}
+
+    def add(self, label: str, images: int, seconds: float, completion_tokens: int, timing: Optional[Dict] = None):
+        with self._lock:
+            m = self.modes.setdefault(label, {"requests": 0, "images": 0, "seconds": 0.0, "tokens": 0,
+                                              "timed": 0, "prefill": 0.0, "prompt_tokens": 0, "cached": 0})
+            m["requests"] += 1
+            m["images"] += images
+            m["seconds"] += seconds
+            m["tokens"] += completion_tokens
+            if timing and timing.get("seconds") is not None:
+                m["timed"] += 1
+                m["prefill"] += timing["seconds"]
+                m["prompt_tokens"] += timing.get("tokens") or 0
+                m["cached"] += timing.get("cached") or 0
+
+    def summary_lines(self) -> List[str]:
+        with self._lock:
+            out = []
+            for label, m in self.modes.items():
+                n = max(1, m["images"])
+                line = (f"Mode {label}: {m['images']} images in {m['requests']} requests, "
+                        f"{m['tokens'] / n:.1f} tokens/image, {m['seconds'] / n:.2f} s/image")
+                if m["timed"]:
+                    line += f", prefill {m['prefill'] / m['timed'] * 1000:.0f} ms/request"
+                    if m["prompt_tokens"]: line += f" ({m['cached'] / m['prompt_tokens']:.0%} of prompt tokens cached)"
+                out.append(line)
+            return out
+
+request_stats = RequestStats()
+
+def make_api_request(messages, max_tokens=512, timeout=120, label: Optional[str] = None, images: int = 1, extra: Optional[Dict] = None) -> Dict:
+    """Posts a chat completion and returns the whole response (choices, finish_reason, usage)."""
     payload = {
         "model": OPENAI_MODEL_NAME,
         "messages": messages,
@@ -323,174 +1007,1203 @@ def make_api_call(messages, max_tokens=512):
         "temperature": 0.2, # Slight creativity allowed for description, but low for logic
         "top_p": 0.95
     }
-    resp = requests.post(f"{API_BASE_URL}/v1/chat/completions", json=payload, timeout=120)
-    resp.raise_for_status()
-    return resp.json()["choices"][0]["message"]["content"]
+    if extra: payload.update(extra)
+    body = json.dumps(payload).encode("utf-8")
+    stage_metrics.incr("requests")
+    stage_metrics.incr("bytes_sent", len(body))
+    t0 = time.time()
+    try:
+        with stage_metrics.timer("request"):
+            if endpoint_pool is not None: data = _post_pooled(payload, body, timeout, images)
+            else:
+                resp = _http.post(f"{API_BASE_URL}/v1/chat/completions", data=body,
+                                  headers={"Content-Type": "application/json"}, timeout=timeout)
+                resp.raise_for_status()
+                data = resp.json()
+    except Exception:
+        stage_metrics.incr("errors")
+        raise
+    usage = data.get("usage") or {}
+    stage_metrics.incr("tokens_in", usage.get("prompt_tokens") or 0)
+    stage_metrics.incr("tokens_out", usage.get("completion_tokens") or 0)
+    timing = prompts.prompt_timing(data) or _kobold_prefill()
+    if timing:
+        if timing["seconds"] is not None: stage_metrics.observe("prefill", timing["seconds"])
+        stage_metrics.incr("tokens_cached", timing.get("cached") or 0)
+    if label:
+        tokens = usage.get("completion_tokens")
+        if tokens is None:
+            # Engine did not report usage: rough estimate from the answer length.
+            try: tokens = len(data["choices"][0]["message"]["content"]) // 4
+            except Exception: tokens = 0
+        request_stats.add(label, images, time.time() - t0, int(tokens), timing)
+    return data
 
-def analyze_image_chain_of_thought(image_path: str, categories: List[Dict]) -> Optional[Dict]:
+def _kobold_prefill() -> Optional[Dict]:
+    """
+    Prompt processing time of the last request from koboldcpp's /api/extra/perf. Only
+    meaningful when nothing else runs on the engine: our own local engine with one slot.
+    """
+    if not ENGINE_PERF_PROBE or ENGINE_EXTERNAL_URL or endpoint_pool is not None or PARALLEL_REQUESTS > 1: return None
+    try:
+        perf = _http.get(f"{API_BASE_URL}/api/extra/perf", timeout=2).json()
+        return {"seconds": float(perf["last_process"]), "tokens": perf.get("last_input_count"), "cached": None}
+    except Exception:
+        return None
+
+def _post_pooled(payload: Dict, body: bytes, timeout: int, images: int) -> Dict:
+    """Sends the request to the least busy endpoint; connection errors and 5xx are retried on another one."""
+    tried: List[engine_pool.Endpoint] = []
+    last_error: Optional[Exception] = None
+    while True:
+        try: ep = endpoint_pool.acquire(tried)
+        except RuntimeError:
+            if last_error is not None: raise last_error
+            raise
+        if ep.model_name and ep.model_name != payload.get("model"):
+            data = json.dumps(dict(payload, model=ep.model_name)).encode("utf-8")
+        else: data = body
+        t0 = time.perf_counter()
+        try:
+            resp = _http.post(f"{ep.base_url}/v1/chat/completions", data=data,
+                              headers={"Content-Type": "application/json"}, timeout=timeout)
+            if resp.status_code >= 500: resp.raise_for_status()
+        except Exception as e:
+            endpoint_pool.release(ep, time.perf_counter() - t0, images, error=e)
+            tried.append(ep)
+            last_error = e
+            stage_metrics.incr("retries")
+            continue
+        endpoint_pool.release(ep, time.perf_counter() - t0, images)
+        # A 4xx is about the request itself; another endpoint would refuse it as well.
+        resp.raise_for_status()
+        return resp.json()
+
+def request_summary_lines() -> List[str]:
+    lines = request_stats.summary_lines()
+    if endpoint_pool is not None: lines.extend(endpoint_pool.summary_lines())
+    return lines
+
+def make_api_call(messages, max_tokens=512, label: Optional[str] = None, images: int = 1):
+    return make_api_request(messages, max_tokens, label=label, images=images)["choices"][0]["message"]["content"]
+
+# Bump when the prompt or response format changes so stale cache rows are ignored.
+PROMPT_VERSION = "cot-v3"
+
+def get_analysis_cache() -> Optional[analysis_cache.AnalysisCache]:
+    global _analysis_cache
+    if not CACHE_ENABLED: return None
+    if _analysis_cache is None or _analysis_cache.path != CACHE_PATH:
+        if _analysis_cache is not None: _analysis_cache.close()
+        try: _analysis_cache = analysis_cache.AnalysisCache(CACHE_PATH, CACHE_MAX_SIZE_MB)
+        except Exception as e:
+            print(f"[WARN] Analysis cache unavailable: {e}")
+            return None
+    return _analysis_cache
+
+def close_analysis_cache():
+    global _analysis_cache
+    if _analysis_cache is not None: _analysis_cache.close()
+    _analysis_cache = None
+
+atexit.register(close_analysis_cache)
+
+def request_image_analysis(image_path: str, categories: List[Dict], img_url: Optional[str] = None,
+                           template: Optional[prompts.PromptTemplate] = None) -> Optional[Dict]:
     """
     High-Precision Mode:
-    1. Encodes Image.
+    1. Encodes Image (unless the pipeline already did).
     2. Asks model to DESCRIBE the image first (Grounding), THEN matches against categories.
-    3. Returns the matched category object or None.
+    3. Returns the raw model answer (description, reasoning, selected_id) or None on failure.
     """
     start_koboldcpp_if_needed()
-    img_url = encode_image(image_path)
+    if img_url is None: img_url = encode_image(image_path)
     if not img_url: return None
 
-    # Construct the Category List for the Prompt
-    cat_list_str = "\n".join([f"- ID '{c['id']}': {c['prompt']}" for c in categories])
-    
     # --- CHAIN OF THOUGHT PROMPT ---
     # We combine description + classification in one prompt to handle the image once.
     # This is much more accurate than asking "Is this Jinx?" directly.
+    # The text part is the run's static prefix (see prompts.py); only the image differs per request.
+    if template is None: template = prompts.compile_template(categories)
+
+    try:
+        # Call the model
+        response_txt = make_api_call(template.messages("precise", [img_url]), label="precise")
+        
+        # Parse Result
+        data = parse_json(response_txt)
+        
+        # Optional: Log the reasoning (can be printed to console for debug)
+        # print(f"DEBUG: {data.get('description')} | {data.get('reasoning')}")
+        
+        return normalize_result(data)
+
+    except Exception as e:
+        print(f"[AI Error] {e}")
+        return None
+
+def normalize_result(data) -> Optional[Dict]:
+    if not isinstance(data, dict): return None
+    return {
+        "description": str(data.get("description", "")),
+        "reasoning": str(data.get("reasoning", "")),
+        "selected_id": str(data.get("selected_id", "none")).strip().strip("'\"").lower(),
+        "confidence": str(data.get("confidence", "")).strip().lower(),
+    }
+
+# -------------------- AI LOGIC (BATCHED) --------------------
+
+def estimate_vision_tokens(max_side: int) -> int:
+    # Qwen-VL: one token per 28x28 pixel patch after merging; assume a square worst case.
+    return (max_side // 28 + 1) ** 2
+
+def image_vision_tokens(size: Tuple[int, int]) -> int:
+    """Vision tokens of an image actually sent (same 28x28 patch rule, real aspect ratio)."""
+    return (-(-size[0] // 28)) * (-(-size[1] // 28))
+
+def effective_batch_size(categories: List[Dict]) -> int:
+    """BATCH_SIZE clamped so K images, the prompt and K answers fit in --contextsize."""
+    if BATCH_SIZE <= 1: return 1
+    prompt_tokens = 400 + sum(len(c["prompt"]) for c in categories) // 3 + 12 * len(categories)
+    per_image = estimate_vision_tokens(ENCODE_MAX_SIDE) + BATCH_TOKENS_PER_IMAGE + 8
+    fits = (ENGINE_CONTEXT_SIZE - prompt_tokens) // per_image
+    return max(1, min(BATCH_SIZE, fits))
+
+def request_batch_analysis(image_paths: List[str], categories: List[Dict], img_urls: List[str],
+                           template: Optional[prompts.PromptTemplate] = None) -> List[Optional[Dict]]:
+    """
+    Classifies several images in one chat request. Each image part is preceded by an
+    "Image k" label and the model answers with one JSON object per image. Images whose
+    answer is missing, malformed or cut off are re-sent as single-image requests.
+    """
+    n = len(image_paths)
+    results: List[Optional[Dict]] = [None] * n
+    start_koboldcpp_if_needed()
+
+    if template is None: template = prompts.compile_template(categories)
+
+    try:
+        resp = make_api_request(template.messages("batch", img_urls), max_tokens=BATCH_TOKENS_PER_IMAGE * n + 32, timeout=120 + 30 * n, label="precise (batched)", images=n)
+        choice = resp["choices"][0]
+        if choice.get("finish_reason") == "length":
+            print(f"[AI Batch] Output truncated for {n} images, falling back to single requests.")
+        else:
+            data = parse_json(choice["message"]["content"], array=True)
+            if isinstance(data, list):
+                # Prefer the explicit index; fall back to position only when the count matches.
+                for pos, entry in enumerate(data):
+                    if not isinstance(entry, dict): continue
+                    try: idx = int(entry.get("image")) - 1
+                    except (TypeError, ValueError): idx = pos if len(data) == n else -1
+                    if 0 <= idx < n and results[idx] is None: results[idx] = normalize_result(entry)
+    except Exception as e:
+        print(f"[AI Batch Error] {e}")
+
+    for i in range(n):
+        if results[i] is None:
+            results[i] = request_image_analysis(image_paths[i], categories, img_urls[i], template)
+    return results
+
+# -------------------- AI LOGIC (MULTI-LABEL) --------------------
+
+MULTI_PROMPT_VERSION = "multi-v1"
+
+def request_multi_label(image_path: str, categories: List[Dict], img_url: Optional[str] = None,
+                        template: Optional[prompts.PromptTemplate] = None) -> Optional[Dict]:
+    """
+    Multi-label Mode (multi-query search): one grounded description, then an independent
+    yes/no per category. Returns the answer with every matching ID in "selected_ids".
+    """
+    start_koboldcpp_if_needed()
+    if img_url is None: img_url = encode_image(image_path)
+    if not img_url: return None
+    if template is None: template = prompts.compile_template(categories)
+    ids = {str(c["id"]).lower() for c in categories}
+
+    try:
+        response_txt = make_api_call(template.messages("multi", [img_url]), max_tokens=256 + 8 * len(categories), label="multi-label")
+        data = parse_json(response_txt)
+        if not isinstance(data, dict): return None
+        picked = data.get("selected_ids", [])
+        if isinstance(picked, str): picked = [picked]
+        selected = []
+        for i in picked if isinstance(picked, list) else []:
+            i = str(i).strip().strip("'\"").lower()
+            if i in ids and i not in selected: selected.append(i)
+        return {"description": str(data.get("description", "")), "reasoning": "",
+                "selected_id": selected[0] if selected else "none", "selected_ids": selected}
+    except Exception as e:
+        print(f"[AI Multi Error] {e}")
+        return None
+
+# -------------------- AI LOGIC (FAST, CONSTRAINED ID-ONLY) --------------------
+
+FAST_PROMPT_VERSION = "fast-v2"
+
+def _gbnf_literal(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def build_id_grammar(ids: List[str]) -> str:
+    """GBNF that only admits {"selected_id": "<one of ids>"}."""
+    alts = " | ".join(_gbnf_literal(i) for i in ids)
+    return f'root ::= "{{\\"selected_id\\": \\"" id "\\"}}"\nid ::= {alts}\n'
+
+def build_id_schema(ids: List[str]) -> Dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "category",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"selected_id": {"type": "string", "enum": ids}},
+                "required": ["selected_id"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def request_fast_classification(image_path: str, categories: List[Dict], img_url: Optional[str] = None,
+                                template: Optional[prompts.PromptTemplate] = None) -> Optional[Dict]:
+    """
+    Fast Mode: no description or reasoning. The output is constrained (GBNF grammar or
+    JSON schema) to one of the category IDs or 'none', so a handful of tokens suffice.
+    """
+    start_koboldcpp_if_needed()
+    if img_url is None: img_url = encode_image(image_path)
+    if not img_url: return None
+
+    ids = [str(c["id"]).lower() for c in categories] + ["none"]
+    if template is None: template = prompts.compile_template(categories)
+    extra = {}
+    if FAST_CONSTRAINT == "grammar": extra["grammar"] = build_id_grammar(ids)
+    elif FAST_CONSTRAINT == "json_schema": extra["response_format"] = build_id_schema(ids)
+
+    try:
+        resp = make_api_request(template.messages("fast", [img_url]), max_tokens=FAST_MAX_TOKENS, label="fast", extra=extra)
+        txt = resp["choices"][0]["message"]["content"]
+        try: sid = str(parse_json(txt).get("selected_id", "none"))
+        except Exception:
+            # Unconstrained engines may answer with a bare ID.
+            sid = txt.strip().strip('"\'` ')
+        sid = sid.strip().strip("'\"").lower()
+        if sid not in ids:
+            print(f"[AI Fast] Unexpected answer: {txt!r}")
+            return None
+        return {"description": "", "reasoning": "", "selected_id": sid}
+    except Exception as e:
+        print(f"[AI Fast Error] {e}")
+        return None
+
+def match_category(result: Optional[Dict], categories: List[Dict]) -> Optional[Dict]:
+    if not result: return None
+    selected_id = str(result.get("selected_id", "none")).lower()
     
-    system_prompt = (
-        "You are a precise visual data sorter. Your job is to analyze an image and match it to a specific category."
-    )
+    # Logic Check
+    if selected_id == "none":
+        return None
+    return next((c for c in categories if str(c["id"]) == selected_id), None)
 
+def analysis_rules_key(categories: List[Dict], mode: str) -> str:
+    version = {"fast": FAST_PROMPT_VERSION, "multi": MULTI_PROMPT_VERSION}.get(mode, PROMPT_VERSION)
+    return analysis_cache.ruleset_digest(categories, version)
+
+def make_analysis_stages(categories: List[Dict], mode: str = "precise", sides: Optional[List[int]] = None):
+    """
+    Returns the (prepare, infer, infer_batch) pipeline stages for analyzing images against categories.
+    mode is "precise" (describe + reason, batchable), "fast" (constrained ID only) or "multi"
+    (every matching ID, for multi-query search); infer_batch is None for the last two.
+    sides is the resolution ladder (default: encode_ladder()); unclear answers climb to the next size.
+    """
+    cache = get_analysis_cache()
+    model_key = current_model_key()
+    rules_key = analysis_rules_key(categories, mode)
+    request_one = {"fast": request_fast_classification, "multi": request_multi_label}.get(mode, request_image_analysis)
+    template = prompts.compile_template(categories)  # one prefix string for every request of the run
+    ladder = sides or encode_ladder()
+
+    def prepare(image_path: str):
+        if not os.path.exists(image_path): return "skip", None
+        key = None
+        if cache is not None:
+            try:
+                key = (hash_file(cache, image_path), model_key, rules_key)
+                cached = cache.get(*key)
+                if cached is not None: return "done", cached
+            except Exception as e:
+                print(f"[WARN] Cache lookup failed: {e}")
+                key = None
+        info: Dict = {}
+        img_url = encode_image(image_path, ladder[0], info)
+        if not img_url: return "done", None
+        resolution_stats.sent(info)
+        return "infer", (key, img_url, info.get("original_side", 0))
+
+    def store(key, result):
+        # Only successful answers are cached; failures are retried on the next run.
+        if result is not None and key is not None:
+            try:
+                cache.put(*key, result)
+                # Rules-independent copy for re-classifying from text later.
+                cache.put_description(key[0], model_key, result.get("description", ""))
+            except Exception as e: print(f"[WARN] Cache write failed: {e}")
+
+    def climb(image_path: str, result: Optional[Dict], original_side: int) -> Optional[Dict]:
+        """Re-asks at the next ladder sizes while the answer is unclear and a larger image has more to show."""
+        side = ladder[0]
+        for nxt in ladder[1:]:
+            if original_side <= side or not escalation_reason(result, match_category(result, categories), LADDER_ESCALATE_ON): break
+            info: Dict = {}
+            img_url = encode_image(image_path, nxt, info)
+            if not img_url: break
+            resolution_stats.sent(info, resend=True)
+            side = nxt
+            result = request_one(image_path, categories, img_url, template)
+        resolution_stats.settle(side)
+        return result
+
+    def infer(image_path: str, payload):
+        key, img_url, original_side = payload
+        result = climb(image_path, request_one(image_path, categories, img_url, template), original_side)
+        store(key, result)
+        return result
+
+    def infer_batch(image_paths: List[str], payloads: List):
+        results = request_batch_analysis(image_paths, categories, [url for _, url, _ in payloads], template)
+        results = [climb(p, r, side) for p, r, (_, _, side) in zip(image_paths, results, payloads)]
+        for (key, _, _), result in zip(payloads, results): store(key, result)
+        return results
+
+    return prepare, infer, (None if mode in ("fast", "multi") else infer_batch)
+
+def analyze_image_raw(image_path: str, categories: List[Dict]) -> Optional[Dict]:
+    """Returns the raw model answer for an image, served from the analysis cache when possible."""
+    prepare, infer, _ = make_analysis_stages(categories)
+    kind, value = prepare(image_path)
+    if kind == "infer": return infer(image_path, value)
+    return value
+
+def analyze_image_chain_of_thought(image_path: str, categories: List[Dict]) -> Optional[Dict]:
+    """Returns the matched category object or None."""
+    return match_category(analyze_image_raw(image_path, categories), categories)
+
+def cache_summary_line() -> Optional[str]:
+    cache = get_analysis_cache()
+    if cache is None: return None
+    return f"Cache: {cache.hits} hits / {cache.misses} misses"
+
+# -------------------- AI LOGIC (RE-CLASSIFY FROM DESCRIPTIONS) --------------------
+
+RECLASSIFY_VERSION = "text-v2"
+
+def request_text_classification(descriptions: List[str], categories: List[Dict]) -> List[Optional[Dict]]:
+    """
+    Text-only classification of stored image descriptions against the categories.
+    Returns one answer per description (None when missing), with a high/low confidence.
+    """
+    n = len(descriptions)
+    results: List[Optional[Dict]] = [None] * n
+    start_koboldcpp_if_needed()
+
+    cat_list_str = "\n".join([f"- ID '{c['id']}': {c['prompt']}" for c in categories])
+    items_str = "\n".join(f"[{i}] {d}" for i, d in enumerate(descriptions))
     user_content = f"""
     <instructions>
-    1. First, describe the main subject of the image in detail. 
-       - If it is a character, describe their hair color, clothes, and distinctive features (tattoos, weapons, etc).
-    2. Then, compare your description to the list of Target Categories below.
-    3. If a prompt is a specific name (e.g. "Jinx", "Goku"), use your knowledge to identify if the character matches that name.
-    4. Select the best matching ID. If the image does not fit any category confidently, select 'none'.
+    Each item at the end is the description of an image. For EACH item, select the best matching ID from the Target Categories.
+    If a prompt is a specific name (e.g. "Jinx", "Goku"), use your knowledge to decide whether the described character matches.
+    If the item does not fit any category, select 'none'.
+    Set "confidence" to "low" when the description lacks the detail needed to decide.
     </instructions>
 
     <target_categories>
     {cat_list_str}
     </target_categories>
 
-    Response Format (JSON Only):
-    {{
-        "description": "Brief description of what you see...",
-        "reasoning": "Why it matches or does not match...",
-        "selected_id": "ID_OR_NONE"
-    }}
+    Response Format (JSON array only, one entry per item):
+    [
+        {{"item": 0, "selected_id": "ID_OR_NONE", "confidence": "high"}}
+    ]
+
+    <items>
+    {items_str}
+    </items>
+    """
+    try:
+        resp = make_api_request([
+            {"role": "system", "content": "You are a precise data sorter working from image descriptions."},
+            {"role": "user", "content": user_content}
+        ], max_tokens=24 * n + 32, label="text", images=n)
+        choice = resp["choices"][0]
+        data = parse_json(choice["message"]["content"], array=True)
+        if isinstance(data, list):
+            for pos, entry in enumerate(data):
+                if not isinstance(entry, dict): continue
+                try: idx = int(entry.get("item"))
+                except (TypeError, ValueError): idx = pos if len(data) == n else -1
+                if 0 <= idx < n and results[idx] is None:
+                    r = normalize_result(dict(entry, description=descriptions[idx], reasoning="classified from stored description"))
+                    r["confidence"] = str(entry.get("confidence", "low")).lower()
+                    results[idx] = r
+    except Exception as e:
+        print(f"[AI Text Error] {e}")
+    return results
+
+class ReclassifyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"cached": 0, "text": 0, "escalated": 0, "image": 0}
+
+    def add(self, key: str):
+        with self._lock: self.counts[key] += 1
+
+    def summary_line(self) -> str:
+        c = self.counts
+        return (f"Re-classify: {c['text']} from descriptions, {c['escalated']} escalated to image analysis, "
+                f"{c['image']} without description, {c['cached']} cached")
+
+class DuplicateStats:
+    def __init__(self, groups: Dict[str, List[str]], members: Dict[str, List[str]], spot_of: Dict[str, str]):
+        self.groups = sum(1 for g in groups.values() if g)
+        self.copied = sum(len(m) for m in members.values())
+        self.spot_of = spot_of
+        self.folders: Dict[str, Optional[str]] = {}  # analyzed image -> folder (None = no match)
+
+    def summary_line(self) -> str:
+        line = (f"Near-duplicates: {self.copied} images in {self.groups} groups reused their representative's result "
+                f"({self.copied} model calls saved)")
+        checked = [(m, r) for m, r in self.spot_of.items() if m in self.folders and r in self.folders]
+        if checked:
+            agree = sum(1 for m, r in checked if self.folders[m] == self.folders[r])
+            line += f", spot checks: {agree}/{len(checked)} agreed"
+        return line
+
+def cached_images(images: List[str], categories: List[Dict], mode: str, model_pair: Optional[Tuple[str, str]] = None) -> set:
+    """The images whose answer for (model, rules, mode) is already in the analysis cache."""
+    cache = get_analysis_cache()
+    if cache is None: return set()
+    model_key = analysis_cache.model_digest(*model_pair) if model_pair else current_model_key()
+    rules_key = analysis_rules_key(categories, mode)
+    hits = set()
+    for p in images:
+        try:
+            if cache.get(hash_file(cache, p), model_key, rules_key, count=False) is not None: hits.add(p)
+        except Exception: pass  # unreadable here means unreadable in the run too
+    return hits
+
+def plan_near_duplicates(images: List[str], categories: List[Dict], mode: str, model_pair: Optional[Tuple[str, str]] = None):
+    """
+    (items to analyze, {representative: members}, DuplicateStats) or None when nothing to group.
+    Images already answered in the cache cost no model call, so they are not hashed and stay on their own.
+    """
+    if not DEDUP_ENABLED or len(images) < 2: return None
+    if not dedup.available():
+        print("[WARN] numpy not installed, near-duplicate grouping disabled.")
+        return None
+    with stage_metrics.timer("dedup"):
+        cached = cached_images(images, categories, mode, model_pair)
+        todo = [p for p in images if p not in cached]
+        if len(todo) < 2: return None
+        hashes = dedup.compute_hashes(todo, DEDUP_HASH, PREFETCH_WORKERS, load=decode_gray)
+        groups = dedup.group_near_duplicates(images, hashes, DEDUP_MAX_DISTANCE)
+    if len(groups) == len(images): return None
+    items, members, spot_of = dedup.plan(groups, DEDUP_SPOT_CHECK)
+    return items, members, DuplicateStats(groups, members, spot_of)
+
+class CascadeStats:
+    def __init__(self):
+        self.tiers: List[Dict] = []  # {"label", "images", "seconds", "escalated": {reason: n}}
+
+    def begin(self, label: str, count: int):
+        self.tiers.append({"label": label, "images": count, "seconds": 0.0, "escalated": {}})
+
+    def escalate(self, reason: str):
+        esc = self.tiers[-1]["escalated"]
+        esc[reason] = esc.get(reason, 0) + 1
+
+    def summary_lines(self) -> List[str]:
+        lines = []
+        for n, t in enumerate(self.tiers, 1):
+            line = f"Cascade tier {n} ({t['label']}): {t['images']} images in {t['seconds']:.1f}s"
+            if t["escalated"]:
+                reasons = ", ".join(f"{v} {k.replace('_', ' ')}" for k, v in t["escalated"].items())
+                line += f", {sum(t['escalated'].values())} escalated ({reasons})"
+            lines.append(line)
+        return lines
+
+def escalation_reason(result: Optional[Dict], match: Optional[Dict], on: Optional[Tuple[str, ...]] = None) -> Optional[str]:
+    """Why an answer should be re-asked (large model, larger image); None = keep it. on defaults to CASCADE_ESCALATE_ON."""
+    if result is None: reason = "error"
+    elif match is None: reason = "none"
+    elif result.get("confidence") == "low": reason = "low_confidence"
+    else: return None
+    return reason if reason in (CASCADE_ESCALATE_ON if on is None else on) else None
+
+def cascade_tiers(mode: str, log: "run_log.RunLog") -> List[Tuple[Optional[str], Optional[Tuple[str, str]], str]]:
+    """
+    [(label, (model, mmproj) or None for the configured model, analysis mode)] for a sort run.
+    Cascade needs both variants on disk and a local engine; otherwise it falls back to one precise pass.
+    """
+    if mode != "cascade": return [(None, None, mode)]
+    if ENGINE_EXTERNAL_URL or (endpoint_pool is not None and not all(ep.local for ep in endpoint_pool.endpoints)):
+        log.add("[WARN] Cascade needs local engines to switch models; running a single precise pass.")
+        return [(None, None, "precise")]
+    missing = [k for k in (CASCADE_SMALL, CASCADE_LARGE) if not check_model_variant_status(k)]
+    if missing:
+        log.add(f"[WARN] Cascade model(s) not downloaded: {', '.join(MODEL_VARIANTS[k]['label'] for k in missing)}; running a single precise pass.")
+        return [(None, None, "precise")]
+    def pair(key: str):
+        v = MODEL_VARIANTS[key]
+        return os.path.join(MODELS_DIR, v["main"]["filename"]), os.path.join(MODELS_DIR, v["mmproj"]["filename"])
+    return [(MODEL_VARIANTS[CASCADE_SMALL]["label"], pair(CASCADE_SMALL), CASCADE_FIRST_MODE),
+            (MODEL_VARIANTS[CASCADE_LARGE]["label"], pair(CASCADE_LARGE), "precise")]
+
+def make_reclassify_stages(categories: List[Dict], stats: ReclassifyStats):
+    """
+    (prepare, infer, infer_batch) stages that classify from stored descriptions.
+    Images without a description, and ambiguous text answers, get a full image analysis.
     """
+    cache = get_analysis_cache()
+    index = get_caption_index()
+    model_key = current_model_key()
+    image_key = analysis_cache.ruleset_digest(categories, PROMPT_VERSION)
+    text_key = analysis_cache.ruleset_digest(categories, RECLASSIFY_VERSION)
+    valid_ids = {str(c["id"]).lower() for c in categories} | {"none"}
 
+    def store(content_hash, rules_key, result):
+        if cache is not None and result is not None:
+            try: cache.put(content_hash, model_key, rules_key, result)
+            except Exception as e: print(f"[WARN] Cache write failed: {e}")
+
+    def prepare(image_path: str):
+        if not os.path.exists(image_path): return "skip", None
+        content_hash = hash_file(cache, image_path)
+        if cache is not None:
+            cached = cache.get(content_hash, model_key, image_key, count=False) or cache.get(content_hash, model_key, text_key, count=False)
+            cache.count(cached is not None)
+            if cached is not None:
+                stats.add("cached")
+                return "done", cached
+        # Search captions are the richest descriptions; sort descriptions are the fallback.
+        row = index.find_by_hash(content_hash)
+        desc = row[0] if row else (cache.get_description(content_hash) if cache is not None else None)
+        return "infer", (content_hash, desc)
+
+    def analyze_image(image_path: str, content_hash: str):
+        result = request_image_analysis(image_path, categories)
+        store(content_hash, image_key, result)
+        if cache is not None and result is not None:
+            cache.put_description(content_hash, model_key, result.get("description", ""))
+        return result
+
+    def infer_batch(image_paths: List[str], payloads: List):
+        results: List[Optional[Dict]] = [None] * len(image_paths)
+        texts = [i for i, (_, desc) in enumerate(payloads) if desc]
+        if texts:
+            answers = request_text_classification([payloads[i][1] for i in texts], categories)
+            for i, answer in zip(texts, answers):
+                if answer and answer["confidence"] == "high" and answer["selected_id"] in valid_ids:
+                    stats.add("text")
+                    store(payloads[i][0], text_key, answer)
+                    results[i] = answer
+        for i, (content_hash, desc) in enumerate(payloads):
+            if results[i] is None:
+                stats.add("escalated" if desc else "image")
+                results[i] = analyze_image(image_paths[i], content_hash)
+        return results
+
+    def infer(image_path: str, payload):
+        return infer_batch([image_path], [payload])[0]
+
+    return prepare, infer, infer_batch
+
+# -------------------- CAPTION INDEX --------------------
+
+CAPTION_VERSION = "caption-v1"
+
+def get_caption_index() -> caption_index.CaptionIndex:
+    global _caption_index
+    if _caption_index is None or _caption_index.path != INDEX_PATH:
+        if _caption_index is not None: _caption_index.close()
+        _caption_index = caption_index.CaptionIndex(INDEX_PATH)
+    return _caption_index
+
+def close_caption_index():
+    global _caption_index
+    if _caption_index is not None: _caption_index.close()
+    _caption_index = None
+
+atexit.register(close_caption_index)
+
+def request_image_caption(image_path: str, img_url: Optional[str] = None) -> Optional[Dict]:
+    """Asks the vision model for a searchable description and tags of one image."""
+    start_koboldcpp_if_needed()
+    if img_url is None: img_url = encode_image(image_path)
+    if not img_url: return None
+
+    system_prompt = "You are a precise image captioner building a search index."
+    user_content = """
+    <instructions>
+    Describe this image so it can be found later by a text search.
+    - Name the main subject(s). If you recognize a character or person, give their name.
+    - Mention actions, setting, dominant colors, and the style (photo, drawing, 3D render, screenshot, meme).
+    - Transcribe any short visible text.
+    Then list 10 to 20 short lowercase tags.
+    </instructions>
+
+    Response Format (JSON Only):
+    {
+        "description": "Detailed description...",
+        "tags": ["tag1", "tag2"]
+    }
+    """
     try:
-        # Call the model
         response_txt = make_api_call([
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": [
-                {"type": "text", "text": user_content}, 
+                {"type": "text", "text": user_content},
                 {"type": "image_url", "image_url": {"url": img_url}}
             ]}
-        ])
-        
-        # Parse Result
-        cleaned_json = clean_json_response(response_txt)
-        data = json.loads(cleaned_json)
-        
-        selected_id = str(data.get("selected_id", "none")).lower()
-        
-        # Logic Check
-        if selected_id == "none":
-            return None
-            
-        candidate = next((c for c in categories if str(c["id"]) == selected_id), None)
-        
-        # Optional: Log the reasoning (can be printed to console for debug)
-        # print(f"DEBUG: {data.get('description')} | {data.get('reasoning')}")
-        
-        return candidate
+        ], max_tokens=320, label="caption")
+        data = parse_json(response_txt)
+        if not isinstance(data, dict) or not data.get("description"): return None
+        tags = data.get("tags", [])
+        if isinstance(tags, str): tags = [t for t in tags.split(",")]
+        return {"description": str(data["description"]), "tags": [str(t).strip().lower() for t in tags if str(t).strip()]}
+    except Exception as e:
+        print(f"[AI Caption Error] {e}")
+        return None
+
+def make_caption_stages(index: caption_index.CaptionIndex):
+    """(prepare, infer, finish) stages that bring the caption index up to date for a list of images."""
+    cache = get_analysis_cache()
+    model_key = current_model_key()
+    rules_key = analysis_cache.ruleset_digest([], CAPTION_VERSION)
+
+    def prepare(image_path: str):
+        if not os.path.exists(image_path): return "skip", None
+        st = os.stat(image_path)
+        if index.is_fresh(image_path, st): return "done", {"source": "index"}
+        content_hash = hash_file(cache, image_path)
+        job = {"st": st, "hash": content_hash}
+        # Same bytes under another name (moved, copied, touched): reuse that caption.
+        row = index.find_by_hash(content_hash)
+        if row:
+            return "done", dict(job, source="reused", caption={"description": row[0], "tags": row[1]}, model_key=row[2])
+        if cache is not None:
+            cached = cache.get(content_hash, model_key, rules_key)
+            if cached is not None: return "done", dict(job, source="cache", caption=cached, model_key=model_key)
+        img_url = encode_image(image_path)
+        if not img_url: return "done", dict(job, source="failed")
+        return "infer", (job, img_url)
+
+    def infer(image_path: str, payload):
+        job, img_url = payload
+        caption = request_image_caption(image_path, img_url)
+        if caption is None: return dict(job, source="failed")
+        if cache is not None:
+            try:
+                cache.put(job["hash"], model_key, rules_key, caption)
+                cache.put_description(job["hash"], model_key, caption["description"])
+            except Exception as e: print(f"[WARN] Cache write failed: {e}")
+        return dict(job, source="model", caption=caption, model_key=model_key)
 
+    def finish(image_path: str, result):
+        # Single writer thread: all index writes happen here.
+        if not result: return "failed"
+        if result.get("caption"):
+            c = result["caption"]
+            index.upsert(image_path, result["st"], result["hash"], c.get("description", ""), c.get("tags", []), result["model_key"])
+        return result["source"]
+
+    return prepare, infer, finish
+
+def rerank_with_llm(query: str, candidates: List[Tuple[str, str]]) -> Optional[List[str]]:
+    """
+    Text-only re-rank: shows the model the captions of the best lexical candidates and
+    keeps the ones that really match the query. Returns None when the answer is unusable.
+    """
+    if not candidates: return []
+    start_koboldcpp_if_needed()
+    lines = "\n".join(f"[{i}] {desc}" for i, (_, desc) in enumerate(candidates))
+    user_content = f"""
+    <query>{query}</query>
+
+    <candidates>
+    {lines}
+    </candidates>
+
+    Each candidate is the description of an image. Select every candidate whose image matches the query,
+    best match first. Ignore candidates that only share a word with the query.
+
+    Response Format (JSON Only):
+    {{"matches": [0, 3]}}
+    """
+    try:
+        response_txt = make_api_call([
+            {"role": "system", "content": "You are a strict search relevance judge."},
+            {"role": "user", "content": user_content}
+        ], max_tokens=16 + 6 * len(candidates), label="rerank", images=0)
+        data = parse_json(response_txt)
+        picks = data.get("matches", []) if isinstance(data, dict) else data
+        out = []
+        for i in picks:
+            try: i = int(i)
+            except (TypeError, ValueError): continue
+            if 0 <= i < len(candidates) and candidates[i][0] not in out: out.append(candidates[i][0])
+        return out
     except Exception as e:
-        print(f"[AI Error] {e}")
+        print(f"[AI Rerank Error] {e}")
+        return None
+
+# -------------------- RUN METRICS --------------------
+
+def begin_run_metrics(kind: str, folder: str, **info):
+    stage_metrics.begin_run(kind=kind, folder=folder, started=time.strftime("%Y-%m-%d %H:%M:%S"), **info)
+    if endpoint_pool is not None: endpoint_pool.reset_stats()
+
+def finish_run_metrics() -> Optional[str]:
+    """Writes the run's metrics as JSON into METRICS_DIR (keeping the newest METRICS_KEEP_RUNS). Returns the path."""
+    if not METRICS_DIR: return None
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        kind = stage_metrics.run_info.get("kind", "run")
+        path = os.path.join(METRICS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{kind}.json")
+        if endpoint_pool is not None: stage_metrics.run_info["endpoints"] = endpoint_pool.snapshot()
+        stage_metrics.write_json(path)
+        run_log.prune_dir(METRICS_DIR, METRICS_KEEP_RUNS, ".json")
+        return path
+    except Exception as e:
+        print(f"[WARN] Could not write run metrics: {e}")
         return None
 
+def new_run_log(kind: str, header: List[str]) -> run_log.RunLog:
+    path = None
+    if LOG_DIR:
+        run_log.prune_dir(LOG_DIR, LOG_KEEP_FILES - 1, ".log")
+        path = os.path.join(LOG_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{kind}.log")
+    return run_log.RunLog(header, path, LOG_TAIL_LINES, LOG_UI_INTERVAL)
+
+def get_metrics_markdown() -> str:
+    return stage_metrics.summary_markdown()
+
+_metrics_server = None
+
+def start_metrics_endpoint() -> bool:
+    global _metrics_server
+    if not METRICS_PROMETHEUS_PORT or _metrics_server is not None: return False
+    _metrics_server = metrics.serve_prometheus(stage_metrics, METRICS_PROMETHEUS_PORT, METRICS_PROMETHEUS_HOST)
+    return _metrics_server is not None
+
 # -------------------- WORKFLOWS --------------------
 
-def run_sort_process(folder: str, rules: List[Dict], progress_callback=None) -> Iterator[str]:
+def _pipeline_options(categories: List[Dict], infer_batch) -> Dict:
+    k = effective_batch_size(categories) if infer_batch else 1
+    return {"workers": PREFETCH_WORKERS, "inflight": inflight_requests(), "depth": max(PREFETCH_DEPTH, 2 * k),
+            "stop_event": stop_event, "batch_size": k, "infer_batch": infer_batch}
+
+def job_path(kind: str) -> str:
+    return os.path.join(JOBS_DIR, f"{kind}.json")
+
+def last_job(kind: str) -> Optional[jobs.Job]:
+    """The last sort or search job if it did not complete, else None."""
+    job = jobs.Job.load(job_path(kind), JOB_CHECKPOINT_S)
+    return job if job is not None and job.resumable else None
+
+def describe_last_job(kind: str) -> str:
+    job = last_job(kind)
+    return job.describe() if job else f"No interrupted {kind} job."
+
+def _open_job(kind: str, resume: bool, log_add, key: Dict, **info) -> jobs.Job:
+    """Reopens the last job of this kind when resuming with the same key settings, else starts a new one."""
+    job = last_job(kind) if resume else None
+    if job is not None and not job.matches(**key):
+        log_add(f"[WARN] The last {kind} job used other settings; starting from scratch.")
+        job = None
+    if job is not None:
+        job.state["status"] = jobs.Job.RUNNING
+        return job
+    return jobs.Job.start(job_path(kind), kind, JOB_CHECKPOINT_S, **key, **info)
+
+def resume_last_sort(progress_callback=None, result_callback=None) -> Iterator[str]:
+    """Continues the interrupted sort job with its folder, rules and mode, skipping finished images."""
+    job = last_job("sort")
+    if job is None:
+        yield "No interrupted sort job to resume."
+        return
+    s = job.state
+    yield from run_sort_process(s["folder"], s["rules"], progress_callback, s.get("reclassify", False), s.get("mode", "precise"),
+                                result_callback, resume=True)
+
+def resume_last_search(progress_callback=None) -> Iterator[Dict[str, List[str]]]:
+    """Continues the interrupted live search; yields {query: matches} with the matches found so far first."""
+    job = last_job("search")
+    if job is None: return
+    s = job.state
+    yield from run_multi_search_process(s["folder"], s.get("queries") or [s["query"]], progress_callback,
+                                        s.get("mode", "precise"), resume=True)
+
+def run_sort_process(folder: str, rules: List[Dict], progress_callback=None, reclassify: bool = False, mode: str = "precise",
+                     result_callback=None, dry_run: bool = False, resume: bool = False) -> Iterator[str]:
+    """
+    Sorts images into rule folders. mode selects precise (chain of thought), fast
+    (constrained ID-only) or cascade (small model first, unclear answers re-asked on the
+    large model) analysis. With reclassify=True, images are matched from their
+    stored descriptions (text only) and only ambiguous ones are sent to the vision model.
+    result_callback(image_path, rule_or_None, dest_path_or_None, error_or_None) is called per image.
+    With dry_run=True nothing is moved; the journal lists where every image would go.
+    Progress is checkpointed to JOBS_DIR; resume=True continues the last sort job
+    (same folder and rules), skipping the images it already finished.
+    """
     stop_event.clear()
     folder = os.path.abspath(folder.strip('"'))
-    images = find_images(folder)
+    images = find_images(folder, rule_folders(folder, rules))
     
     if not images:
         yield "No images found."
         return
+    total = len(images)
 
-    log = [f"Starting High-Precision Sort in: {folder}", f"Found {len(images)} images.", "Initializing AI Engine..."]
-    yield "\n".join(log)
+    titles = {"fast": "Starting Fast Sort", "cascade": "Starting Cascade Sort"}
+    title = "Re-classifying from descriptions" if reclassify else titles.get(mode, "Starting High-Precision Sort")
+    if dry_run: title += " (dry run, nothing is moved)"
+    log = new_run_log("sort", [f"{title} in: {folder}", f"Found {len(images)} images."])
+    log.add("Initializing AI Engine...")
+    yield log.text()
     
     stats = {r["folder_name"]: 0 for r in rules}
     skipped = 0
     processed = 0
+    job: Optional[jobs.Job] = None
+    resume_pair = None
+    if not dry_run:
+        key = {"folder": folder, "rules_hash": jobs.rules_digest(rules), "mode": mode, "reclassify": reclassify}
+        job = _open_job("sort", resume, log.add, key, rules=rules, model=list(active_model_paths()), model_key=current_model_key())
+        if job.done:
+            # Already sorted images were moved out of the scan; the rest (no match) are skipped here.
+            total = len(set(images) | set(job.done))
+            images = [p for p in images if p not in job.done]
+            for outcome in job.done.values():
+                processed += 1
+                if outcome in stats: stats[outcome] += 1
+                else: skipped += 1
+            log.add(f"Resuming: {processed} images already done, {len(images)} left.")
+            pair = tuple(job.state.get("model") or ())
+            if len(pair) == 2 and pair != active_model_paths() and not ENGINE_EXTERNAL_URL and mode != "cascade":
+                if all(os.path.isfile(p) for p in pair):
+                    resume_pair = pair
+                    log.add(f"Using the job's model: {os.path.basename(pair[0])}")
+                else: log.add(f"[WARN] The job's model {os.path.basename(pair[0])} is gone; continuing with the active model.")
+    cache = get_analysis_cache()
+    if cache is not None: cache.reset_counters()
+    encode_stats.reset()
+    resolution_stats.reset()
+    reclassify_stats = ReclassifyStats() if reclassify else None
+    request_stats.reset()
+    begin_run_metrics("sort", folder, mode="reclassify" if reclassify else mode, images=len(images))
+    items, members, dup_stats = images, {}, None
+    cascade_stats: Optional[CascadeStats] = None
+    tiers = [(None, None, None)] if reclassify else cascade_tiers(mode, log)
+    if not reclassify and DEDUP_ENABLED:
+        log.add("Looking for near-duplicates...")
+        yield log.text()
+        _, first_pair, first_mode = tiers[0]
+        planned = plan_near_duplicates(images, rules, first_mode, first_pair or resume_pair)
+        if planned:
+            items, members, dup_stats = planned
+            log.add(f"{dup_stats.copied} near-duplicates will reuse the result of {dup_stats.groups} representatives.")
+    acquire_engine()
+
+    planner = new_move_planner(folder, dry_run)
+
+    def move(img_path: str, match: Dict):
+        try:
+            with stage_metrics.timer("move"): return match, planner.move(img_path, os.path.join(folder, match["folder_name"])), None
+        except Exception as e:
+            return match, None, e
+
+    escalate = False  # set while a cascade tier other than the last one runs
+    unanswered = set()  # failed requests: not checkpointed, so a resume retries them
+
+    def finish(img_path: str, result: Optional[Dict]):
+        # Runs on the pipeline's single mover thread. Near-duplicates follow their representative.
+        match = match_category(result, rules)
+        if result is None: unanswered.add(img_path)
+        if escalate:
+            reason = escalation_reason(result, match)
+            if reason: return reason
+        if dup_stats: dup_stats.folders[img_path] = match["folder_name"] if match else None
+        outcome = move(img_path, match) if match else (None, None, None)
+        copies = [(m,) + (move(m, match) if match else (None, None, None)) for m in members.get(img_path, [])]
+        return outcome, copies
+
+    def record(img_path: str, match: Optional[Dict], dest: Optional[str], err, note: str = ""):
+        nonlocal processed, skipped
+        fname = os.path.basename(img_path)
+        if result_callback: result_callback(img_path, match, dest, err)
+        if job is not None and err is None and img_path not in unanswered and members_of.get(img_path, img_path) not in unanswered:
+            job.mark(img_path, match["folder_name"] if match else None)
+        processed += 1
+        stage_metrics.incr("images")
+        if progress_callback: progress_callback((processed, total), desc=f"Analyzed: {fname}")
+        if match and err is None:
+            stats[match["folder_name"]] += 1
+            log.add(f"✓ {fname} -> {match['folder_name']}{note}")
+        elif match:
+            log.add(f"✗ Error moving {fname}: {err}"); skipped += 1
+        else:
+            skipped += 1
+            log.add(f"- {fname} (No confident match){note}")
     
+    members_of = {m: rep for rep, ms in members.items() for m in ms}
+    failed = False
     try:
-        start_koboldcpp_if_needed()
-        total = len(images)
-        
-        for i, img_path in enumerate(images):
-            if stop_event.is_set():
-                log.append("\n[STOPPED BY USER]")
-                yield "\n".join(log); break
-                
-            if not os.path.exists(img_path): continue
-            
-            fname = os.path.basename(img_path)
-            if progress_callback: progress_callback((i, total), desc=f"Analyzing: {fname}")
-            
-            processed += 1
-            
-            # CALL NEW PRECISION LOGIC
-            match = analyze_image_chain_of_thought(img_path, rules)
-            
-            if match:
-                target = os.path.join(folder, match["folder_name"])
-                try:
-                    move_file_unique(img_path, target)
-                    stats[match["folder_name"]] += 1
-                    log.append(f"✓ {fname} -> {match['folder_name']}")
-                except Exception as e:
-                    log.append(f"✗ Error moving {fname}: {e}"); skipped += 1
-            else:
-                skipped += 1
-                log.append(f"- {fname} (No confident match)")
-                
-            yield "\n".join(log)
+        # The engine is started lazily on the first cache miss.
+        if reclassify:
+            prepare, infer, infer_batch = make_reclassify_stages(rules, reclassify_stats)
+            options = dict(_pipeline_options(rules, infer_batch), batch_size=TEXT_BATCH_SIZE, depth=max(PREFETCH_DEPTH, 2 * TEXT_BATCH_SIZE))
+        elif len(tiers) > 1: cascade_stats = CascadeStats()
+
+        for n, (label, model_pair, tier_mode) in enumerate(tiers):
+            if stop_event.is_set(): break
+            escalate = n < len(tiers) - 1
+            if tier_mode is not None:
+                set_model_override(model_pair or resume_pair)
+                prepare, infer, infer_batch = make_analysis_stages(rules, tier_mode)
+                options = _pipeline_options(rules, infer_batch)
+                k = effective_batch_size(rules)
+                if BATCH_SIZE > 1 and infer_batch and n == 0:
+                    log.add(f"Batching {k} images per request" + (f" (batch_size={BATCH_SIZE} clamped to fit --contextsize {ENGINE_CONTEXT_SIZE})" if k < BATCH_SIZE else "") + ".")
+            if cascade_stats:
+                cascade_stats.begin(label, len(items))
+                log.add(f"--- Tier {n + 1}: {label} ({tier_mode}), {len(items)} images ---")
+                yield log.text()
+            tier_start = time.perf_counter()
+            escalated = []
+
+            for img_path, outcome in run_pipeline(items, prepare, infer, finish, **options):
+                if isinstance(outcome, str):
+                    escalated.append(img_path)
+                    cascade_stats.escalate(outcome)
+                    continue
+                (match, dest, err), copies = outcome or ((None, None, None), [])
+                record(img_path, match, dest, err, f" [{label}]" if cascade_stats and n else "")
+                for m, m_match, m_dest, m_err in copies:
+                    record(m, m_match, m_dest, m_err, f" (duplicate of {os.path.basename(img_path)})")
+                    
+                if log.due(): yield log.text()
+
+            if cascade_stats: cascade_stats.tiers[-1]["seconds"] = time.perf_counter() - tier_start
+            items = escalated
+
+        if stop_event.is_set():
+            log.add("\n[STOPPED BY USER]")
+            yield log.text()
             
     except Exception as e:
-        log.append(f"\nCRITICAL ERROR: {e}")
-        yield "\n".join(log)
+        failed = True
+        log.add(f"\nCRITICAL ERROR: {e}")
+        yield log.text()
     finally:
-        stop_koboldcpp()
+        set_model_override(None)
+        release_engine()
+        planner.close()
         cleanup_temp_folder()
-        summary = ["\n--- COMPLETE ---", f"Processed: {processed}/{len(images)}", f"Skipped (No Match): {skipped}"]
+        if job is not None:
+            if failed: job.finish(jobs.Job.FAILED)
+            elif stop_event.is_set() or unanswered: job.finish(jobs.Job.STOPPED)
+            else: job.finish(jobs.Job.COMPLETE)
+        summary = ["\n--- COMPLETE ---", f"Processed: {processed}/{total}", f"Skipped (No Match): {skipped}"]
+        cache_line = cache_summary_line()
+        if cache_line: summary.append(cache_line)
+        sent_line = encode_stats.summary_line()
+        if sent_line: summary.append(sent_line)
+        resolution_line = resolution_stats.summary_line()
+        if resolution_line: summary.append(resolution_line)
+        if reclassify_stats: summary.append(reclassify_stats.summary_line())
+        if dup_stats: summary.append(dup_stats.summary_line())
+        if cascade_stats: summary.extend(cascade_stats.summary_lines())
+        summary.append(planner.summary_line())
+        summary.extend(request_summary_lines())
         for k, v in stats.items(): summary.append(f"  {k}: {v}")
-        log.extend(summary)
-        yield "\n".join(log)
+        metrics_path = finish_run_metrics()
+        if metrics_path: summary.append(f"Metrics: {metrics_path}")
+        if log.path: summary.append(f"Full log: {log.path}")
+        if planner.journal_path: summary.append(f"Move journal: {planner.journal_path}")
+        if job is not None and job.resumable: summary.append(f"Unfinished: {total - len(job.done)} images can be resumed (Resume Last Job).")
+        log.set_footer(summary)
+        log.close()
+        yield log.text()
 
-def run_search_process(folder: str, query: str, progress_callback=None) -> Iterator[List[str]]:
+def split_queries(text: str) -> List[str]:
+    """One search query per non-empty line, duplicates dropped."""
+    out = []
+    for line in (text or "").splitlines():
+        q = line.strip()
+        if q and q not in out: out.append(q)
+    return out
+
+def run_search_process(folder: str, query: str, progress_callback=None, mode: str = "precise", resume: bool = False) -> Iterator[List[str]]:
+    """Live search for one query; yields the matches so far. See run_multi_search_process."""
+    for found in run_multi_search_process(folder, [query], progress_callback, mode, resume):
+        yield found[query]
+
+def run_multi_search_process(folder: str, queries: List[str], progress_callback=None, mode: str = "precise",
+                             resume: bool = False) -> Iterator[Dict[str, List[str]]]:
+    """
+    Live search: analyzes every image once against all queries and yields {query: matches so far}
+    after each image. A single query is a one-category classification; several queries are
+    answered together by one multi-label request per image. resume=True continues the last (same) search.
+    """
     stop_event.clear()
     folder = os.path.abspath(folder.strip('"'))
+    queries = list(dict.fromkeys(q for q in queries if q.strip()))
+    found: Dict[str, List[str]] = {q: [] for q in queries}
     images = find_images(folder)
-    found_images = []
-    if not images: return
+    if not images or not queries: return
+    total = len(images)
+    single = len(queries) == 1
+    if single:
+        # For search, we define a single category.
+        search_rules = [{"id": "match", "prompt": queries[0], "folder_name": "search_result"}]
+        key = {"folder": folder, "query": queries[0], "mode": mode}
+    else:
+        search_rules = [{"id": f"q{i}", "prompt": q, "folder_name": q} for i, q in enumerate(queries, 1)]
+        key = {"folder": folder, "query": " | ".join(queries), "queries": queries, "mode": mode}
+    query_of = {r["id"]: r["prompt"] for r in search_rules}
+    job = _open_job("search", resume, print, key)
+    if job.done:
+        # Outcomes hold the matched IDs ("q1,q3"; "match" for a single query) in completion order.
+        for path, outcome in job.done.items():
+            for i in (outcome or "").split(","):
+                if i in query_of: found[query_of[i]].append(path)
+        images = [p for p in images if p not in job.done]
+        print(f"[Search] Resuming: {len(job.done)} images already searched, {sum(map(len, found.values()))} matches.")
+        yield found
+    cache = get_analysis_cache()
+    if cache is not None: cache.reset_counters()
+    encode_stats.reset()
+    request_stats.reset()
+    begin_run_metrics("search", folder, mode=mode, images=len(images), queries=len(queries))
+    acquire_engine()
 
+    unanswered, failed = 0, False
     try:
-        start_koboldcpp_if_needed()
-        total = len(images)
-        
-        # For search, we define a single category.
-        search_rule = [{"id": "match", "prompt": query, "folder_name": "search_result"}]
+        # No ladder here: 'none' is the usual search answer and would send most images twice.
+        if single: prepare, infer, infer_batch = make_analysis_stages(search_rules, mode, [ENCODE_MAX_SIDE])
+        else:
+            if mode != "precise": print(f"[Search] {len(queries)} queries: using the multi-label prompt instead of {mode} mode.")
+            prepare, infer, infer_batch = make_analysis_stages(search_rules, "multi", [ENCODE_MAX_SIDE])
+        done = total - len(images)
         
-        for i, img_path in enumerate(images):
-            if stop_event.is_set(): break
-            if progress_callback: progress_callback((i, total), desc=f"Searching: {os.path.basename(img_path)}")
-            
-            match = analyze_image_chain_of_thought(img_path, search_rule)
+        for img_path, result in run_pipeline(images, prepare, infer, **_pipeline_options(search_rules, infer_batch)):
+            done += 1
+            stage_metrics.incr("images")
+            if progress_callback: progress_callback((done, total), desc=f"Searched: {os.path.basename(img_path)}")
             
-            if match: found_images.append(img_path)
-            yield found_images
+            if single: hits = ["match"] if match_category(result, search_rules) is not None else []
+            else: hits = [i for i in (result or {}).get("selected_ids", []) if i in query_of]
+            for i in hits: found[query_of[i]].append(img_path)
+            if result is not None: job.mark(img_path, ",".join(hits) or None, found=bool(hits))
+            else: unanswered += 1
+            yield found
 
-    except Exception as e: print(f"Search Error: {e}")
+    except Exception as e:
+        print(f"Search Error: {e}")
+        failed = True
+    finally:
+        release_engine()
+        cleanup_temp_folder()
+        if failed: job.finish(jobs.Job.FAILED)
+        elif stop_event.is_set() or unanswered: job.finish(jobs.Job.STOPPED)
+        else: job.finish(jobs.Job.COMPLETE)
+        metrics_path = finish_run_metrics()
+        for line in [cache_summary_line(), encode_stats.summary_line()] + request_summary_lines() + [metrics_path and f"Metrics: {metrics_path}"]:
+            if line: print(f"[Search] {line}")
+        yield found
+
+def run_index_process(folder: str, progress_callback=None) -> Iterator[str]:
+    """Builds or refreshes the caption index for a folder; only new or changed images reach the model."""
+    stop_event.clear()
+    folder = os.path.abspath(folder.strip('"'))
+    images = find_images(folder)
+    if not images:
+        yield "No images found."
+        return
+
+    index = get_caption_index()
+    counts = {"index": 0, "reused": 0, "cache": 0, "model": 0, "failed": 0}
+    log = new_run_log("index", [f"Indexing: {folder}", f"Found {len(images)} images."])
+    yield log.text()
+    begin_run_metrics("index", folder, images=len(images))
+    acquire_engine()
+    try:
+        prepare, infer, finish = make_caption_stages(index)
+        opts = {"workers": PREFETCH_WORKERS, "inflight": inflight_requests(), "depth": PREFETCH_DEPTH, "stop_event": stop_event}
+        done = 0
+        for img_path, source in run_pipeline(images, prepare, infer, finish, **opts):
+            done += 1
+            counts[source or "failed"] = counts.get(source or "failed", 0) + 1
+            stage_metrics.incr("images")
+            if progress_callback: progress_callback((done, len(images)), desc=f"Indexed: {os.path.basename(img_path)}")
+            if source == "failed": log.add(f"✗ {os.path.basename(img_path)} (could not caption)")
+            if log.due(): yield log.text([f"{done}/{len(images)} checked, {counts['model']} analyzed by the model..."])
+        pruned = index.prune(folder, images)
+        if stop_event.is_set(): log.add("\n[STOPPED BY USER]")
+        log.set_footer([f"\n--- INDEX {'UPDATED' if not stop_event.is_set() else 'PARTIAL'} ---",
+                        f"Up to date: {counts['index']} | Reused: {counts['reused'] + counts['cache']} | "
+                        f"Analyzed: {counts['model']} | Failed: {counts['failed']} | Removed: {pruned}"])
+    except Exception as e:
+        log.add(f"\nCRITICAL ERROR: {e}")
     finally:
-        stop_koboldcpp()
+        release_engine()
         cleanup_temp_folder()
-        yield found_images
+        finish_run_metrics()
+        log.close()
+    yield log.text()
+
+def run_indexed_search_process(folder: str, query: str, rerank: Optional[bool] = None, progress_callback=None) -> Iterator[Tuple[List[str], str]]:
+    """
+    Search against the caption index. Unindexed or changed images are captioned first
+    (live analysis), then captions are ranked with BM25 and optionally re-ranked by the LLM.
+    Yields (found_images, status_text).
+    """
+    rerank = INDEX_RERANK if rerank is None else rerank
+    folder = os.path.abspath(folder.strip('"'))
+    images = find_images(folder)
+    if not images:
+        yield [], "No images found."
+        return
+
+    index = get_caption_index()
+    stale = [p for p in images if not index.is_fresh(p)]
+    if stale:
+        yield [], f"Indexing {len(stale)} new or changed images (live analysis)..."
+        for line in run_index_process(folder, progress_callback):
+            status = line.splitlines()[-1] if line else ""
+            yield [], f"Indexing {len(stale)} new or changed images (live analysis)... {status}"
+        if stop_event.is_set():
+            yield [], "Search stopped while indexing."
+            return
+
+    captions = index.captions_for(images)
+    docs = {p: f"{d} {t} {t}" for p, (d, t) in captions.items()}  # tags weighted twice
+    ranked = caption_index.bm25_rank(query, docs)
+    source = f"index ({len(captions)} captions" + (f", {len(stale)} new or changed" if stale else "") + ")"
+
+    if rerank and ranked:
+        top = ranked[:INDEX_RERANK_CANDIDATES]
+        yield [], f"Re-ranking {len(top)} candidates from the {source}..."
+        acquire_engine()
+        try: picked = rerank_with_llm(query, [(p, captions[p][0]) for p, _, _ in top])
+        except Exception as e:
+            print(f"Search Error: {e}"); picked = None
+        finally: release_engine()
+        if picked is not None:
+            yield picked[:INDEX_TOP_K], f"Results from the {source}, re-ranked by the LLM: {len(picked)} matches."
+            return
+
+    found = [p for p, _, cov in ranked if cov >= INDEX_MIN_COVERAGE][:INDEX_TOP_K]
+    yield found, f"Results from the {source}: {len(found)} matches."
 
 def request_stop():
     stop_event.set()
\ No newline at end of file
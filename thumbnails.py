@@ -0,0 +1,91 @@
+# --- START OF FILE thumbnails.py ---
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import decode_pool
+
+# Disk-backed LRU cache of small preview images (Searcher results, Sorter gallery).
+#
+# Thumbnails are keyed by (absolute path, size, mtime, thumbnail settings), so an
+# edited file gets a new thumbnail and the stale one simply ages out. The file's
+# mtime doubles as the LRU clock: a hit touches it, eviction removes the oldest.
+# Images are decoded by a `decode` callable (decode_pool.thumbnail, in a worker
+# process when the caller passes one) so a broken file cannot take the GUI down.
+
+THUMB_EXT = {"webp": ".webp", "jpeg": ".jpg"}
+
+
+class ThumbnailCache:
+    def __init__(self, folder: str, max_size_mb: int = 256, side: int = 192, fmt: str = "webp", quality: int = 80,
+                 decode: Optional[Callable[[str, int, str, int], bytes]] = None):
+        self.folder = folder
+        self.max_bytes = max(1, int(max_size_mb)) * 1024 * 1024
+        self.side = side
+        self.fmt = fmt if fmt in THUMB_EXT else "webp"
+        self.quality = quality
+        self.decode = decode or (lambda path, side, fmt, quality: decode_pool.thumbnail(path, side, fmt, quality)[0])
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._bytes = sum(e.stat().st_size for e in self._entries())
+
+    def _entries(self):
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir(): continue
+            for e in os.scandir(shard.path):
+                if e.is_file(): yield e
+
+    def key(self, path: str, st: os.stat_result) -> str:
+        raw = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{self.side}|{self.fmt}|{self.quality}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, path: str) -> Optional[str]:
+        """Path of the thumbnail for path, created on a miss. None when the image cannot be read."""
+        try: st = os.stat(path)
+        except OSError: return None
+        k = self.key(path, st)
+        thumb = os.path.join(self.folder, k[:2], k + THUMB_EXT[self.fmt])
+        if os.path.exists(thumb):
+            try: os.utime(thumb)
+            except OSError: pass
+            return thumb
+        tmp = None
+        try:
+            data = self.decode(path, self.side, self.fmt, self.quality)
+            os.makedirs(os.path.dirname(thumb), exist_ok=True)
+            tmp = f"{thumb}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, thumb)
+        except Exception as e:
+            print(f"[WARN] Thumbnail failed for {path}: {e}")
+            if tmp is not None:
+                # A half-written temp file would otherwise count against the budget forever.
+                try: os.remove(tmp)
+                except OSError: pass
+            return None
+        with self._lock:
+            self._bytes += os.path.getsize(thumb)
+            if self._bytes > self.max_bytes: self._evict_locked()
+        return thumb
+
+    def get_many(self, paths: List[str], workers: int = 4) -> Dict[str, str]:
+        """{path: thumbnail} for the paths that could be read, built in parallel."""
+        if not paths: return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths))), thread_name_prefix="thumb") as pool:
+            thumbs = list(pool.map(self.get, paths))
+        return {p: t for p, t in zip(paths, thumbs) if t}
+
+    def _evict_locked(self):
+        # Oldest first until we are back under 90% of the budget.
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in self._entries()))
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, p in entries:
+            if total <= target: break
+            try:
+                os.remove(p)
+                total -= size
+            except OSError: pass
+        self._bytes = total